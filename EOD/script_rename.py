@@ -1,12 +1,82 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, url_for, stream_with_context
+import getpass
+import hashlib
+import json
 import os
+import re
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
 from werkzeug.utils import secure_filename
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 from datetime import datetime
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# The renaming engine is shared with renamingV7.py in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import renaming_core
+from renaming_core import (DEFAULT_CATALOG, OLE_SIGNATURE, REPORT_DATE_FORMAT, REPORTS_CONFIG, ReportCatalog,
+                           ReportRenamer, VerifiedTransfer, WorkbookError, check_workbook_signature, directory_cache,
+                           load_report_config, metrics, normalize_report_date, record_content, same_content,
+                           save_content_indexes, temp_prefix, validate_workbook)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['ALLOWED_EXTENSIONS'] = {'xls', 'xlsx'}
+# File mapping and routing rules, shared with renamingV7.py; re-read whenever the file changes
+app.config['REPORTS_CONFIG'] = os.environ.get('REPORTS_CONFIG', REPORTS_CONFIG)
+# Write uploads straight into their destination folders while the request body is read
+app.config['STREAM_UPLOADS'] = True
+# Read size for streamed uploads; must stay below Flask's MAX_FORM_MEMORY_SIZE
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024
+# Size limits in bytes: per uploaded file, and per request (enforced by Flask/Werkzeug)
+app.config['MAX_FILE_SIZE'] = 512 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024
+# Accept uploads into UPLOAD_FOLDER and move them to OneDrive on background workers;
+# /process_files then returns a job ID to poll at /jobs/<id>
+app.config['ASYNC_JOBS'] = True
+app.config['JOB_WORKERS'] = 4
+app.config['MAX_JOBS'] = 1000
+# Seconds a finished job's status is kept
+app.config['JOB_TTL'] = 3600
+# Job status files, so any worker process can answer /jobs/<id>
+app.config['JOBS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.jobs')
+# Advisory lock files serializing writes to the same destination across worker processes;
+# destinations are hashed onto LOCK_STRIPES lock files
+app.config['LOCK_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.locks')
+app.config['LOCK_STRIPES'] = 256
+# Seconds to wait for a destination lock before the upload fails with a timeout error
+app.config['LOCK_TIMEOUT'] = 60
+# Background sweeping of UPLOAD_FOLDER, every SWEEP_INTERVAL seconds (0 disables it): staged files
+# last modified more than STAGING_MAX_AGE seconds ago are deleted, and while the folder holds more than
+# STAGING_MAX_BYTES the oldest files are evicted, sparing those younger than STAGING_MIN_AGE seconds
+# (possibly still being received or moved). Each tick examines at most SWEEP_BATCH files.
+app.config['SWEEP_INTERVAL'] = 30
+app.config['SWEEP_BATCH'] = 500
+app.config['STAGING_MAX_AGE'] = 24 * 3600
+app.config['STAGING_MIN_AGE'] = 300
+app.config['STAGING_MAX_BYTES'] = 10 * 1024 * 1024 * 1024
+# Verified-transfer mode for moving staged uploads to another volume: each copy is checksummed
+# while it is written, fsynced with its folder and compared before the staged file is deleted.
+# A failed copy is retried up to TRANSFER_RETRIES times, after TRANSFER_BACKOFF seconds, doubled
+# for each later retry. The checksum overhead is exported at /metrics (checksum and verify stages).
+app.config['VERIFY_TRANSFERS'] = False
+app.config['TRANSFER_RETRIES'] = 3
+app.config['TRANSFER_BACKOFF'] = 0.5
+# Request threads per process when served by waitress (python script_rename.py)
+app.config['SERVER_THREADS'] = 8
+
+# Check that uploads are complete workbooks (zip directory / OLE header) before filing them
+app.config['VALIDATE_WORKBOOKS'] = True
+# SQLite catalog of filed reports behind /reports, shared with renamingV7.py; empty to disable
+app.config['CATALOG_PATH'] = os.environ.get('CATALOG_PATH', DEFAULT_CATALOG)
+# Root of the destination tree; defaults to the service account's OneDrive (see default_destination_root)
+app.config['DESTINATION_ROOT'] = os.environ.get('DESTINATION_ROOT')
 
 def allowed_file(filename):
     """
@@ -19,83 +89,815 @@ def format_date(date_str):
     Convert a date string from YYYY-MM-DD format to DDMonYYYY format.
     """
     date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-    return date_obj.strftime('%d%b%Y')
-
-class FileRenamerMover:
-    def __init__(self, file_mapping, additional_info):
-        """
-        Initialize the FileRenamerMover with file mapping, additional information, 
-        and destination directories based on the logged-in user.
-        """
-        self.file_mapping = file_mapping
-        self.additional_info = additional_info
-        self.username = self.get_logged_in_username()
-        self.base_destination_directory = os.path.join('C:\\Users', self.username, 'OneDrive - iTrust Finance Limited', 'itrust')
-        self.finance_folder = os.path.join(self.base_destination_directory, 'FINANCE')
-        self.credit_folder = os.path.join(self.base_destination_directory, 'CREDIT')
-        self.investment_folder = os.path.join(self.base_destination_directory, 'INVESTMENT')
-
-    def get_logged_in_username(self):
-        """
-        Retrieve the username of the currently logged-in user.
-        """
-        return os.getlogin()
-
-    def determine_destination_folder(self, new_name):
-        """
-        Determine the appropriate destination folder for a renamed file based on its new name.
-        """
-        if new_name.startswith('P&L_CONSOLIDATED_'):
-            suffix = new_name.split('_')[2]
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'P&L', suffix)
-        elif new_name.startswith('SKUK_Report_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'SUKUK')
-        elif new_name.startswith('Daily Investment Report_'):
-            return os.path.join(self.investment_folder, '2024', 'JUNE')
-        elif new_name.startswith('FUND CUSTOMER BALANCE_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'FUND CUSTOMER BALANCE')
-        elif new_name.startswith('Data Entry Report_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'DATA ENTRY')
-        elif new_name.startswith('Balancesheet_consolidated_'):
-            suffix = new_name.split('_')[2]
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'BALANCE SHEET', suffix)
-        elif new_name.startswith('CUSTOMER BALANCE_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'CUSTOMER BALANCE')
-        elif new_name.startswith('Bot_Loan_status_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'BOT LOAN STATUS')
-        elif new_name.startswith('Loan Report Swalha_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'BOT LOAN STATUS')
+    return date_obj.strftime(REPORT_DATE_FORMAT)
+
+def move_upload(source_path, destination_path, digest=None):
+    """
+    Move a saved upload to its destination with shutil.move or, with VERIFY_TRANSFERS, through the
+    engine's VerifiedTransfer: renamed and its folder fsynced on the same volume, otherwise copied
+    and checked (retried with backoff on failure) and deleted only once the copy matches. digest is
+    the upload's BLAKE2b hash, if known.
+    """
+    if not app.config['VERIFY_TRANSFERS']:
+        shutil.move(source_path, destination_path)
+        return
+    same_device = os.stat(source_path).st_dev == os.stat(os.path.dirname(destination_path)).st_dev
+    get_engine().verify.move(source_path, destination_path, same_device, digest)
+
+def destination_lock(path):
+    """
+    Hold the advisory lock of a destination path, shared by every thread and worker process of the
+    service; see renaming_core.destination_lock. The lock files live in LOCK_FOLDER, and waiting for
+    one fails with LockTimeoutError after LOCK_TIMEOUT seconds.
+    """
+    return renaming_core.destination_lock(path, app.config['LOCK_FOLDER'], app.config['LOCK_STRIPES'],
+                                          app.config['LOCK_TIMEOUT'])
+
+class StreamingUpload:
+    def __init__(self, old_name, new_name, destination_path, max_size, staging_folder=None, expected_sheets=None,
+                 report_date=None):
+        """
+        Open a temporary file for an upload that is still being received, beside the destination path
+        or, when a staging folder is given, in that folder to be moved later by a background job.
+        Unless expected_sheets is None (validation off), the upload must be a complete workbook with
+        those sheets; see validate_workbook. report_date is kept for the catalog.
+        """
+        self.old_name = old_name
+        self.new_name = new_name
+        self.destination_path = destination_path
+        self.max_size = max_size
+        self.staging_folder = staging_folder
+        self.expected_sheets = expected_sheets
+        self.report_date = report_date
+        self.head = b''
+        self.size = 0
+        self.started = time.perf_counter()
+        self.digest = hashlib.blake2b()
+        temp_folder = staging_folder or os.path.dirname(destination_path)
+        # The worker's PID in the name keeps temp files of different processes apart and traceable
+        fd, self.temp_path = tempfile.mkstemp(dir=temp_folder, prefix=temp_prefix(new_name), suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        """
+        Append a chunk of the upload, refusing it once the file grows past the size limit.
+        """
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ValueError(f'File exceeds the maximum size of {self.max_size} bytes')
+        if self.expected_sheets is not None and len(self.head) < len(OLE_SIGNATURE):
+            # Refuse a file of the wrong type as soon as its signature has arrived
+            self.head += data[:len(OLE_SIGNATURE)]
+            if len(self.head) >= len(OLE_SIGNATURE):
+                check_workbook_signature(self.old_name, self.head)
+        self.file.write(data)
+        self.digest.update(data)
+
+    def commit(self):
+        """
+        Flush the received bytes to disk and atomically rename the temp file to its final name.
+        Staged uploads stay in the staging folder; their result carries the 'staged' path, content
+        hash and report date instead. An upload that fails validation raises WorkbookError before it is renamed (the
+        caller aborts it). An upload identical to the file already at its destination is discarded. The
+        comparison and rename happen under the destination's lock, so concurrent uploads of the same
+        report from other workers are applied one at a time.
+        """
+        metrics.observe('receive', time.perf_counter() - self.started)
+        metrics.add_bytes('receive', self.size)
+        with metrics.timed('fsync'):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if self.expected_sheets is not None:
+            validate_workbook(self.temp_path, self.old_name, self.expected_sheets)
+        digest = self.digest.hexdigest()
+        result = {'old': self.old_name, 'new': self.new_name, 'moved_to': self.destination_path}
+        if self.staging_folder:
+            result['staged'] = self.temp_path
+            result['digest'] = digest
+            result['report_date'] = self.report_date
         else:
-            return os.path.join(self.base_destination_directory)
+            with destination_lock(self.destination_path):
+                if same_content(self.destination_path, self.size, digest):
+                    os.unlink(self.temp_path)
+                    result['unchanged'] = True
+                else:
+                    with metrics.timed('rename'):
+                        os.replace(self.temp_path, self.destination_path)
+                    record_content(self.destination_path, digest)
+        return result
+
+    def abort(self):
+        """
+        Discard a partially received upload.
+        """
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.unlink(self.temp_path)
+
+def record_in_catalog(router, filed):
+    """
+    Add reports just filed, as (path, content hash, report date) tuples, to the catalog if it is
+    enabled. Failures are logged rather than failing the upload; `renamingV7.py catalog rebuild`
+    restores missing rows.
+    """
+    catalog = get_engine().catalog
+    if catalog is None or not filed:
+        return
+    try:
+        catalog.record([ReportCatalog.entry(router, path, os.stat(path), digest, report_date)
+                        for path, digest, report_date in filed])
+    except (OSError, sqlite3.Error) as e:
+        app.logger.warning('Recording %d report(s) in the catalog failed: %s', len(filed), e)
+
+class JobRegistry:
+    def __init__(self, max_jobs, ttl, folder=None):
+        """
+        Keep the status of background jobs in memory. At most max_jobs are held, and finished jobs
+        are forgotten ttl seconds after they complete. With a folder, each job's status is also
+        written there, so a job can be polled through any worker process, not just the one running it.
+        """
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.folder = folder
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def job_path(self, job_id):
+        return os.path.join(self.folder, job_id + '.json')
+
+    def persist(self, job_id):
+        """
+        Write a job's status file atomically. Must be called with the lock held.
+        """
+        if self.folder is None:
+            return
+        try:
+            fd, temp_path = directory_cache.run_in(self.folder, tempfile.mkstemp, '.part', f'.{job_id}.{os.getpid()}.', self.folder)
+            with os.fdopen(fd, 'w', encoding='utf-8') as job_file:
+                json.dump(self.jobs[job_id], job_file)
+            os.replace(temp_path, self.job_path(job_id))
+        except OSError as e:
+            app.logger.warning('Saving the status of job %s failed: %s', job_id, e)
+
+    def forget(self, job_id):
+        """
+        Drop a job and its status file. Must be called with the lock held.
+        """
+        self.jobs.pop(job_id, None)
+        if self.folder is not None:
+            try:
+                os.unlink(self.job_path(job_id))
+            except OSError:
+                pass
+
+    def create(self):
+        """
+        Register a new job and return its ID, or None if the registry is full of unfinished jobs.
+        """
+        with self.lock:
+            self.evict()
+            if len(self.jobs) >= self.max_jobs:
+                return None
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'id': job_id, 'status': 'receiving', 'created': time.time(), 'finished': None, 'files': []}
+            self.persist(job_id)
+            return job_id
+
+    def update(self, job_id, **changes):
+        """
+        Update the fields of a job.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(changes)
+                self.persist(job_id)
+
+    def update_file(self, job_id, index, **changes):
+        """
+        Update the status entry of one file in a job.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job['files'][index].update(changes)
+                self.persist(job_id)
+
+    def discard(self, job_id):
+        """
+        Forget a job.
+        """
+        with self.lock:
+            self.forget(job_id)
+
+    def get(self, job_id):
+        """
+        Return a snapshot of a job with per-file progress, or None if it is unknown or expired.
+        """
+        with self.lock:
+            self.evict()
+            job = self.jobs.get(job_id)
+        if job is None and self.folder is not None and re.fullmatch('[0-9a-f]{32}', job_id):
+            # A job run by another worker process
+            try:
+                with open(self.job_path(job_id), encoding='utf-8') as job_file:
+                    job = json.load(job_file)
+            except (OSError, ValueError):
+                return None
+            if job['finished'] is not None and time.time() - job['finished'] > self.ttl:
+                return None
+        if job is None:
+            return None
+        with self.lock:
+            files = [{key: value for key, value in entry.items() if key != 'staged'} for entry in job['files']]
+            done = sum(1 for entry in files if entry['status'] in ('moved', 'unchanged', 'error'))
+            return dict(job, files=files, done=done, total=len(files))
+
+    def unfinished_jobs(self):
+        """
+        Return the jobs that have not finished yet (queued, receiving or running), in this worker process
+        and, from their status files, in the others.
+        """
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job['finished'] is None]
+            local = set(self.jobs)
+        if self.folder is not None:
+            try:
+                names = os.listdir(self.folder)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if re.fullmatch(r'[0-9a-f]{32}\.json', name) and name[:-5] not in local:
+                    try:
+                        with open(os.path.join(self.folder, name), encoding='utf-8') as job_file:
+                            job = json.load(job_file)
+                    except (OSError, ValueError):
+                        continue
+                    if job['finished'] is None:
+                        jobs.append(job)
+        return jobs
+
+    def staged_paths(self):
+        """
+        Return the staged uploads that unfinished jobs have yet to move.
+        """
+        jobs = self.unfinished_jobs()
+        with self.lock:
+            return {entry['staged'] for job in jobs for entry in job['files']
+                    if entry.get('staged') and entry['status'] in ('queued', 'moving')}
+
+    def status_paths(self):
+        """
+        Return the status files of unfinished jobs. A finished job's file is last written when it
+        finishes, so its age counts from then.
+        """
+        if self.folder is None:
+            return set()
+        return {self.job_path(job['id']) for job in self.unfinished_jobs()}
+
+    def evict(self):
+        """
+        Drop expired jobs, then the oldest finished jobs while the registry is at capacity.
+        Must be called with the lock held.
+        """
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            finished = job['finished']
+            if finished is not None and (now - finished > self.ttl or len(self.jobs) >= self.max_jobs):
+                self.forget(job_id)
+
+class StagingSweeper:
+    def __init__(self, folder, max_age, max_bytes=None, min_age=0, batch_size=500, pinned=None):
+        """
+        Incremental cleaner for a staging folder. Each tick examines at most batch_size files,
+        resuming the folder listing where the previous tick stopped: files last modified more than
+        max_age seconds ago are deleted. When a full pass finds the folder holding more than max_bytes,
+        its oldest files (never those younger than min_age) are evicted over the following ticks,
+        again at most batch_size per tick, until the excess is gone. pinned, if given, returns the
+        paths that must not be removed (uploads still waiting for their job).
+        """
+        self.folder = folder
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.pinned = pinned
+        self.lock = threading.Lock()
+        self.listing = None
+        # (mtime, size, path) of the files kept so far in the current pass, and their total size
+        self.pass_files = []
+        self.pass_bytes = 0
+        self.evictions = deque()
+        # Bytes still to evict to bring the last complete pass under max_bytes
+        self.excess = 0
+        # Bytes found by the last complete pass
+        self.usage = None
+        self.reclaimed = {'aged_files': 0, 'aged_bytes': 0, 'evicted_files': 0, 'evicted_bytes': 0}
+
+    def remove(self, path, size, reason):
+        """
+        Delete a file and count it as reclaimed for reason ('aged' or 'evicted'). A file another
+        worker process deleted first is skipped.
+        """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            app.logger.warning('Sweeping %s failed: %s', path, e)
+            return
+        self.reclaimed[reason + '_files'] += 1
+        self.reclaimed[reason + '_bytes'] += size
+        metrics.add_bytes('sweep', size)
+
+    def tick(self, now=None):
+        """
+        Run one bounded sweeping step. Returns the number of files and bytes it reclaimed.
+        """
+        now = time.time() if now is None else now
+        with self.lock, metrics.timed('sweep'):
+            before = dict(self.reclaimed)
+            budget = self.batch_size
+            pinned = self.pinned() if self.pinned is not None else set()
+            while self.evictions and self.excess > 0 and budget > 0:
+                budget -= 1
+                mtime, size, path = self.evictions.popleft()
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Moved by its job or removed by someone else, which frees its bytes just the same
+                    self.excess -= size
+                    continue
+                # A file rewritten since it was listed is no longer the oldest
+                if stat.st_mtime == mtime and path not in pinned:
+                    self.remove(path, stat.st_size, 'evicted')
+                    self.excess -= stat.st_size
+            if self.excess <= 0:
+                self.evictions.clear()
+
+            if self.listing is None and budget > 0:
+                try:
+                    self.listing = os.scandir(self.folder)
+                except FileNotFoundError:
+                    return 0, 0
+                self.pass_files = []
+                self.pass_bytes = 0
+            while self.listing is not None and budget > 0:
+                entry = next(self.listing, None)
+                if entry is None:
+                    self.finish_pass(now)
+                    break
+                budget -= 1
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.max_age and entry.path not in pinned:
+                    self.remove(entry.path, stat.st_size, 'aged')
+                else:
+                    self.pass_files.append((stat.st_mtime, stat.st_size, entry.path))
+                    self.pass_bytes += stat.st_size
+
+            files = sum(self.reclaimed[key] - before[key] for key in ('aged_files', 'evicted_files'))
+            size = sum(self.reclaimed[key] - before[key] for key in ('aged_bytes', 'evicted_bytes'))
+        if files:
+            app.logger.info('Swept %d file(s), %d bytes from %s', files, size, self.folder)
+        return files, size
+
+    def finish_pass(self, now):
+        """
+        Close a complete listing of the folder and, if it is over max_bytes, queue its files old enough to
+        be evicted, oldest first; ticks evict them until the excess is gone, skipping pinned files. This
+        replaces what is left of the previous pass's queue. Must be called with the lock held.
+        """
+        self.listing.close()
+        self.listing = None
+        self.usage = self.pass_bytes
+        self.evictions.clear()
+        self.excess = 0
+        if self.max_bytes is not None and self.pass_bytes > self.max_bytes:
+            self.excess = self.pass_bytes - self.max_bytes
+            self.evictions.extend(entry for entry in sorted(self.pass_files) if now - entry[0] >= self.min_age)
+        self.pass_files = []
+
+    def status(self):
+        """
+        Report the folder's size at the last complete pass, pending evictions and what was reclaimed.
+        """
+        with self.lock:
+            return {'folder': self.folder, 'usage_bytes': self.usage, 'max_bytes': self.max_bytes,
+                    'pending_evictions': len(self.evictions), 'reclaimed': dict(self.reclaimed)}
+
+_sweepers_lock = threading.Lock()
+
+def get_sweepers():
+    """
+    Get this worker process's sweepers (for UPLOAD_FOLDER and the job status files), starting their
+    background thread on first use. Called per request rather than at import, so the thread runs in
+    each worker process, not only in a pre-forking master; of those, only the one holding the sweeper
+    lock sweeps (see hold_sweeper_lock). Staged uploads and status files of unfinished jobs are never
+    swept.
+    """
+    sweepers = app.extensions.get('staging_sweepers')
+    if sweepers is None:
+        with _sweepers_lock:
+            sweepers = app.extensions.get('staging_sweepers')
+            if sweepers is None:
+                sweepers = app.extensions['staging_sweepers'] = [
+                    StagingSweeper(app.config['UPLOAD_FOLDER'], app.config['STAGING_MAX_AGE'], app.config['STAGING_MAX_BYTES'],
+                                   app.config['STAGING_MIN_AGE'], app.config['SWEEP_BATCH'], lambda: get_jobs()[0].staged_paths()),
+                    StagingSweeper(app.config['JOBS_FOLDER'], app.config['JOB_TTL'], batch_size=app.config['SWEEP_BATCH'],
+                                   pinned=lambda: get_jobs()[0].status_paths()),
+                ]
+                if app.config['SWEEP_INTERVAL']:
+                    threading.Thread(target=run_sweepers, args=(sweepers, app.config['SWEEP_INTERVAL']),
+                                     name='staging-sweeper', daemon=True).start()
+    return sweepers
+
+def hold_sweeper_lock():
+    """
+    Try to become the worker process that sweeps. The staging folders are shared, so only the holder of
+    LOCK_FOLDER/sweeper.lock sweeps them; it keeps the lock for its lifetime, and another process takes
+    over once it exits. Returns whether this process holds the lock.
+    """
+    if app.extensions.get('sweeper_lock') is not None:
+        return True
+    lock_folder = app.config['LOCK_FOLDER']
+    fd = directory_cache.run_in(lock_folder, os.open, os.path.join(lock_folder, 'sweeper.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    if not renaming_core.try_lock(fd):
+        os.close(fd)
+        return False
+    app.extensions['sweeper_lock'] = fd
+    return True
+
+def run_sweepers(sweepers, interval):
+    """
+    Tick every sweeper each interval seconds, for the life of the process, while this process holds the
+    sweeper lock.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            if not hold_sweeper_lock():
+                continue
+        except OSError as e:
+            app.logger.warning('Taking the sweeper lock failed: %s', e)
+            continue
+        for sweeper in sweepers:
+            try:
+                sweeper.tick()
+            except Exception:
+                app.logger.exception('Sweeping %s failed', sweeper.folder)
+
+@app.before_request
+def start_sweepers():
+    get_sweepers()
+
+_jobs_lock = threading.Lock()
+
+def get_jobs():
+    """
+    Get the app's JobRegistry and the executor running its jobs, creating them from MAX_JOBS, JOB_TTL,
+    JOBS_FOLDER and JOB_WORKERS on first use, so settings changed after import are honoured.
+    """
+    registry = app.extensions.get('job_registry')
+    if registry is None:
+        with _jobs_lock:
+            registry = app.extensions.get('job_registry')
+            if registry is None:
+                app.extensions['job_executor'] = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+                registry = app.extensions['job_registry'] = JobRegistry(app.config['MAX_JOBS'], app.config['JOB_TTL'],
+                                                                        app.config['JOBS_FOLDER'])
+    return registry, app.extensions['job_executor']
+
+def prepare_month_folders(renamer_mover, infos):
+    """
+    Create the destination hierarchy of each report date in infos (additional_info dictionaries) in one
+    pass. The directory cache remembers them, so only the first request of a month pays for it. A
+    folder that cannot be created is left to the moves into it, which report the error.
+    """
+    try:
+        for additional_info in infos:
+            renamer_mover.prepare_destination_folders(additional_info)
+    except OSError:
+        pass
+
+def run_job(job_id, moves):
+    """
+    Move the staged uploads of a job to their destination folders, recording progress per file.
+    moves holds (index, staged path, destination path, digest, report date) per file.
+    """
+    jobs, _ = get_jobs()
+    jobs.update(job_id, status='running')
+    filed = []
+    try:
+        # No route depends on the SYSDATE, so the report date stands in for it
+        report_dates = sorted({report_date for *_, report_date in moves if report_date})
+        if report_dates:
+            prepare_month_folders(get_engine().renamer({'RPTDATE': report_dates[0], 'SYSDATE': report_dates[0]}),
+                                  [{'RPTDATE': report_date, 'SYSDATE': report_date} for report_date in report_dates])
+        for index, staged_path, destination_path, digest, report_date in moves:
+            jobs.update_file(job_id, index, status='moving')
+            try:
+                size = os.path.getsize(staged_path)
+                with destination_lock(destination_path):
+                    if same_content(destination_path, size, digest):
+                        os.unlink(staged_path)
+                        jobs.update_file(job_id, index, status='unchanged')
+                        filed.append((destination_path, digest, report_date))
+                        continue
+                    destination_folder = os.path.dirname(destination_path)
+                    with metrics.timed('move'):
+                        directory_cache.run_in(destination_folder, move_upload, staged_path, destination_path, digest)
+                    metrics.add_bytes('move', size)
+                    record_content(destination_path, digest)
+                filed.append((destination_path, digest, report_date))
+                jobs.update_file(job_id, index, status='moved')
+            except Exception as e:
+                app.logger.warning('Moving %s to %s failed: %s', staged_path, destination_path, e)
+                jobs.update_file(job_id, index, status='error', error=str(e))
+    finally:
+        save_content_indexes()
+        engine = get_engine()
+        record_in_catalog(engine.config.router(engine.base_destination_directory), filed)
+        jobs.update(job_id, status='done', finished=time.time())
+
+class FileRenamerMover(ReportRenamer):
+    """
+    Renames and files the uploads of one request. Requests get theirs from ReportEngine.renamer
+    rather than constructing one directly; naming and routing come from ReportRenamer.
+    """
+
+    def open_upload(self, old_name, new_name, staging_folder=None, report_date=None):
+        """
+        Route an incoming upload by its new name and report date before any of its data is read, and
+        open a StreamingUpload for it in the destination folder (or the staging folder, if given).
+        """
+        destination_folder = self.determine_destination_folder(new_name, report_date)
+        destination_path = os.path.join(destination_folder, new_name)
+        expected_sheets = self.config.sheets_for(new_name) if app.config['VALIDATE_WORKBOOKS'] else None
+        return directory_cache.run_in(staging_folder or destination_folder, StreamingUpload, old_name, new_name,
+                                      destination_path, app.config['MAX_FILE_SIZE'], staging_folder, expected_sheets,
+                                      report_date)
 
     def rename_and_move_files(self, uploaded_files):
         """
         Rename and move uploaded files to their appropriate destination folders based on the mapping.
+        Uploads are hashed while they are saved; one identical to the file already at its destination
+        is discarded, and filed reports are recorded in the content index and the catalog.
         """
         results = []
-        for uploaded_file in uploaded_files:
-            old_name = uploaded_file.filename
-            if old_name in self.file_mapping:
-                new_name_template = self.file_mapping[old_name]
-                new_name = new_name_template.format(**self.additional_info)
-                new_file_path = os.path.join(app.config['UPLOAD_FOLDER'], new_name)
+        filed = []
+        # Work out every new name first so the whole batch is routed in one call
+        matches = [self.match_source(uploaded_file.filename) for uploaded_file in uploaded_files]
+        routed = [match for match in matches if match is not None]
+        destination_folders = iter(self.route_many([new_name for _, new_name, _ in routed], [report_date for _, _, report_date in routed]))
+        try:
+            for uploaded_file, match in zip(uploaded_files, matches):
+                old_name = uploaded_file.filename
+                if match is not None:
+                    _, new_name, report_date = match
+                    destination_folder = next(destination_folders)
 
-                try:
-                    uploaded_file.save(new_file_path)
-                    destination_folder = self.determine_destination_folder(new_name)
-                    destination_path = os.path.join(destination_folder, new_name)
-                    
-                    if not os.path.exists(destination_folder):
-                        os.makedirs(destination_folder)
-
-                    shutil.move(new_file_path, destination_path)
-                    results.append({'old': old_name, 'new': new_name, 'moved_to': destination_path})
-                except Exception as e:
-                    results.append({'error': str(e), 'file': old_name})
-            else:
-                results.append({'error': 'File not found in mapping', 'file': old_name})
+                    try:
+                        # A unique name per upload, so workers saving the same report do not collide
+                        fd, new_file_path = directory_cache.run_in(
+                            app.config['UPLOAD_FOLDER'], tempfile.mkstemp,
+                            '.part', temp_prefix(new_name), app.config['UPLOAD_FOLDER'])
+                        digest = hashlib.blake2b()
+                        with os.fdopen(fd, 'wb') as staged_file:
+                            while chunk := uploaded_file.stream.read(app.config['UPLOAD_CHUNK_SIZE']):
+                                staged_file.write(chunk)
+                                digest.update(chunk)
+                            size = staged_file.tell()
+                        digest = digest.hexdigest()
+                        if app.config['VALIDATE_WORKBOOKS']:
+                            try:
+                                validate_workbook(new_file_path, old_name, self.config.sheets_for(new_name))
+                            except WorkbookError:
+                                os.unlink(new_file_path)
+                                raise
+                        destination_path = os.path.join(destination_folder, new_name)
+                        result = {'old': old_name, 'new': new_name, 'moved_to': destination_path}
+                        with destination_lock(destination_path):
+                            if same_content(destination_path, size, digest):
+                                os.unlink(new_file_path)
+                                result['unchanged'] = True
+                            else:
+                                directory_cache.run_in(destination_folder, move_upload, new_file_path, destination_path, digest)
+                                record_content(destination_path, digest)
+                        filed.append((destination_path, digest, report_date))
+                        results.append(result)
+                    except Exception as e:
+                        results.append({'error': str(e), 'file': old_name})
+                else:
+                    results.append({'error': 'File not found in mapping', 'file': old_name})
+        finally:
+            save_content_indexes()
+            record_in_catalog(self.router, filed)
         return results
 
+def default_destination_root():
+    """
+    The OneDrive folder of the account the service runs as. getpass reads the account from the
+    environment or the password database, so unlike os.getlogin it works without a controlling
+    terminal (under gunicorn, waitress or a service manager).
+    """
+    return os.path.join('C:\\Users', getpass.getuser(), 'OneDrive - iTrust Finance Limited', 'itrust')
+
+class ReportEngine:
+    def __init__(self, config_path, base_destination_directory, catalog_path=None, verify=None):
+        """
+        Process-wide renaming engine, created once per worker: holds the compiled reports config
+        (with its name templates and route table), the directory cache, the destination root, the
+        report catalog, if any, and the VerifiedTransfer used with VERIFY_TRANSFERS. Requests only
+        supply their dates through renamer().
+        """
+        self.config_path = config_path
+        self.base_destination_directory = base_destination_directory
+        self.directory_cache = directory_cache
+        self.verify = verify or VerifiedTransfer()
+        self.catalog = None
+        if catalog_path:
+            try:
+                self.catalog = ReportCatalog(catalog_path)
+            except (OSError, sqlite3.Error) as e:
+                app.logger.error('Cannot open the catalog %s, reports will not be recorded: %s', catalog_path, e)
+
+    @property
+    def config(self):
+        """
+        The compiled reports config; load_report_config only re-reads it when the file changes.
+        """
+        return load_report_config(self.config_path)
+
+    def renamer(self, additional_info):
+        """
+        Get a FileRenamerMover for one request's RPTDATE and SYSDATE.
+        """
+        return FileRenamerMover(self.config, additional_info, self.base_destination_directory)
+
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """
+    Get the app's ReportEngine, creating it from REPORTS_CONFIG, DESTINATION_ROOT and CATALOG_PATH on first use.
+    """
+    engine = app.extensions.get('report_engine')
+    if engine is None:
+        with _engine_lock:
+            engine = app.extensions.get('report_engine')
+            if engine is None:
+                engine = app.extensions['report_engine'] = ReportEngine(
+                    app.config['REPORTS_CONFIG'], app.config['DESTINATION_ROOT'] or default_destination_root(),
+                    app.config['CATALOG_PATH'], VerifiedTransfer(app.config['TRANSFER_RETRIES'], app.config['TRANSFER_BACKOFF']))
+    return engine
+
+def load_manifest(text):
+    """
+    Parse a batch manifest: {"groups": [{"name": ..., "rptdate": ..., "sysdate": ..., "files": [...]}]}.
+    Returns a dictionary of group name -> (additional_info, set of listed file names). Groups without a
+    name are named by their position; sysdate defaults to rptdate and files may be omitted.
+    """
+    try:
+        groups = json.loads(text)['groups']
+        manifest = {}
+        for number, group in enumerate(groups):
+            name = str(group.get('name', number))
+            if name in manifest:
+                raise ValueError(f'Duplicate manifest group {name!r}')
+            rpt_date = normalize_report_date(group['rptdate'])
+            additional_info = {
+                'RPTDATE': rpt_date,
+                'SYSDATE': normalize_report_date(group.get('sysdate') or rpt_date),
+            }
+            manifest[name] = (additional_info, set(group.get('files', ())))
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f'Invalid manifest: {e}')
+    if not manifest:
+        raise ValueError('The manifest has no groups')
+    return manifest
+
+def iter_uploaded_files(stream, boundary, max_form_memory_size, staging_folder=None, batch=False):
+    """
+    Parse a multipart upload part by part, yielding a result per file as soon as it is stored. Each file
+    is routed by its filename when its headers arrive and its bytes are written in chunks straight into
+    its destination folder, so neither the request body nor a staging copy is ever held. The rptdate
+    and sysdate fields must come before the files. With a staging folder, files are written there
+    instead and left for a background job to move.
+
+    With batch set, a manifest field (see load_manifest) comes first instead, and each file is sent
+    under the name of its date group. All groups share one FileRenamerMover.
+    """
+    fields = {}
+    renamer_mover = None
+    manifest = None
+    received = {}
+    part = None
+    field_data = []
+    upload = None
+    group = None
+    # (path, hash, report date) of the reports filed, for the catalog
+    filed = []
+    decoder = MultipartDecoder(boundary, max_form_memory_size=max_form_memory_size)
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+
+    def tagged(result):
+        if batch:
+            result['group'] = group
+        return result
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            # An empty chunk (None) tells the decoder the body is complete
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    part = event
+                    field_data = []
+                elif isinstance(event, File):
+                    part = event
+                    old_name = event.filename
+                    if renamer_mover is None:
+                        if batch:
+                            if 'manifest' not in fields:
+                                raise ValueError('The manifest must be sent before the files')
+                            manifest = load_manifest(fields['manifest'])
+                            infos = [additional_info for additional_info, _ in manifest.values()]
+                        else:
+                            if 'rptdate' not in fields or 'sysdate' not in fields:
+                                raise ValueError('rptdate and sysdate must be sent before the files')
+                            infos = [{
+                                'RPTDATE': format_date(fields['rptdate']),
+                                'SYSDATE': format_date(fields['sysdate']),
+                            }]
+                        renamer_mover = get_engine().renamer(infos[0])
+                        if staging_folder is None:
+                            # Staged uploads get their folders when their job runs
+                            prepare_month_folders(renamer_mover, infos)
+                    additional_info = None
+                    if batch:
+                        group = event.name
+                        if group in manifest:
+                            additional_info = manifest[group][0]
+                            received.setdefault(group, set()).add(old_name)
+                    if batch and additional_info is None:
+                        yield tagged({'error': 'Unknown manifest group', 'file': old_name})
+                    elif not allowed_file(old_name):
+                        yield tagged({'error': 'Only .xls and .xlsx files are allowed', 'file': old_name})
+                    elif (match := renamer_mover.match_source(old_name, additional_info)) is None:
+                        yield tagged({'error': 'File not found in mapping', 'file': old_name})
+                    else:
+                        _, new_name, report_date = match
+                        try:
+                            upload = renamer_mover.open_upload(old_name, new_name, staging_folder, report_date)
+                        except Exception as e:
+                            yield tagged({'error': str(e), 'file': old_name})
+                elif isinstance(event, Data):
+                    if isinstance(part, Field):
+                        field_data.append(event.data)
+                        if not event.more_data:
+                            fields[part.name] = b''.join(field_data).decode()
+                    elif upload is not None:
+                        # Data of rejected files is read and dropped
+                        try:
+                            upload.write(event.data)
+                            if not event.more_data:
+                                result = upload.commit()
+                                if 'staged' not in result:
+                                    filed.append((upload.destination_path, upload.digest.hexdigest(), upload.report_date))
+                                upload = None
+                                yield tagged(result)
+                        except Exception as e:
+                            upload.abort()
+                            failed, upload = upload, None
+                            yield tagged({'error': str(e), 'file': failed.old_name})
+                event = decoder.next_event()
+            if not chunk:
+                break
+    finally:
+        if upload is not None:
+            upload.abort()
+        save_content_indexes()
+        if renamer_mover is not None:
+            record_in_catalog(renamer_mover.router, filed)
+
+    if manifest:
+        for group, (_, listed) in manifest.items():
+            for old_name in sorted(listed - received.get(group, set())):
+                yield tagged({'error': 'Listed in the manifest but not uploaded', 'file': old_name})
+
+def stream_uploaded_files(stream, boundary, max_form_memory_size, staging_folder=None):
+    """
+    Store a multipart upload with iter_uploaded_files and return the list of per-file results.
+    """
+    return list(iter_uploaded_files(stream, boundary, max_form_memory_size, staging_folder))
+
 @app.route('/')
 def index():
     """
@@ -108,6 +910,11 @@ def process_files():
     """
     Process uploaded files: rename and move them based on the provided RPTDATE and SYSDATE.
     """
+    if app.config['ASYNC_JOBS']:
+        return process_files_async()
+    if app.config['STREAM_UPLOADS']:
+        return process_files_streaming()
+
     rpt_date_raw = request.form['rptdate']
     sys_date_raw = request.form['sysdate']
 
@@ -119,41 +926,142 @@ def process_files():
     if not all(allowed_file(file.filename) for file in uploaded_files):
         return jsonify({'error': 'Only .xls and .xlsx files are allowed'}), 400
 
-    file_mapping = {
-        'Profit N Loss 006_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_006_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Profit N Loss 005_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_005_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Profit N Loss 004_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_004_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Profit N Loss 003_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_003_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Profit N Loss 002_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_002_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Profit N Loss 001_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_001_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Loan Report Swalha_Loan Report Swalha Layout.xlsx': 'Loan Report Swalha_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'FUND CUSTOMER BALANCE_Reports.xlsx': 'FUND CUSTOMER BALANCE_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Daily Investment Report_Loan Report Swalha Layout.xlsx': 'Daily Investment Report_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_006_Reports.xlsx': 'Balancesheet_consolidated_006_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_005_Reports.xlsx': 'Balancesheet_consolidated_005_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_004_Reports.xlsx': 'Balancesheet_consolidated_004_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_003_Reports.xlsx': 'Balancesheet_consolidated_003_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_002_Reports.xlsx': 'Balancesheet_consolidated_002_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Balancesheet_001_Reports.xlsx': 'Balancesheet_consolidated_001_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'SKUK_Reports.xlsx': 'SKUK_Report_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'PL_CONSOLIDATED_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_000_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'CUSTOMER BALANCE_Reports.xlsx': 'CUSTOMER BALANCE_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Bot_Loan_status_Bot_loan_status.xls': 'Bot_Loan_status_{RPTDATE}sysdate{SYSDATE}.xls',
-        'Balancesheet_consolidated_new_Reports.xlsx': 'Balancesheet_consolidated_000_{RPTDATE}sysdate{SYSDATE}.xlsx',
-        'Data Entry Report_Data Entry_Layout.xlsx': 'Data Entry Report_{RPTDATE}sysdate{SYSDATE}.xlsx',
-    }
-
     additional_info = {
         'RPTDATE': rpt_date,
         'SYSDATE': sys_date,
     }
 
-    renamer_mover = FileRenamerMover(file_mapping, additional_info)
+    renamer_mover = get_engine().renamer(additional_info)
+    prepare_month_folders(renamer_mover, [additional_info])
     result = renamer_mover.rename_and_move_files(uploaded_files)
     
     return jsonify(result)
 
+def process_files_streaming():
+    """
+    Streaming variant of process_files: uploads are written directly into their destination folders.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Expected a multipart/form-data upload'}), 400
+    try:
+        result = stream_uploaded_files(request.stream, boundary.encode(), request.max_form_memory_size)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result)
+
+def process_files_async():
+    """
+    Receive the uploads into the staging folder at network speed and queue a background job that
+    moves them to their destination folders. Responds with the job ID to poll at /jobs/<id>.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Expected a multipart/form-data upload'}), 400
+    jobs, job_executor = get_jobs()
+    job_id = jobs.create()
+    if job_id is None:
+        return jsonify({'error': 'Too many jobs in progress, please try again later'}), 503
+
+    staging_folder = app.config['UPLOAD_FOLDER']
+    directory_cache.ensure(staging_folder)
+    try:
+        results = stream_uploaded_files(request.stream, boundary.encode(), request.max_form_memory_size, staging_folder)
+    except ValueError as e:
+        jobs.discard(job_id)
+        return jsonify({'error': str(e)}), 400
+    except BaseException:
+        jobs.discard(job_id)
+        raise
+
+    files = []
+    moves = []
+    for index, result in enumerate(results):
+        staged_path = result.pop('staged', None)
+        digest = result.pop('digest', None)
+        report_date = result.pop('report_date', None)
+        if staged_path is None:
+            files.append(dict(result, status='error'))
+        else:
+            # The staged path is kept in the job (not shown by /jobs) so the sweeper leaves the file alone
+            files.append(dict(result, status='queued', staged=staged_path))
+            moves.append((index, staged_path, result['moved_to'], digest, report_date))
+    jobs.update(job_id, status='queued', files=files)
+    job_executor.submit(run_job, job_id, moves)
+    return jsonify({'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id)}), 202
+
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    """
+    Process uploads spanning several report dates in one request. The form starts with a manifest
+    field listing the date groups, and each file is sent under its group's name. Per-file results are
+    streamed back as NDJSON, one line per file as soon as it is stored.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'Expected a multipart/form-data upload'}), 400
+    results = iter_uploaded_files(request.stream, boundary.encode(), request.max_form_memory_size, batch=True)
+
+    def generate():
+        try:
+            for result in results:
+                yield json.dumps(result) + '\n'
+        except ValueError as e:
+            yield json.dumps({'error': str(e)}) + '\n'
+
+    return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/reports')
+def find_reports():
+    """
+    Look up filed reports in the catalog. Query parameters: rptdate, from, to (14Jun2024 or
+    2024-06-14), type (e.g. Balancesheet_consolidated), branch (e.g. 003), name and limit.
+    """
+    catalog = get_engine().catalog
+    if catalog is None:
+        return jsonify({'error': 'The report catalog is disabled'}), 404
+    args = request.args
+    try:
+        limit = max(1, min(int(args.get('limit', 100)), 1000))
+        reports = catalog.query(args.get('rptdate'), args.get('from'), args.get('to'), args.get('type'),
+                                args.get('branch'), args.get('name'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(reports)
+
+@app.route('/staging')
+def staging_status():
+    """
+    Report the size of the staging folders and what the sweepers have reclaimed in this worker.
+    """
+    return jsonify([sweeper.status() for sweeper in get_sweepers()])
+
+@app.route('/metrics')
+def export_metrics():
+    """
+    Expose per-stage timings and byte counters in the Prometheus text format.
+    """
+    return app.response_class(metrics.prometheus('eod'), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Report the progress of a background job, per file.
+    """
+    jobs, _ = get_jobs()
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
 if __name__ == '__main__':
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
-    app.run(host='0.0.0.0', debug=True)
+    # For several worker processes run it under gunicorn instead: gunicorn -w 4 script_rename:app
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    host = os.environ.get('HOST', '0.0.0.0')
+    port = int(os.environ.get('PORT', 5000))
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host=host, port=port, threaded=True)
+    else:
+        serve(app, host=host, port=port, threads=app.config['SERVER_THREADS'])
@@ -0,0 +1,458 @@
+"""
+Benchmark harness for the renaming and routing engines.
+
+Generates synthetic Downloads directories named like the CBS exports in reports.json and times:
+
+- cli:       renamingV7.FileRenamerMover moving the corpus into a destination tree on the same volume
+- cli-cross: the same, with the source and destination on different volumes (e.g. tmpfs -> disk)
+- flask:     EOD/script_rename.py's /process_files route, uploading the corpus through the test client
+
+Each (engine, scenario, target) combination runs in its own child process, so peak memory is measured
+per run. Results include throughput, per-file (CLI) or per-request (Flask) latency percentiles,
+counts of audited file operations and peak RSS, and can be compared against a baseline file to catch
+regressions:
+
+    python benchmarks/benchmark.py                          # default scenarios on tmpfs and disk
+    python benchmarks/benchmark.py --files 20000 --size 4K  # a custom scenario
+    python benchmarks/benchmark.py --target /mnt/slow       # add a throttled or slow mount
+    python benchmarks/benchmark.py --write-baseline         # record benchmarks/baseline.json
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import date, timedelta
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Named corpora: (number of files, size of each file in bytes)
+SCENARIOS = {
+    'small': (50, 4 * 1024),
+    'many': (5000, 4 * 1024),
+    'large': (8, 64 * 1024 * 1024),
+}
+
+# Audit events counted as file operations (os.replace raises os.rename, os.unlink os.remove). These are
+# Python-level calls, not kernel syscalls: a copy_file_range loop or an fsync does not show up here
+AUDITED_EVENTS = ('open', 'os.rename', 'os.remove', 'os.mkdir', 'os.rmdir', 'os.scandir', 'os.listdir',
+                  'os.utime', 'os.chmod', 'os.truncate', 'shutil.copyfile', 'shutil.move')
+
+# Workbook part of the synthetic .xlsx files
+WORKBOOK_XML = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheets><sheet name="Report" sheetId="1"/></sheets></workbook>')
+
+# Files sent per /process_files request
+FLASK_REQUEST_FILES = 20
+
+
+def parse_size(text):
+    """
+    Parse a size such as '4096', '64K', '8M' or '1G'.
+
+    :param text: Size with an optional K/M/G suffix.
+    :return: Size in bytes.
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def default_targets():
+    """
+    :return: Dictionary of target name -> directory: tmpfs (/dev/shm) where available, and the disk
+             holding the system temp directory.
+    """
+    targets = {}
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        targets['tmpfs'] = '/dev/shm'
+    targets['disk'] = tempfile.gettempdir()
+    return targets
+
+
+def corpus_config(file_mapping, source_patterns, routes):
+    """
+    Extend the reports config for a synthetic corpus. Every exact name 'Stem.ext' of the mapping also
+    gets a pattern for 'Stem_YYYY-MM-DD.ext' capturing RPTDATE, so one corpus can hold any number of
+    distinct reports, spread over as many report dates as needed.
+
+    :return: Config dictionary in the reports.json format.
+    """
+    patterns = list(source_patterns)
+    for filename, template in file_mapping.items():
+        stem, extension = os.path.splitext(filename)
+        pattern = '(?:' + re.escape(stem) + r')_(?P<RPTDATE>\d{4}-\d{2}-\d{2})' + re.escape(extension)
+        patterns.append({'pattern': pattern, 'template': template})
+    return {'file_mapping': file_mapping, 'source_patterns': patterns, 'routes': routes}
+
+
+def write_workbook(path, size, stamp, block):
+    """
+    Write a minimal workbook of about `size` bytes that passes the renamers' validation: an .xlsx
+    zip with a workbook part listing one sheet, or an .xls OLE header, padded with `block`.
+
+    :param path: Path of the file; its extension selects the format.
+    :param size: Approximate size in bytes.
+    :param stamp: Bytes making the content unique.
+    :param block: Padding data.
+    """
+    def pad(output, remaining):
+        while remaining > 0:
+            output.write(block[:remaining])
+            remaining -= len(block)
+
+    if path.lower().endswith('.xlsx'):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr('xl/workbook.xml', WORKBOOK_XML)
+            with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=size > 2 ** 31) as sheet:
+                sheet.write(stamp)
+                pad(sheet, size - len(stamp) - len(WORKBOOK_XML) - 256)
+    else:
+        with open(path, 'wb') as output:
+            # OLE2 signature, then the sector shift (512-byte sectors) at offset 30
+            header = bytearray(512)
+            header[:8] = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+            header[30:32] = (9).to_bytes(2, 'little')
+            output.write(header)
+            output.write(stamp)
+            pad(output, size - 512 - len(stamp))
+
+
+def make_corpus(directory, files, size, mapping_names, seed=0):
+    """
+    Write a synthetic Downloads directory: `files` workbooks of about `size` bytes, cycling through
+    the mapping's file names and moving to the previous day after each full cycle.
+
+    :param directory: Directory to create the files in.
+    :param files: Number of files.
+    :param size: Size of each file in bytes.
+    :param mapping_names: Exact file names from the mapping.
+    :param seed: Varies the file content between runs.
+    :return: List of the file names, in creation order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    block = os.urandom(min(size, 1024 * 1024)) if size else b''
+    names = []
+    first_date = date(2024, 6, 30)
+    for number in range(files):
+        cycle, position = divmod(number, len(mapping_names))
+        stem, extension = os.path.splitext(mapping_names[position])
+        report_date = first_date - timedelta(days=cycle)
+        name = f'{stem}_{report_date.isoformat()}{extension}'
+        write_workbook(os.path.join(directory, name), size, f'{seed}:{number}:'.encode(), block)
+        names.append(name)
+    return names
+
+
+def percentiles(values):
+    """
+    :param values: List of durations in seconds.
+    :return: Dictionary of p50, p90, p99 and max in milliseconds.
+    """
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(ordered[-1] * 1000, 3)}
+
+
+def peak_rss_kb():
+    """
+    :return: Peak resident set size of this process in KiB, or None where unavailable.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class FileOperationCounter:
+    def __init__(self):
+        """
+        Count file operation audit events (AUDITED_EVENTS) while enabled. Audit hooks cannot be removed, so one counter
+        is installed per process.
+        """
+        self.counts = collections.Counter()
+        self.enabled = False
+        sys.addaudithook(self.hook)
+
+    def hook(self, event, args):
+        if self.enabled and event in AUDITED_EVENTS:
+            self.counts[event] += 1
+
+
+def stage_totals(summary):
+    """
+    :param summary: StageMetrics.summary() of a run.
+    :return: Its per-stage count, total, mean and max, without the latency histograms.
+    """
+    return {stage: {key: value for key, value in timings.items() if key != 'buckets'}
+            for stage, timings in summary['stages'].items()}
+
+
+def run_cli(job, work, counter):
+    """
+    Time renamingV7.FileRenamerMover moving a corpus.
+
+    :return: Dictionary of measurements.
+    """
+    sys.path.insert(0, REPO)
+    import renamingV7
+
+    source = os.path.join(job['source_target'], work, 'Downloads')
+    destination = os.path.join(job['target'], work, 'OneDrive')
+    config = renamingV7.load_report_config(job['config_path'])
+    names = make_corpus(source, job['files'], job['size'], list(config.file_mapping))
+
+    class BenchmarkRenamerMover(renamingV7.FileRenamerMover):
+        def get_logged_in_username(self):
+            # The benchmark files into its own destination tree, never a real user's OneDrive
+            return 'benchmark'
+
+    additional_info = {'RPTDATE': '30Jun2024', 'SYSDATE': '01Jul2024'}
+    renamer_mover = BenchmarkRenamerMover(config, source, additional_info, job['workers'])
+    renamer_mover.base_destination_directory = destination
+    renamer_mover.router = config.router(destination)
+
+    latencies = []
+    move_file = renamer_mover.move_file
+
+    def timed_move(operation):
+        start = time.perf_counter()
+        result = move_file(operation)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    renamer_mover.move_file = timed_move
+    counter.enabled = True
+    start = time.perf_counter()
+    results = renamer_mover.rename_and_move_files()
+    seconds = time.perf_counter() - start
+    counter.enabled = False
+    errors = [result for result in results if 'error' in result]
+    return {'files': len(names), 'moved': len(results) - len(errors), 'errors': len(errors),
+            'seconds': seconds, 'latency_ms': percentiles(latencies), 'stages': stage_totals(renamingV7.metrics.summary())}
+
+
+def run_flask(job, work, counter):
+    """
+    Time the /process_files route uploading a corpus through the Flask test client, in requests of
+    FLASK_REQUEST_FILES files.
+
+    :return: Dictionary of measurements.
+    """
+    sys.path.insert(0, os.path.join(REPO, 'EOD'))
+    import script_rename
+
+    source = os.path.join(job['target'], work, 'Downloads')
+    destination = os.path.join(job['target'], work, 'OneDrive')
+    with open(job['config_path'], encoding='utf-8') as config_file:
+        mapping_names = list(json.load(config_file)['file_mapping'])
+    names = make_corpus(source, job['files'], job['size'], mapping_names)
+
+    uploads = os.path.join(job['target'], work, 'uploads')
+    script_rename.app.config.update(REPORTS_CONFIG=job['config_path'], DESTINATION_ROOT=destination,
+                                    ASYNC_JOBS=False, STREAM_UPLOADS=True, UPLOAD_FOLDER=uploads,
+                                    LOCK_FOLDER=os.path.join(uploads, '.locks'), JOBS_FOLDER=os.path.join(uploads, '.jobs'),
+                                    CATALOG_PATH=os.path.join(job['target'], work, 'catalog.sqlite3'))
+    client = script_rename.app.test_client()
+
+    latencies = []
+    moved = errors = 0
+    counter.enabled = True
+    start = time.perf_counter()
+    for offset in range(0, len(names), FLASK_REQUEST_FILES):
+        batch = names[offset:offset + FLASK_REQUEST_FILES]
+        files = [open(os.path.join(source, name), 'rb') for name in batch]
+        try:
+            request_start = time.perf_counter()
+            response = client.post('/process_files', content_type='multipart/form-data', data={
+                'rptdate': '2024-06-30', 'sysdate': '2024-07-01',
+                'files': [(file, name) for file, name in zip(files, batch)],
+            })
+            latencies.append(time.perf_counter() - request_start)
+        finally:
+            for file in files:
+                file.close()
+        for result in response.get_json():
+            if 'error' in result:
+                errors += 1
+            else:
+                moved += 1
+    seconds = time.perf_counter() - start
+    counter.enabled = False
+    return {'files': len(names), 'moved': moved, 'errors': errors, 'seconds': seconds,
+            'latency_ms': percentiles(latencies)}
+
+
+def run_child(job):
+    """
+    Run one benchmark job in this process and return its measurements.
+
+    :param job: Dictionary describing the engine, corpus and target directories.
+    :return: Dictionary of measurements.
+    """
+    counter = FileOperationCounter()
+    work = tempfile.mkdtemp(prefix='renamer-benchmark-', dir=job['target'])
+    # Keep the run's content indexes, lock files and catalog out of the real state folder; set before
+    # the engines import renaming_core, which reads it once
+    os.environ['REPORTS_STATE_DIR'] = os.path.join(work, 'state')
+    try:
+        if job['source_target'] != job['target']:
+            os.makedirs(os.path.join(job['source_target'], os.path.basename(work)), exist_ok=True)
+        runner = run_flask if job['engine'] == 'flask' else run_cli
+        measurements = runner(job, os.path.basename(work), counter)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        if job['source_target'] != job['target']:
+            shutil.rmtree(os.path.join(job['source_target'], os.path.basename(work)), ignore_errors=True)
+    total_bytes = measurements['files'] * job['size']
+    measurements.update(
+        files_per_second=round(measurements['files'] / measurements['seconds'], 2),
+        mb_per_second=round(total_bytes / measurements['seconds'] / 1024 ** 2, 2),
+        seconds=round(measurements['seconds'], 4),
+        file_operations=dict(sorted(counter.counts.items())),
+        peak_rss_kb=peak_rss_kb(),
+    )
+    return measurements
+
+
+def compare(results, baseline, tolerance, operations_tolerance=0.05, rss_tolerance=0.25):
+    """
+    Compare results against a baseline.
+
+    :param results: Dictionary of run key -> measurements.
+    :param baseline: Dictionary of run key -> measurements.
+    :param tolerance: Allowed relative slowdown, e.g. 0.2 for 20%.
+    :param operations_tolerance: Allowed relative rise in audited file operations.
+    :param rss_tolerance: Allowed relative rise in peak RSS.
+    :return: List of regression descriptions.
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if current['files_per_second'] < previous['files_per_second'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {current['files_per_second']} files/s, "
+                               f"baseline {previous['files_per_second']} files/s")
+        current_p99 = current['latency_ms'].get('p99')
+        previous_p99 = previous['latency_ms'].get('p99')
+        if current_p99 and previous_p99 and current_p99 > previous_p99 * (1 + tolerance):
+            regressions.append(f'{key}: p99 latency {current_p99} ms, baseline {previous_p99} ms')
+        if 'file_operations' in previous:
+            current_operations = sum(current['file_operations'].values())
+            previous_operations = sum(previous['file_operations'].values())
+            if current_operations > previous_operations * (1 + operations_tolerance):
+                regressions.append(f'{key}: {current_operations} file operations, baseline {previous_operations}')
+        current_rss, previous_rss = current['peak_rss_kb'], previous.get('peak_rss_kb')
+        if current_rss and previous_rss and current_rss > previous_rss * (1 + rss_tolerance):
+            regressions.append(f'{key}: peak RSS {current_rss} KiB, baseline {previous_rss} KiB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark renamingV7.py and the EOD /process_files route.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='named corpus to run (default: small and many); may be repeated')
+    parser.add_argument('--files', type=int, help='run a custom corpus with this many files')
+    parser.add_argument('--size', type=parse_size, default=4 * 1024, help='size of each custom file, e.g. 4K, 8M, 1G (default: 4K)')
+    parser.add_argument('--engine', action='append', choices=['cli', 'cli-cross', 'flask'],
+                        help='engine to run (default: all); may be repeated')
+    parser.add_argument('--target', action='append', default=[],
+                        help='extra directory to run on, e.g. a throttled or network mount; may be repeated')
+    parser.add_argument('--workers', type=int, default=4, help='FileRenamerMover workers (default: 4)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('--write-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before failing (default: 0.2)')
+    parser.add_argument('--operations-tolerance', type=float, default=0.05,
+                        help='allowed relative rise in audited file operations before failing (default: 0.05)')
+    parser.add_argument('--rss-tolerance', type=float, default=0.25,
+                        help='allowed relative rise in peak RSS before failing (default: 0.25)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return 0
+
+    with open(os.path.join(REPO, 'reports.json'), encoding='utf-8') as config_file:
+        reports = json.load(config_file)
+    scenarios = {name: SCENARIOS[name] for name in args.scenario or ['small', 'many']}
+    if args.files:
+        scenarios[f'custom-{args.files}x{args.size}'] = (args.files, args.size)
+    targets = default_targets()
+    for directory in args.target:
+        targets[os.path.basename(os.path.normpath(directory)) or directory] = directory
+    engines = args.engine or ['cli', 'cli-cross', 'flask']
+
+    config_directory = tempfile.mkdtemp(prefix='renamer-benchmark-config-')
+    config_path = os.path.join(config_directory, 'reports.json')
+    with open(config_path, 'w', encoding='utf-8') as config_file:
+        json.dump(corpus_config(reports['file_mapping'], reports.get('source_patterns', []), reports['routes']), config_file)
+
+    results = {}
+    try:
+        for engine in engines:
+            for scenario, (files, size) in scenarios.items():
+                for target_name, target in targets.items():
+                    source_target = target
+                    if engine == 'cli-cross':
+                        # Source on the first target of another volume
+                        others = [other for other in targets.values() if os.stat(other).st_dev != os.stat(target).st_dev]
+                        if not others:
+                            continue
+                        source_target = others[0]
+                    job = {'engine': engine, 'files': files, 'size': size, 'target': target,
+                           'source_target': source_target, 'workers': args.workers, 'config_path': config_path}
+                    key = f'{engine}/{scenario}/{target_name}'
+                    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(job)],
+                                               capture_output=True, text=True)
+                    if completed.returncode:
+                        print(f'{key}: failed\n{completed.stderr}', file=sys.stderr)
+                        continue
+                    results[key] = json.loads(completed.stdout.splitlines()[-1])
+                    result = results[key]
+                    print(f"{key:32} {result['files_per_second']:>10} files/s {result['mb_per_second']:>9} MiB/s  "
+                          f"p50 {result['latency_ms'].get('p50')} ms  p99 {result['latency_ms'].get('p99')} ms  "
+                          f"file ops {sum(result['file_operations'].values())}  peak {result['peak_rss_kb']} KiB"
+                          + (f"  errors {result['errors']}" if result['errors'] else ''))
+    finally:
+        shutil.rmtree(config_directory, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+    if args.write_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance, args.operations_tolerance, args.rss_tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,136 +1,1522 @@
+import argparse
+import ctypes
+import ctypes.util
+import getpass
+import json
+import logging
 import os
+import select
+import sqlite3
 import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 
-class FileRenamerMover:
-    def __init__(self, file_mapping, source_directory, additional_info):
+try:
+    # Python 3.14+
+    from compression import zstd
+    zstandard = None
+except ImportError:
+    zstd = None
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+from concurrent.futures import ThreadPoolExecutor
+
+from renaming_core import (ARCHIVE_FORMATS, COPY_CHUNK_SIZE, DEFAULT_CATALOG, REPORT_DATE_FORMAT, REPORT_EXTENSIONS,
+                           ZSTD_FOOTER, ZSTD_FOOTER_MAGIC, ZSTD_INDEX_MAGIC, ReportCatalog, ReportRenamer, VerifiedTransfer,
+                           bundle_members, content_index, copy_across_devices, date_path, directory_cache, file_digest,
+                           fsync_directory, load_report_config, metrics, normalize_report_date, recover_zip,
+                           save_content_indexes, tar_zst_index, validate_workbook, zip_journal_path)
+
+logger = logging.getLogger('renamingV7')
+
+# Name of the operation journal kept in the source directory while a batch runs
+JOURNAL_NAME = '.renaming-journal.jsonl'
+
+# Ledger of the archive bundles under the base destination directory, read when pruning loose files
+ARCHIVE_LEDGER_NAME = '.archive-ledger.json'
+
+# Suffixes browsers give downloads that are still in progress
+PARTIAL_DOWNLOAD_SUFFIXES = ('.crdownload', '.part', '.partial', '.download', '.tmp')
+
+
+def remove_partial_copies(destination_path):
+    """
+    Delete the temporary files an interrupted copy_across_devices left beside a destination path.
+
+    :param destination_path: Final path of the file being copied.
+    """
+    folder, name = os.path.split(destination_path)
+    prefix = '.' + name + '.'
+    try:
+        with os.scandir(folder) as entries:
+            partial = [entry.path for entry in entries if entry.name.startswith(prefix) and entry.name.endswith('.part')]
+    except FileNotFoundError:
+        return
+    for path in partial:
+        os.unlink(path)
+
+
+# One planned file move. `conflict` is None, 'collision' (another file in the batch gets the same
+# destination path) or 'overwrite' (a file with that name already exists at the destination).
+PlannedMove = namedtuple('PlannedMove', ['old_name', 'new_name', 'destination_folder', 'destination_path', 'conflict', 'report_date'],
+                         defaults=(None,))
+
+
+class BatchPlan:
+    def __init__(self, operations, new_folders, missing, unmatched, superseded):
+        """
+        The full set of operations for a batch, computed before any file is touched.
+
+        :param operations: List of PlannedMove entries, in mapping order.
+        :param new_folders: Sorted list of destination folders that do not exist yet.
+        :param missing: Mapped file names that were not found.
+        :param unmatched: Spreadsheets in the source directory that no rule matched.
+        :param superseded: Dictionary of older duplicate downloads that were skipped to the download
+                           filed in their place. They are kept unless the renamer removes duplicates,
+                           in which case they are deleted once that one has been moved.
+        """
+        self.operations = operations
+        self.new_folders = new_folders
+        self.missing = missing
+        self.unmatched = unmatched
+        self.superseded = superseded
+
+    def conflicts(self):
+        """
+        :return: The planned moves that collide with another move or would overwrite an existing file.
+        """
+        return [operation for operation in self.operations if operation.conflict]
+
+    def print_plan(self, source_directory, remove_duplicates=False):
+        """
+        Log the planned operations.
+
+        :param source_directory: Directory the source files are in.
+        :param remove_duplicates: Whether the older duplicates will be deleted or kept.
+        """
+        logger.info('Plan: %d file(s) to move, %d folder(s) to create, %d conflict(s)',
+                    len(self.operations), len(self.new_folders), len(self.conflicts()))
+        for folder in self.new_folders:
+            logger.info('Create folder: %s', folder)
+        for operation in self.operations:
+            action = {None: 'Move', 'collision': 'Skip (collides with another file)',
+                      'overwrite': 'Move (overwrites existing file)'}[operation.conflict]
+            logger.info('%s: %s -> %s', action, os.path.join(source_directory, operation.old_name), operation.destination_path)
+        for old_name, winner in self.superseded.items():
+            if remove_duplicates:
+                logger.info('Delete older duplicate once %s is moved: %s', winner, os.path.join(source_directory, old_name))
+            else:
+                logger.info('Skip older duplicate (%s is newer): %s', winner, os.path.join(source_directory, old_name))
+
+
+class OperationJournal:
+    def __init__(self, path):
+        """
+        Append-only JSON-lines journal of a batch. The intent of every move is written and fsynced
+        before any file is touched, and each move's completion is appended as it finishes, so a run
+        that dies partway can be resumed from the journal alone. The file is removed once nothing in
+        it is left open.
+
+        :param path: Path of the journal file.
+        """
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def pending(self):
+        """
+        :return: PlannedMove entries whose intent was recorded but whose completion was not, in order.
+        """
+        pending = {}
+        try:
+            with open(self.path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A record torn by a crash in the middle of a write
+                        continue
+                    if entry['step'] == 'intent':
+                        pending[entry['path']] = PlannedMove(entry['old'], entry['new'], entry['folder'], entry['path'], None,
+                                                             entry.get('date'))
+                    else:
+                        pending.pop(entry['path'], None)
+        except FileNotFoundError:
+            pass
+        return list(pending.values())
+
+    def write(self, entries, sync=False):
+        """
+        Append records to the journal.
+
+        :param entries: List of JSON-serializable records.
+        :param sync: fsync the journal before returning.
+        """
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+                if self.file.tell():
+                    # Start on a fresh line in case the last record was torn
+                    self.file.write('\n')
+            self.file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def begin(self, operations):
+        """
+        Record the intent of a batch of moves, durably, in one write.
+
+        :param operations: List of PlannedMove entries about to be run.
+        """
+        self.write([{'step': 'intent', 'old': operation.old_name, 'new': operation.new_name,
+                     'folder': operation.destination_folder, 'path': operation.destination_path,
+                     'date': operation.report_date}
+                    for operation in operations], sync=True)
+
+    def record(self, operation, result):
+        """
+        Record that a move finished, successfully or not.
+
+        :param operation: The PlannedMove.
+        :param result: Its result dictionary.
+        """
+        if 'error' in result:
+            self.write([{'step': 'failed', 'path': operation.destination_path, 'error': result['error']}])
+        else:
+            self.write([{'step': 'done', 'path': operation.destination_path}])
+
+    def close(self):
+        """
+        Flush the journal to disk, and remove it if every recorded move has completed.
+        """
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+        if not self.pending():
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def zstd_frame_compressor():
+    """
+    :return: (compress, finish) callables producing one complete zstd frame from the data passed to
+             compress, ended by finish.
+    :raises RuntimeError: If neither compression.zstd nor the zstandard package is available.
+    """
+    if zstd is not None:
+        compressor = zstd.ZstdCompressor()
+        return compressor.compress, lambda: compressor.flush(zstd.ZstdCompressor.FLUSH_FRAME)
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor().compressobj()
+        return compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+    raise RuntimeError('tar.zst bundles need Python 3.14 or the zstandard package')
+
+
+def zstd_frame_decompressor():
+    """
+    :return: A callable decompressing the chunks of a single zstd frame.
+    """
+    if zstd is not None:
+        return zstd.ZstdDecompressor().decompress
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    raise RuntimeError('tar.zst bundles need Python 3.14 or the zstandard package')
+
+
+def read_bundle_member(path, name):
+    """
+    Read one member of an archive bundle, seeking straight to it through the bundle's index.
+
+    :param path: Path of a .zip or .tar.zst bundle.
+    :param name: Member name, relative to the bundle's folder with '/' separators.
+    :return: Generator of the member's data, in chunks.
+    """
+    if path.endswith('.zip'):
+        recover_zip(path)
+        with zipfile.ZipFile(path) as bundle, bundle.open(name) as member:
+            while chunk := member.read(COPY_CHUNK_SIZE):
+                yield chunk
+        return
+    offset, length, size, header_length = tar_zst_index(path)[name]
+    decompress = zstd_frame_decompressor()
+    skip, remaining = header_length, size
+    with open(path, 'rb') as bundle:
+        bundle.seek(offset)
+        while length > 0 and remaining > 0:
+            compressed = bundle.read(min(COPY_CHUNK_SIZE, length))
+            length -= len(compressed)
+            data = decompress(compressed)
+            # Drop the tar header, then stop at the end of the member's data
+            dropped = min(skip, len(data))
+            skip -= dropped
+            data = data[dropped:remaining + dropped]
+            remaining -= len(data)
+            if data:
+                yield data
+
+
+class ArchiveBundler:
+    def __init__(self, base_directory, archive_format='zip', keep_days=None, catalog=None):
+        """
+        Writes the files of each routed batch into one bundle per destination subtree and report day,
+        e.g. FINANCE/2024/JUNE/FINANCE_2024-06-14.zip holding P&L/006/..., BALANCE SHEET/001/...
+        Files are streamed into the bundle in COPY_CHUNK_SIZE chunks, so memory use does not depend on
+        their size. A zip bundle's central directory is its index; a tar.zst bundle has one zstd frame
+        per member and a JSON index of the frames in a skippable frame at its end.
+
+        :param base_directory: Base destination directory the routes are relative to.
+        :param archive_format: 'zip' or 'tar.zst'.
+        :param keep_days: Keep loose copies of the bundled files for this many days after their report
+                          date, then delete them. None keeps them for good.
+        :param catalog: ReportCatalog whose rows of pruned files are pointed at their bundles, if any.
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError(f'Unknown archive format {archive_format!r}')
+        if archive_format == 'tar.zst':
+            zstd_frame_compressor()
+        self.base_directory = base_directory
+        self.archive_format = archive_format
+        self.keep_days = keep_days
+        self.catalog = catalog
+        self.ledger_path = os.path.join(base_directory, ARCHIVE_LEDGER_NAME)
+
+    def bundle_path(self, destination_folder, report_date):
+        """
+        Work out the bundle a file filed in a destination folder belongs to. Its subtree is the
+        YEAR/MONTH folder of the file's route, or the destination folder itself for undated routes.
+
+        :param destination_folder: Folder the file was moved to.
+        :param report_date: The file's report date, in REPORT_DATE_FORMAT.
+        :return: (bundle path, subtree folder), or None if the file is outside the base directory.
+        """
+        relative = os.path.relpath(destination_folder, self.base_directory)
+        parts = relative.split(os.sep)
+        if parts[0] in (os.pardir, os.curdir):
+            return None
+        year, month = date_path(report_date)
+        subtree_parts = parts
+        for position in range(1, len(parts) - 1):
+            if parts[position] == year and parts[position + 1] == month:
+                subtree_parts = parts[:position + 2]
+                break
+        day = datetime.strptime(report_date, REPORT_DATE_FORMAT).date().isoformat()
+        subtree = os.path.join(self.base_directory, *subtree_parts)
+        return os.path.join(subtree, f'{parts[0]}_{day}.{self.archive_format}'), subtree
+
+    def add(self, operations, results):
+        """
+        Add the files of a finished batch to their bundles, and prune loose copies that have left the
+        keep window.
+
+        :param operations: The batch's PlannedMove entries.
+        :param results: Their result dictionaries, in the same order.
+        :return: List of the bundles written.
+        """
+        bundles = {}
+        for operation, result in zip(operations, results):
+            if 'moved_to' not in result or not operation.report_date:
+                continue
+            located = self.bundle_path(operation.destination_folder, operation.report_date)
+            if located is None:
+                continue
+            bundle, subtree = located
+            member = os.path.relpath(result['moved_to'], subtree).replace(os.sep, '/')
+            bundles.setdefault(bundle, {})[member] = result['moved_to']
+
+        written = []
+        for bundle, members in bundles.items():
+            try:
+                with metrics.timed('archive'):
+                    if self.archive_format == 'zip':
+                        self.write_zip(bundle, members)
+                    else:
+                        self.write_tar_zst(bundle, members)
+                written.append(bundle)
+                logger.info('Archived %d file(s) in %s', len(members), bundle)
+            except Exception as e:
+                logger.error('Archiving %d file(s) in %s failed: %s', len(members), bundle, e)
+        if written:
+            self.update_ledger(written)
+        if self.keep_days is not None:
+            self.prune()
+        return written
+
+    def write_zip(self, bundle, members):
+        """
+        Write files into a zip bundle. New members are appended in place, so adding a batch costs the
+        size of the batch rather than of the whole bundle (see append_zip). Only when members of the
+        same name are replaced is the bundle rebuilt, in a temporary file renamed into place, so a crash
+        never leaves it half written.
+
+        :param bundle: Path of the bundle.
+        :param members: Dictionary of member name -> path of the file.
+        """
+        recover_zip(bundle)
+        if os.path.exists(bundle):
+            with zipfile.ZipFile(bundle) as existing:
+                replaced = any(name in members for name in existing.namelist())
+            if not replaced:
+                self.append_zip(bundle, members)
+                return
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(bundle), prefix='.' + os.path.basename(bundle) + '.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as output, zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+                if os.path.exists(bundle):
+                    with zipfile.ZipFile(bundle) as existing:
+                        for info in existing.infolist():
+                            if info.filename not in members:
+                                copy = zipfile.ZipInfo(info.filename, info.date_time)
+                                copy.compress_type = zipfile.ZIP_DEFLATED
+                                with existing.open(info) as source, archive.open(copy, 'w', force_zip64=True) as target:
+                                    shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+                self.zip_files(archive, members)
+                archive.close()
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temp_path, bundle)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def append_zip(self, bundle, members):
+        """
+        Append new members to an existing zip bundle. They are written over its central directory,
+        which is rewritten after them, so the central directory and its offset are saved in a journal
+        beside the bundle first; if the append is interrupted, recover_zip puts them back.
+
+        :param bundle: Path of the bundle.
+        :param members: Dictionary of member name -> path of the file, none of them in the bundle yet.
+        """
+        folder = os.path.dirname(bundle)
+        journal_path = zip_journal_path(bundle)
+        with open(bundle, 'r+b') as output:
+            with zipfile.ZipFile(output) as existing:
+                offset = existing.start_dir
+            output.seek(offset)
+            saved = output.read()
+            fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(bundle) + '.', suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as journal:
+                    journal.write(struct.pack('<Q', offset) + saved)
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                os.replace(temp_path, journal_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            fsync_directory(folder)
+
+            output.seek(0)
+            with zipfile.ZipFile(output, 'a', zipfile.ZIP_DEFLATED) as archive:
+                self.zip_files(archive, members)
+            output.flush()
+            os.fsync(output.fileno())
+        os.unlink(journal_path)
+
+    @staticmethod
+    def zip_files(archive, members):
+        """
+        Stream files into an open zip archive as new members.
+
+        :param archive: zipfile.ZipFile open for writing or appending.
+        :param members: Dictionary of member name -> path of the file.
+        """
+        for member, path in members.items():
+            info = zipfile.ZipInfo.from_file(path, member)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as source, archive.open(info, 'w', force_zip64=True) as target:
+                while chunk := source.read(COPY_CHUNK_SIZE):
+                    target.write(chunk)
+                    metrics.add_bytes('archive', len(chunk))
+
+    def write_tar_zst(self, bundle, members):
+        """
+        Write files into a tar.zst bundle, replacing members of the same name. Each member (tar header,
+        data and padding) is its own zstd frame, so the frames of existing members are copied over
+        without recompressing them, and a member can be read by decompressing its frame alone. The
+        frames are followed by the tar end-of-archive blocks, the index and a fixed-size footer giving
+        the index's offset; `zstd -dc bundle | tar x` still extracts the whole bundle.
+
+        :param bundle: Path of the bundle.
+        :param members: Dictionary of member name -> path of the file.
+        """
+        index = {}
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(bundle), prefix='.' + os.path.basename(bundle) + '.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                if os.path.exists(bundle):
+                    with open(bundle, 'rb') as existing:
+                        for member, (offset, length, size, header_length) in tar_zst_index(bundle).items():
+                            if member in members:
+                                continue
+                            index[member] = [output.tell(), length, size, header_length]
+                            existing.seek(offset)
+                            while length > 0:
+                                chunk = existing.read(min(COPY_CHUNK_SIZE, length))
+                                output.write(chunk)
+                                length -= len(chunk)
+                for member, path in members.items():
+                    start = output.tell()
+                    compress, finish = zstd_frame_compressor()
+                    stat = os.stat(path)
+                    info = tarfile.TarInfo(member)
+                    info.size = stat.st_size
+                    info.mtime = int(stat.st_mtime)
+                    info.mode = 0o644
+                    header = info.tobuf(tarfile.PAX_FORMAT)
+                    output.write(compress(header))
+                    with open(path, 'rb') as source:
+                        while chunk := source.read(COPY_CHUNK_SIZE):
+                            output.write(compress(chunk))
+                            metrics.add_bytes('archive', len(chunk))
+                    output.write(compress(b'\0' * (-stat.st_size % tarfile.BLOCKSIZE)))
+                    output.write(finish())
+                    index[member] = [start, output.tell() - start, stat.st_size, len(header)]
+                compress, finish = zstd_frame_compressor()
+                output.write(compress(b'\0' * (2 * tarfile.BLOCKSIZE)))
+                output.write(finish())
+                index_offset = output.tell()
+                payload = json.dumps({'members': index}).encode()
+                output.write(struct.pack('<II', ZSTD_INDEX_MAGIC, len(payload)) + payload)
+                output.write(ZSTD_FOOTER.pack(ZSTD_FOOTER_MAGIC, 8, index_offset))
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temp_path, bundle)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def read_ledger(self):
+        """
+        :return: Dictionary of bundle path (relative to the base directory) -> {'day', 'pruned'}.
+        """
+        try:
+            with open(self.ledger_path, encoding='utf-8') as ledger_file:
+                return json.load(ledger_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_ledger(self, ledger):
+        fd, temp_path = tempfile.mkstemp(dir=self.base_directory, prefix=ARCHIVE_LEDGER_NAME + '.', suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as ledger_file:
+            json.dump(ledger, ledger_file, indent=1)
+        os.replace(temp_path, self.ledger_path)
+
+    def update_ledger(self, bundles):
+        """
+        Record bundles just written; their loose files become candidates for pruning again.
+
+        :param bundles: Paths of the bundles.
+        """
+        ledger = self.read_ledger()
+        for bundle in bundles:
+            day = os.path.basename(bundle)[:-len(self.archive_format) - 1].rpartition('_')[2]
+            ledger[os.path.relpath(bundle, self.base_directory)] = {'day': day, 'pruned': False}
+        self.write_ledger(ledger)
+
+    def prune(self, today=None):
+        """
+        Delete the loose copies of bundled files whose report day is more than keep_days ago. A loose
+        file is only deleted while it still has the size of its bundled copy, so a report filed again
+        after it was bundled is kept until it is bundled too. The catalog rows of deleted files are
+        moved to their bundle and member name.
+
+        :param today: Date the window is counted back from (default: today).
+        :return: Number of loose files deleted.
+        """
+        cutoff = ((today or date.today()) - timedelta(days=self.keep_days)).isoformat()
+        ledger = self.read_ledger()
+        deleted = []
+        changed = False
+        for relative, entry in ledger.items():
+            if entry['pruned'] or entry['day'] >= cutoff:
+                continue
+            bundle = os.path.join(self.base_directory, relative)
+            subtree = os.path.dirname(bundle)
+            try:
+                members = bundle_members(bundle)
+            except (OSError, ValueError, zipfile.BadZipFile) as e:
+                logger.warning('Not pruning the files of %s: %s', bundle, e)
+                continue
+            for member, size in members.items():
+                loose = os.path.join(subtree, *member.split('/'))
+                try:
+                    if os.path.getsize(loose) == size:
+                        os.unlink(loose)
+                        deleted.append((loose, bundle, member))
+                except FileNotFoundError:
+                    pass
+            entry['pruned'] = True
+            changed = True
+        if changed:
+            self.write_ledger(ledger)
+        if deleted:
+            logger.info('Pruned %d loose file(s) older than %d day(s) that are kept in bundles', len(deleted), self.keep_days)
+            if self.catalog is not None:
+                try:
+                    self.catalog.archive(deleted)
+                except sqlite3.Error as e:
+                    logger.error('Moving %d pruned file(s) to their bundles in the catalog %s failed: %s',
+                                 len(deleted), self.catalog.path, e)
+        return len(deleted)
+
+
+class InotifyWatcher:
+    # inotify_add_watch event flags (linux/inotify.h)
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    # Reported (with wd -1) when the kernel's event queue overflowed and events were dropped
+    IN_Q_OVERFLOW = 0x4000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        """
+        Watch a directory for new and rewritten files with Linux inotify, through libc.
+
+        :param directory: Directory to watch.
+        :raises OSError: If inotify is not available.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'Cannot watch {directory}')
+
+    def changes(self, timeout=None):
+        """
+        Wait for files to be created, written or moved into the directory.
+
+        :param timeout: Seconds to wait at most, or None to wait indefinitely.
+        :return: List of file names (empty on timeout), or None if the event queue overflowed and the
+                 directory must be listed again.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        overflowed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+            elif length:
+                names.append(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+            offset += length
+        return None if overflowed else names
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, directory, interval=1.0):
+        """
+        Portable fallback for InotifyWatcher: list the directory every `interval` seconds and report
+        files that appeared or changed size or mtime since the previous listing.
+
+        :param directory: Directory to watch.
+        :param interval: Seconds between listings.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.signatures = self.list_directory()
+        self.last_poll = time.monotonic()
+
+    def list_directory(self):
+        """
+        :return: Dictionary of file name -> (size, mtime_ns) for the files in the directory.
+        """
+        signatures = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        signatures[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # Removed while the directory was being listed
+                    pass
+        return signatures
+
+    def changes(self, timeout=None):
+        """
+        Wait until the next listing is due (or the timeout passes) and report what changed.
+
+        :param timeout: Seconds to wait at most, or None to wait for the next listing.
+        :return: List of file names (empty if the listing was not due yet).
+        """
+        due = self.last_poll + self.interval - time.monotonic()
+        if timeout is not None and timeout < due:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(due, 0))
+        signatures = self.list_directory()
+        self.last_poll = time.monotonic()
+        changed = [name for name, signature in signatures.items() if self.signatures.get(name) != signature]
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        """
+        Stop watching.
+        """
+
+
+def open_watcher(directory, poll_interval=1.0):
+    """
+    Watch a directory with inotify on Linux, falling back to polling elsewhere or if it fails.
+
+    :param directory: Directory to watch.
+    :param poll_interval: Seconds between listings when polling.
+    :return: InotifyWatcher or PollingWatcher.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directory)
+        except OSError:
+            pass
+    return PollingWatcher(directory, poll_interval)
+
+
+class Throttle:
+    def __init__(self, max_per_second=None):
+        """
+        Space out operation starts so the OneDrive/SMB sync client is not flooded.
+
+        :param max_per_second: Maximum number of operations started per second, or None for no limit.
+        """
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def wait(self):
+        """
+        Block until the caller is allowed to start its next operation.
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def default_destination_directory(username):
+    """
+    :param username: Windows account name.
+    :return: The account's OneDrive folder the reports are filed under.
+    """
+    return os.path.join('C:\\Users', username, 'OneDrive - iTrust Finance Limited', 'IMAAN CBS REPORTS')
+
+
+class FileRenamerMover(ReportRenamer):
+    def __init__(self, config, source_directory, additional_info, max_workers=4, max_files_per_second=None, journal=None,
+                 validate=True):
         """
         Initialize the FileRenamerMover with the necessary parameters.
         
-        :param file_mapping: A dictionary where keys are old file names and values are new file names (with placeholders for additional info).
+        :param config: ReportConfig holding the file mapping (old file names to new name templates with
+                       placeholders for additional info) and the routing rules.
         :param source_directory: Path to the directory containing the files.
         :param additional_info: Dictionary containing variables to be used in the new file names.
+        :param max_workers: Number of files renamed and moved concurrently. Use 1 to process files one at a time.
+        :param max_files_per_second: Optional limit on how many file moves are started per second.
+        :param journal: Optional OperationJournal recording each move so an interrupted batch can be resumed.
+        :param validate: Check that each file is a complete workbook (see validate_workbook) before moving it.
         """
-        self.file_mapping = file_mapping
         self.source_directory = source_directory
-        self.additional_info = additional_info
+        self.max_workers = max_workers
+        self.throttle = Throttle(max_files_per_second)
+        self.journal = journal
+        self.validate = validate
+        # Delete the older duplicates of the downloads that were filed; they are kept by default
+        self.remove_duplicates = False
+        # Optional ArchiveBundler that also writes each batch into per-day bundles
+        self.archive = None
+        # Optional ReportCatalog recording every filed report
+        self.catalog = None
+        # Optional VerifiedTransfer checking every copy before its source is deleted
+        self.verify = None
+        # Device numbers of destination folders, keyed by path
+        self.folder_devices = {}
         self.username = self.get_logged_in_username()
-        # self.base_destination_directory = os.path.join('C:\\Users', self.username, 'OneDrive - iTrust Finance Limited', 'itrust')
-        self.base_destination_directory = os.path.join('C:\\Users', self.username, 'OneDrive - iTrust Finance Limited', 'IMAAN CBS REPORTS')
         # C:\Users\erick.makilagi\OneDrive - iTrust Finance Limited\IMAAN CBS REPORTS
-        self.finance_folder = os.path.join(self.base_destination_directory, 'FINANCE')
-        self.credit_folder = os.path.join(self.base_destination_directory, 'CREDIT')
-        self.investment_folder = os.path.join(self.base_destination_directory, 'INVESTMENT')
+        super().__init__(config, additional_info, default_destination_directory(self.username))
 
     def get_logged_in_username(self):
         """
-        Get the username of the currently logged-in user on Windows.
+        Get the username of the currently logged-in user on Windows. getpass reads it from the
+        environment or the account database, so unlike os.getlogin it also works without a console
+        (e.g. as a scheduled task).
 
         :return: Username of the logged-in user.
         """
-        return os.getlogin()
+        return getpass.getuser()
 
-    def determine_destination_folder(self, new_name):
+    def index_source_directory(self):
         """
-        Determine the destination folder based on the new file name.
-        
-        :param new_name: The new name of the file.
-        :return: The path to the destination folder.
-        """
-        if new_name.startswith('P&L_CONSOLIDATED_'):
-            suffix = new_name.split('_')[2]
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'P&L', suffix)
-        elif new_name.startswith('SKUK_Report_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'SUKUK')
-        elif new_name.startswith('Daily Investment Report_'):
-            return os.path.join(self.investment_folder, '2024', 'JUNE')
-        elif new_name.startswith('FUND CUSTOMER BALANCE_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'FUND CUSTOMER BALANCE')
-        elif new_name.startswith('Data Entry Report_'):
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'DATA ENTRY')
-        elif new_name.startswith('Balancesheet_consolidated_'):
-            suffix = new_name.split('_')[2]
-            return os.path.join(self.finance_folder, '2024', 'JUNE', 'BALANCE SHEET', suffix)
-        elif new_name.startswith('CUSTOMER BALANCE_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'CUSTOMER BALANCE')
-        elif new_name.startswith('Bot_Loan_status_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'BOT LOAN STATUS')
-        elif new_name.startswith('Loan Report Swalha_'):
-            return os.path.join(self.credit_folder, '2024', 'JUNE', 'BOT LOAN STATUS')
-        else:
-            return os.path.join(self.base_destination_directory)
+        List the source directory once and index the files in it by name.
 
-    def rename_and_move_files(self):
+        :return: Dictionary mapping file names to their os.DirEntry.
         """
-        Rename specific .xlsx files based on a given mapping and move them to a specified folder if they exist in the directory.
+        with metrics.timed('scan'), os.scandir(self.source_directory) as entries:
+            return {entry.name: entry for entry in entries if entry.is_file()}
+
+    def collect_jobs(self, single_scan=True):
         """
-        # Iterate over the mapping dictionary
-        for old_name, new_name_template in self.file_mapping.items():
-            # Construct full file paths
-            old_file = os.path.join(self.source_directory, old_name)
-            # Format the new file name with additional info
-            new_name = new_name_template.format(**self.additional_info)
-            new_file = os.path.join(self.source_directory, new_name)
-            
-            # Check if the old file exists
+        Find the files to process and work out their new names.
+
+        :param single_scan: List the source directory once and match every name in it against the exact
+                            names and patterns of the mapping. When several files would get the same new
+                            name, the newest one wins. Otherwise only exact names are checked, each with
+                            its own os.path.exists call.
+        :return: Tuple of (jobs, missing, unmatched, superseded): jobs is a list of (old_name, new_name,
+                 report_date) tuples in mapping order, missing lists the mapped file names no file matched, unmatched lists the
+                 spreadsheets no rule matched and superseded maps the older duplicates that were skipped to
+                 the file chosen in their place.
+        """
+        if not single_scan:
+            jobs = []
+            missing = []
+            for old_name in self.file_mapping:
+                if os.path.exists(os.path.join(self.source_directory, old_name)):
+                    jobs.append((old_name, self.render_name(old_name), self.additional_info.get('RPTDATE')))
+                else:
+                    missing.append(old_name)
+            return jobs, missing, [], {}
+
+        source_index = self.index_source_directory()
+        # Best candidate per new name, as (rule index, file name, DirEntry, report date)
+        chosen = {}
+        matched_rules = set()
+        unmatched = []
+        # (file name, new name) of the older duplicates
+        superseded = []
+        for name, entry in source_index.items():
+            match = self.match_source(name)
+            if match is None:
+                if name.lower().endswith(REPORT_EXTENSIONS):
+                    unmatched.append(name)
+                continue
+            index, new_name, report_date = match
+            matched_rules.add(index)
+            current = chosen.get(new_name)
+            if current is None:
+                chosen[new_name] = (index, name, entry, report_date)
+            elif (entry.stat().st_mtime, name) > (current[2].stat().st_mtime, current[1]):
+                superseded.append((current[1], new_name))
+                chosen[new_name] = (index, name, entry, report_date)
+            else:
+                superseded.append((name, new_name))
+
+        jobs = [(name, new_name, report_date) for new_name, (index, name, entry, report_date) in sorted(chosen.items(), key=lambda item: item[1][:2])]
+        rules = self.config.source_matcher.rules
+        missing = [rule.filename for index, rule in enumerate(rules) if rule.filename is not None and index not in matched_rules]
+        return jobs, missing, sorted(unmatched), {name: chosen[new_name][1] for name, new_name in sorted(superseded)}
+
+    def list_destination(self, folder):
+        """
+        List the file names already in a destination folder, case-folded because OneDrive and Windows
+        paths are case-insensitive.
+
+        :param folder: Destination folder.
+        :return: Set of case-folded file names, or None if the folder does not exist.
+        """
+        try:
+            with metrics.timed('list'), os.scandir(folder) as entries:
+                return {entry.name.casefold() for entry in entries}
+        except FileNotFoundError:
+            return None
+
+    def plan(self, single_scan=True):
+        """
+        Work out every (source, new name, destination) operation of the batch in memory, checking for
+        collisions within the batch and for overwrites against one listing of each destination folder.
+
+        :param single_scan: See collect_jobs.
+        :return: A BatchPlan.
+        """
+        return self.plan_jobs(*self.collect_jobs(single_scan))
+
+    def plan_names(self, names):
+        """
+        Plan the moves of specific files in the source directory, without scanning it.
+
+        :param names: File names in the source directory.
+        :return: A BatchPlan; names no rule matches are listed as unmatched. Names whose new name
+                 cannot be worked out, e.g. from a malformed date, are logged and left out.
+        """
+        jobs = []
+        unmatched = []
+        for name in names:
+            try:
+                match = self.match_source(name)
+            except ValueError as e:
+                logger.error('Cannot file %s: %s', os.path.join(self.source_directory, name), e)
+                continue
+            if match is None:
+                unmatched.append(name)
+            else:
+                jobs.append((name, match[1], match[2]))
+        return self.plan_jobs(jobs, [], unmatched, {})
+
+    def plan_manifest(self, groups):
+        """
+        Plan one batch spanning several report dates, from the date groups of a manifest. The source
+        directory is listed once for all groups.
+
+        :param groups: List of {'name': ..., 'rptdate': ..., 'sysdate': ..., 'files': [...]} dictionaries.
+                       'files' are names in the source directory; a group without a name is named by
+                       its position and sysdate defaults to rptdate.
+        :return: Tuple of (BatchPlan, dictionary of file name -> group name).
+        :raises ValueError: If a file is listed in more than one group.
+        """
+        source_index = self.index_source_directory()
+        jobs = []
+        missing = []
+        unmatched = []
+        group_of = {}
+        for number, group in enumerate(groups):
+            rpt_date = normalize_report_date(group['rptdate'])
+            additional_info = dict(self.additional_info, RPTDATE=rpt_date,
+                                   SYSDATE=normalize_report_date(group.get('sysdate') or rpt_date))
+            for name in group.get('files', ()):
+                if name in group_of:
+                    raise ValueError(f'{name} is listed in more than one manifest group')
+                group_of[name] = str(group.get('name', number))
+                if name not in source_index:
+                    missing.append(name)
+                elif (match := self.match_source(name, additional_info)) is None:
+                    unmatched.append(name)
+                else:
+                    jobs.append((name, match[1], match[2]))
+        return self.plan_jobs(jobs, missing, unmatched, {}), group_of
+
+    def process_manifest(self, groups, dry_run=False, overwrite=True):
+        """
+        Rename and move the files of a manifest (see plan_manifest) and print one JSON result per file
+        (NDJSON), tagged with its group.
+
+        :param groups: The manifest's date groups.
+        :param dry_run: Only print the plan; do not move anything.
+        :param overwrite: Replace files that already exist at the destination.
+        :return: List of per-file result dictionaries.
+        """
+        plan, group_of = self.plan_manifest(groups)
+        if dry_run:
+            plan.print_plan(self.source_directory, self.remove_duplicates)
+            return []
+        results = [{'old': os.path.join(self.source_directory, name), 'error': 'File not found'} for name in plan.missing]
+        results += [{'old': os.path.join(self.source_directory, name), 'error': 'File not found in mapping'} for name in plan.unmatched]
+        results += self.execute_plan(plan, overwrite)
+        for result in results:
+            result['group'] = group_of[os.path.basename(result['old'])]
+            print(json.dumps(result), flush=True)
+        return results
+
+    def plan_jobs(self, jobs, missing, unmatched, superseded):
+        """
+        Build the BatchPlan for a list of (old name, new name, report date) jobs. See plan.
+
+        :return: A BatchPlan.
+        """
+        folders = self.route_many([new_name for _, new_name, _ in jobs], [report_date for _, _, report_date in jobs])
+        listings = {}
+        claimed = set()
+        operations = []
+        for (old_name, new_name, report_date), folder in zip(jobs, folders):
+            if folder not in listings:
+                listings[folder] = self.list_destination(folder)
+                if listings[folder] is not None:
+                    directory_cache.add(folder)
+            destination_path = os.path.join(folder, new_name)
+            key = destination_path.casefold()
+            if key in claimed:
+                conflict = 'collision'
+            else:
+                claimed.add(key)
+                listing = listings[folder]
+                conflict = 'overwrite' if listing is not None and new_name.casefold() in listing else None
+            operations.append(PlannedMove(old_name, new_name, folder, destination_path, conflict, report_date))
+        new_folders = sorted(folder for folder, listing in listings.items() if listing is None)
+        return BatchPlan(operations, new_folders, missing, unmatched, superseded)
+
+    def execute_plan(self, plan, overwrite=True):
+        """
+        Carry out a BatchPlan: create each missing destination folder once, then move the files. With
+        remove_duplicates, the older duplicates of each file that was moved are then deleted; otherwise
+        they stay in the source directory, reported as skipped.
+
+        :param plan: The BatchPlan to run.
+        :param overwrite: Replace files that already exist at the destination. Collisions within the
+                          batch are always skipped.
+        :return: List of per-file result dictionaries, in plan order.
+        """
+        for folder in plan.new_folders:
+            try:
+                directory_cache.ensure(folder)
+            except OSError:
+                # The moves into this folder fail and report the error
+                pass
+
+        results = [None] * len(plan.operations)
+        runnable = []
+        for index, operation in enumerate(plan.operations):
+            if operation.conflict == 'collision':
+                error = f'Skipped: another file in this batch is also moved to {operation.destination_path}'
+            elif operation.conflict == 'overwrite' and not overwrite:
+                error = f'Skipped: {operation.destination_path} already exists'
+            else:
+                runnable.append((index, operation))
+                continue
+            results[index] = {'old': os.path.join(self.source_directory, operation.old_name), 'new': operation.new_name, 'error': error}
+
+        operations = [operation for _, operation in runnable]
+        if self.journal is not None:
+            self.journal.begin(operations)
+        try:
+            for (index, _), result in zip(runnable, self.execute(operations)):
+                results[index] = result
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+        if plan.superseded and self.remove_duplicates:
+            self.remove_superseded(plan.superseded, results)
+        return results
+
+    def remove_superseded(self, superseded, results):
+        """
+        Delete the older duplicates of the downloads that were filed. Duplicates of a download that
+        failed to move are kept.
+
+        :param superseded: Dictionary of older duplicate file names to the file names filed instead.
+        :param results: Per-file result dictionaries of the batch.
+        """
+        moved = {os.path.basename(result['old']) for result in results if 'moved_to' in result}
+        for old_name, winner in superseded.items():
+            if winner not in moved:
+                continue
+            path = os.path.join(self.source_directory, old_name)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning('Cannot remove the older duplicate %s: %s', path, e)
+            else:
+                logger.info('Removed older duplicate: %s', path)
+
+    def resume(self):
+        """
+        Finish the moves an interrupted run left open in the journal, without rescanning the source
+        directory. Leftover partial copies are removed; a move whose source is still there is run
+        again, and one whose source is gone but whose destination exists is recorded as completed.
+
+        :return: List of per-file result dictionaries, in journal order.
+        """
+        pending = self.journal.pending()
+        results = [None] * len(pending)
+        replay = []
+        for index, operation in enumerate(pending):
+            remove_partial_copies(operation.destination_path)
+            old_file = os.path.join(self.source_directory, operation.old_name)
             if os.path.exists(old_file):
+                if os.path.exists(operation.destination_path):
+                    # Possibly copied but not yet removed; an unchanged destination is not copied again
+                    operation = operation._replace(conflict='overwrite')
+                replay.append((index, operation))
+                continue
+            result = {'old': old_file, 'new': operation.new_name}
+            if os.path.exists(operation.destination_path):
+                # The move finished but the run died before recording it
+                result.update(moved_to=operation.destination_path, strategy='completed',
+                              bytes=os.path.getsize(operation.destination_path))
+            else:
+                result['error'] = 'Neither the source nor the destination exists any more'
+            self.journal.record(operation, result)
+            results[index] = result
+
+        try:
+            for (index, _), result in zip(replay, self.execute([operation for _, operation in replay])):
+                results[index] = result
+        finally:
+            self.journal.close()
+        self.print_results(results)
+        return results
+
+    def rename_and_move_files(self, single_scan=True, dry_run=False, overwrite=True):
+        """
+        Rename specific .xlsx files based on a given mapping and move them to a specified folder if they exist in the directory.
+
+        :param single_scan: List the source directory once and match the files in it against the mapping's
+                            exact names and patterns, instead of checking every mapping entry with its own
+                            os.path.exists call. Spreadsheets on disk that no rule matches are reported as
+                            unmatched.
+        :param dry_run: Only print the plan; do not move anything.
+        :param overwrite: Replace files that already exist at the destination.
+        :return: List of per-file result dictionaries, in mapping order (empty for a dry run).
+        """
+        plan = self.plan(single_scan)
+        for old_name in plan.missing:
+            logger.warning('File not found: %s', os.path.join(self.source_directory, old_name))
+        for old_name, winner in plan.superseded.items():
+            logger.info('Skipped older duplicate: %s (%s is newer)', os.path.join(self.source_directory, old_name), winner)
+
+        if dry_run:
+            plan.print_plan(self.source_directory, self.remove_duplicates)
+            results = []
+        else:
+            results = self.execute_plan(plan, overwrite)
+        self.print_results(results)
+
+        # Report spreadsheets in the source directory that no mapping entry claimed
+        for name in plan.unmatched:
+            logger.warning('Unmatched file: %s', os.path.join(self.source_directory, name))
+
+        return results
+
+    def watch(self, watcher, settle=0.5, overwrite=True, current_date_fields=()):
+        """
+        Run as a daemon: file each report as soon as it has finished downloading into the source
+        directory, until interrupted. Files already there are handled first. Partial downloads
+        (PARTIAL_DOWNLOAD_SUFFIXES), empty files and files with a partial download beside them (the
+        placeholders browsers create) are ignored, and a file is only moved once its size and mtime
+        have stayed the same for `settle` seconds, and still are just before it is filed, so files
+        still being written are left alone. Errors are logged and watching goes on; if the watcher
+        lost events, the directory is listed again. A file that cannot be filed, e.g. because it is
+        not a valid workbook, is reported on its own and the others are still filed.
+
+        :param watcher: InotifyWatcher or PollingWatcher on the source directory.
+        :param settle: Seconds a file must stay unchanged before it is moved.
+        :param overwrite: Replace files that already exist at the destination.
+        :param current_date_fields: Fields of additional_info (RPTDATE, SYSDATE) set to the current
+                                    date before each batch, for dates that were not given, so a
+                                    daemon running past midnight files the next day's reports
+                                    under that day.
+        """
+        # Name -> ((size, mtime_ns), monotonic time that signature was first seen); None until stat'ed
+        pending = dict.fromkeys(self.index_source_directory())
+        while True:
+            try:
+                names = watcher.changes(settle / 2 if pending else None)
+                if names is None:
+                    logger.warning('Events were lost, listing %s again', self.source_directory)
+                    names = self.index_source_directory()
+            except OSError as e:
+                logger.error('Watching %s failed: %s', self.source_directory, e)
+                time.sleep(max(settle, 1))
+                continue
+            for name in names:
+                pending[name] = None
+            now = time.monotonic()
+            ready = []
+            for name, seen in list(pending.items()):
+                signature = self.download_signature(name)
+                if signature is None:
+                    del pending[name]
+                elif seen is None or seen[0] != signature:
+                    pending[name] = (signature, now)
+                elif now - seen[1] >= settle:
+                    ready.append((name, signature))
+                    del pending[name]
+            # A last look just before filing: files written to meanwhile go back to waiting
+            stable = []
+            for name, signature in ready:
+                current = self.download_signature(name)
+                if current == signature:
+                    stable.append(name)
+                elif current is not None:
+                    pending[name] = (current, time.monotonic())
+            if stable:
+                if current_date_fields:
+                    today = datetime.now().strftime(REPORT_DATE_FORMAT)
+                    self.additional_info = dict(self.additional_info, **dict.fromkeys(current_date_fields, today))
                 try:
-                    # Rename the file
-                    os.rename(old_file, new_file)
-                    print(f'Renamed: {old_file} -> {new_file}')
-                    
-                    # Determine the destination folder
-                    destination_folder = self.determine_destination_folder(new_name)
-                    # Construct the full destination path
-                    destination_path = os.path.join(destination_folder, new_name)
-                    
-                    # Create the destination directory if it doesn't exist
-                    if not os.path.exists(destination_folder):
-                        os.makedirs(destination_folder)
-                    
-                    # Move the file to the destination folder
-                    shutil.move(new_file, destination_path)
-                    print(f'Moved: {new_file} -> {destination_path}')
-                except Exception as e:
-                    print(f'Error renaming or moving {old_file} to {new_file}: {e}')
+                    plan = self.plan_names(sorted(stable))
+                    self.print_results(self.execute_plan(plan, overwrite))
+                except (OSError, ValueError) as e:
+                    # ValueError includes the WorkbookError of a file that is not a valid workbook
+                    for name in sorted(stable):
+                        logger.error('Filing %s failed: %s', os.path.join(self.source_directory, name), e)
+                    continue
+                for name in plan.unmatched:
+                    logger.warning('Unmatched file: %s', os.path.join(self.source_directory, name))
+
+    def download_signature(self, name):
+        """
+        Check whether a file in the source directory looks like a finished report download.
+
+        :param name: File name.
+        :return: The file's (size, mtime_ns), or None if it is not a report, is a partial download or
+                 an empty placeholder, has a partial download beside it, or cannot be read.
+        """
+        if name.startswith('.') or name.endswith(PARTIAL_DOWNLOAD_SUFFIXES) or not name.lower().endswith(REPORT_EXTENSIONS):
+            return None
+        path = os.path.join(self.source_directory, name)
+        try:
+            stat = os.stat(path)
+            if stat.st_size == 0 or any(os.path.exists(path + suffix) for suffix in PARTIAL_DOWNLOAD_SUFFIXES):
+                return None
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning('Cannot check %s: %s', path, e)
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def print_results(self, results):
+        """
+        Log the outcome of each move.
+
+        :param results: List of per-file result dictionaries.
+        """
+        for result in results:
+            if 'error' in result:
+                logger.error('Error renaming or moving %s to %s: %s', result['old'], result['new'], result['error'])
+            else:
+                logger.info('Moved: %s -> %s (%s, %d bytes)', result['old'], result['moved_to'], result['strategy'], result['bytes'])
+
+    def execute(self, operations):
+        """
+        Run the move pipeline for a batch of planned moves on a bounded thread pool, then record the
+        moved files in the catalog and add them to their archive bundles, if those are on.
+
+        :param operations: List of PlannedMove entries whose destination folders exist.
+        :return: List of per-file result dictionaries, in the same order as the operations.
+        """
+        try:
+            if self.max_workers <= 1 or len(operations) <= 1:
+                results = [self.move_file(operation) for operation in operations]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(operations))) as executor:
+                    results = list(executor.map(self.move_file, operations))
+        finally:
+            save_content_indexes()
+        if self.catalog is not None:
+            self.record_in_catalog(operations, results)
+        if self.archive is not None:
+            self.archive.add(operations, results)
+        return results
+
+    def record_in_catalog(self, operations, results):
+        """
+        Add the files a batch filed to the catalog. A catalog failure is logged; it does not fail the
+        moves, and `catalog rebuild` restores the missing rows.
+
+        :param operations: The batch's PlannedMove entries.
+        :param results: Their result dictionaries, in the same order.
+        """
+        try:
+            entries = []
+            for operation, result in zip(operations, results):
+                if 'moved_to' in result:
+                    stat = os.stat(result['moved_to'])
+                    # Hashed by move_file, or looked up in the content index for unchanged files
+                    digest = result.get('digest') or content_index(operation.destination_folder).digest(
+                        operation.new_name, result['moved_to'], stat)
+                    entries.append(ReportCatalog.entry(self.router, result['moved_to'], stat, digest, operation.report_date))
+            self.catalog.record(entries)
+        except (OSError, sqlite3.Error) as e:
+            logger.error('Recording the batch in the catalog %s failed: %s', self.catalog.path, e)
+
+    def move_file(self, operation):
+        """
+        Move a single file from the source directory straight to its final path under the new name.
+
+        Files on the same volume as their destination are moved with one atomic os.replace. Otherwise
+        the data is copied in large chunks into a temporary file beside the destination, fsynced and
+        renamed into place before the source is removed.
+
+        When the destination already exists with the same content (same size, then same BLAKE2b hash
+        via the folder's ContentIndex), nothing is written and the source is simply removed. A
+        destination modified more recently than the source is never overwritten; the source is kept.
+
+        With validation on, a file that is not a complete workbook is left where it is and reported
+        as an error before anything is written.
+
+        :param operation: PlannedMove giving the file's current name, new name and destination.
+        :return: Dictionary with the old path and new name plus either 'moved_to', 'strategy' and
+                 'bytes' (and 'digest' when the content was hashed), or 'error'.
+        """
+        old_file = os.path.join(self.source_directory, operation.old_name)
+        destination_folder = operation.destination_folder
+        destination_path = operation.destination_path
+        result = {'old': old_file, 'new': operation.new_name}
+        self.throttle.wait()
+        try:
+            if self.validate:
+                validate_workbook(old_file, operation.old_name, self.config.sheets_for(operation.new_name))
+            source_stat = os.stat(old_file)
+            if operation.conflict == 'overwrite' and self.is_unchanged(old_file, source_stat, operation):
+                os.unlink(old_file)
+                strategy, moved_bytes = 'unchanged', 0
+            elif operation.conflict == 'overwrite' and self.is_newer_at_destination(source_stat, operation):
+                raise FileExistsError(f'{destination_path} is newer than {old_file}; not overwritten')
             else:
-                print(f'File not found: {old_file}')
+                strategy, moved_bytes, digest = directory_cache.run_in(
+                    destination_folder, self.transfer, old_file, source_stat, destination_folder, destination_path)
+                destination_stat = os.stat(destination_path)
+                content_index(destination_folder).remember(operation.new_name, destination_stat, digest)
+                if digest is None and self.catalog is not None:
+                    # Hash on the worker threads for the catalog row (and later comparisons)
+                    digest = content_index(destination_folder).digest(operation.new_name, destination_path, destination_stat)
+                if digest is not None:
+                    result['digest'] = digest
+            result['strategy'] = strategy
+            result['bytes'] = moved_bytes
+            result['moved_to'] = destination_path
+        except Exception as e:
+            result['error'] = str(e)
+        if self.journal is not None:
+            self.journal.record(operation, result)
+        return result
+
+    def is_unchanged(self, old_file, source_stat, operation):
+        """
+        Check whether the file already at a move's destination has the same content as the source.
+        Sizes are compared first; only files of equal size are hashed.
+
+        :param old_file: Path of the source file.
+        :param source_stat: os.stat result of the source file.
+        :param operation: The PlannedMove.
+        :return: True if the destination holds identical content.
+        """
+        try:
+            destination_stat = os.stat(operation.destination_path)
+        except FileNotFoundError:
+            return False
+        if destination_stat.st_size != source_stat.st_size:
+            return False
+        index = content_index(operation.destination_folder)
+        return file_digest(old_file) == index.digest(operation.new_name, operation.destination_path, destination_stat)
+
+    def is_newer_at_destination(self, source_stat, operation):
+        """
+        Check whether the file already at a move's destination was modified after the source, e.g. a
+        newer download filed by an earlier run.
+
+        :param source_stat: os.stat result of the source file.
+        :param operation: The PlannedMove.
+        :return: True if the destination exists and its mtime is later than the source's.
+        """
+        try:
+            return os.stat(operation.destination_path).st_mtime_ns > source_stat.st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def transfer(self, old_file, source_stat, destination_folder, destination_path):
+        """
+        Move a file into an existing destination folder, with os.replace on the same volume or a
+        chunked copy across volumes, through self.verify in verified-transfer mode.
+
+        :return: Tuple of (strategy used, bytes moved, BLAKE2b hex digest of the content or None if it
+                 was not hashed on the way).
+        """
+        same_device = source_stat.st_dev == self.folder_device(destination_folder)
+        if self.verify is not None:
+            moved, digest = self.verify.move(old_file, destination_path, same_device)
+            return ('replace' if same_device else 'verified'), moved, digest
+        if same_device:
+            with metrics.timed('rename'):
+                os.replace(old_file, destination_path)
+            metrics.add_bytes('rename', source_stat.st_size)
+            return 'replace', source_stat.st_size, None
+        copied, method = copy_across_devices(old_file, destination_path)
+        return method, copied, None
+
+    def folder_device(self, folder):
+        """
+        Get the device (st_dev) a destination folder lives on, remembering it for later files.
+
+        :param folder: Path to an existing folder.
+        :return: The folder's device number.
+        """
+        device = self.folder_devices.get(folder)
+        if device is None:
+            device = self.folder_devices[folder] = os.stat(folder).st_dev
+        return device
+
+
+def catalog_main(argv):
+    """
+    Command line of `renamingV7.py catalog`: look up filed reports, printed as NDJSON, or rebuild the
+    catalog from the destination tree.
+
+    :param argv: Arguments after 'catalog'.
+    :return: Exit status.
+    """
+    parser = argparse.ArgumentParser(prog='renamingV7.py catalog', description='Query or rebuild the catalog of filed reports.')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help=f'catalog database (default: {DEFAULT_CATALOG})')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='logging level (default: INFO)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='print the matching reports, newest report date first')
+    query.add_argument('--rptdate', help='report date, as 14Jun2024 or 2024-06-14')
+    query.add_argument('--from', dest='date_from', help='earliest report date')
+    query.add_argument('--to', dest='date_to', help='latest report date')
+    query.add_argument('--type', dest='report_type', help='report type, e.g. Balancesheet_consolidated')
+    query.add_argument('--branch', help='branch suffix, e.g. 003')
+    query.add_argument('--name', help='part of the file name')
+    query.add_argument('--limit', type=int, default=100, help='maximum number of reports (default: 100)')
+    rebuild = commands.add_parser('rebuild', help='re-read the destination tree into the catalog')
+    rebuild.add_argument('--base', help="root of the destination tree (default: the user's OneDrive reports folder)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    catalog = ReportCatalog(args.catalog)
+    if args.command == 'query':
+        try:
+            reports = catalog.query(args.rptdate, args.date_from, args.date_to, args.report_type, args.branch, args.name,
+                                    max(1, args.limit))
+        except ValueError as e:
+            parser.error(str(e))
+        for report in reports:
+            print(json.dumps(report))
+    else:
+        base = args.base or default_destination_directory(getpass.getuser())
+        started = time.perf_counter()
+        count = catalog.rebuild(base, load_report_config().router(base))
+        logger.info('Catalogued %d report(s) under %s in %.2fs', count, base, time.perf_counter() - started)
+    return 0
+
 
 # Example usage
 if __name__ == "__main__":
-    file_mapping = {
-    'Profit N Loss 006_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_006_{RPTDATE}{SYSDATE}.xlsx',
-    'Profit N Loss 005_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_005_{RPTDATE}{SYSDATE}.xlsx',
-    'Profit N Loss 004_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_004_{RPTDATE}{SYSDATE}.xlsx',
-    'Profit N Loss 003_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_003_{RPTDATE}{SYSDATE}.xlsx',
-    'Profit N Loss 002_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_002_{RPTDATE}{SYSDATE}.xlsx',
-    'Profit N Loss 001_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_001_{RPTDATE}{SYSDATE}.xlsx',
-    'Loan Report Swalha_Loan Report Swalha Layout.xlsx': 'Loan Report Swalha_{RPTDATE}{SYSDATE}.xlsx',
-    'FUND CUSTOMER BALANCE_Reports.xlsx': 'FUND CUSTOMER BALANCE_{RPTDATE}{SYSDATE}.xlsx',
-    'Daily Investment Report_Loan Report Swalha Layout.xlsx': 'Daily Investment Report_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_006_Reports.xlsx': 'Balancesheet_consolidated_006_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_005_Reports.xlsx': 'Balancesheet_consolidated_005_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_004_Reports.xlsx': 'Balancesheet_consolidated_004_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_003_Reports.xlsx': 'Balancesheet_consolidated_003_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_002_Reports.xlsx': 'Balancesheet_consolidated_002_{RPTDATE}{SYSDATE}.xlsx',
-    'Balancesheet_001_Reports.xlsx': 'Balancesheet_consolidated_001_{RPTDATE}{SYSDATE}.xlsx',
-    'SKUK_Reports.xlsx': 'SKUK_Report_{RPTDATE}{SYSDATE}.xlsx',
-    'PL_CONSOLIDATED_PL_CONSOLIDATED.xlsx': 'P&L_CONSOLIDATED_000_{RPTDATE}{SYSDATE}.xlsx',
-    'CUSTOMER BALANCE_Reports.xlsx': 'CUSTOMER BALANCE_{RPTDATE}{SYSDATE}.xlsx',
-    'Bot_Loan_status_Bot_loan_status.xls': 'Bot_Loan_status_{RPTDATE}{SYSDATE}.xls',
-    'Balancesheet_consolidated_new_Reports.xlsx': 'Balancesheet_consolidated_000_{RPTDATE}{SYSDATE}.xlsx',
-    'Data Entry Report_Data Entry_Layout.xlsx': 'Data Entry Report_{RPTDATE}{SYSDATE}.xlsx',
-    }
+    if sys.argv[1:2] == ['catalog']:
+        sys.exit(catalog_main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Rename the CBS report downloads and file them under OneDrive.',
+                                     epilog='Run "%(prog)s catalog --help" to query or rebuild the catalog of filed reports.')
+    parser.add_argument('--source', default=os.path.join(os.path.expanduser('~'), 'Downloads'),
+                        help="directory the reports were downloaded to (default: the user's Downloads folder)")
+    parser.add_argument('--rptdate', type=normalize_report_date,
+                        help='report date, as 14Jun2024 or 2024-06-14; also picks the year and month folders '
+                             '(default: today; with --watch, the day each batch is filed)')
+    parser.add_argument('--sysdate', type=normalize_report_date, help='system date of the reports (default: the report date)')
+    parser.add_argument('--manifest', help='JSON manifest of date groups and their files; results are printed as NDJSON')
+    parser.add_argument('--dry-run', action='store_true', help='print the planned moves and conflicts without moving anything')
+    parser.add_argument('--no-overwrite', action='store_true', help='skip files that already exist at the destination')
+    parser.add_argument('--remove-duplicates', action='store_true',
+                        help='delete older duplicate downloads once the newest copy is filed (default: keep them)')
+    parser.add_argument('--prepare-folders', action='store_true',
+                        help="create the month's whole destination folder hierarchy before moving files")
+    parser.add_argument('--resume', action='store_true',
+                        help='finish the moves an interrupted run left open in the journal, then stop')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and file each report as soon as it has finished downloading')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='with --watch, seconds a download must stay unchanged before it is moved (default: 0.5)')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='with --watch, seconds between directory listings where inotify is unavailable (default: 1)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='logging level (default: INFO)')
+    parser.add_argument('--metrics-file', help='also write the JSON run summary (stage timings and byte counts) to this file')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help=f'record filed reports in this catalog (default: {DEFAULT_CATALOG})')
+    parser.add_argument('--no-catalog', action='store_true', help='do not record filed reports in the catalog')
+    parser.add_argument('--archive', choices=ARCHIVE_FORMATS,
+                        help="also bundle each day's filed reports into one archive per destination subtree")
+    parser.add_argument('--archive-keep-days', type=int,
+                        help='with --archive, delete loose files this many days after their report date (default: keep them)')
+    parser.add_argument('--no-validate', action='store_true', help='move files without checking that they are complete workbooks')
+    parser.add_argument('--verify', action='store_true',
+                        help='checksum every copy and fsync it and its folder before deleting the source')
+    parser.add_argument('--verify-retries', type=int, default=3, help='retries of a copy that fails verification (default: 3)')
+    parser.add_argument('--verify-backoff', type=float, default=0.5,
+                        help='seconds before the first retry, doubled for each later one (default: 0.5)')
+    parser.add_argument('--workers', type=int, default=4, help='number of files moved concurrently (default: 4)')
+    parser.add_argument('--max-files-per-second', type=float, help='limit how many moves are started per second')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    # Load the file mapping and routing rules
+    config = load_report_config()
 
     # Define variables to be used in the new file names
+    today = datetime.now().strftime(REPORT_DATE_FORMAT)
     additional_info = {
-        'RPTDATE': '14Jun2024',
-        'SYSDATE': 'sysdate14Jun2024',
+        'RPTDATE': args.rptdate or today,
+        'SYSDATE': args.sysdate or args.rptdate or today,
         # Add more variables as needed
     }
+    # Dates not given on the command line follow the calendar while watching
+    current_date_fields = tuple(field for field, value in (('RPTDATE', args.rptdate), ('SYSDATE', args.sysdate or args.rptdate))
+                                if value is None)
 
-    # Get the path to the user's Downloads directory
-    downloads_directory = os.path.join(os.path.expanduser('~'), 'Downloads')
+    # Moves are journaled in the source directory so an interrupted batch can be resumed
+    journal = OperationJournal(os.path.join(args.source, JOURNAL_NAME))
+    if journal.pending() and not (args.resume or args.dry_run):
+        parser.error(f'{journal.path} lists moves an earlier run did not finish; run with --resume first')
 
     # Create an instance of the FileRenamerMover class and rename and move the files
-    renamer_mover = FileRenamerMover(file_mapping, downloads_directory, additional_info)
-    renamer_mover.rename_and_move_files()
+    started = time.perf_counter()
+    renamer_mover = FileRenamerMover(config, args.source, additional_info, args.workers, args.max_files_per_second, journal,
+                                     not args.no_validate)
+    if not (args.no_catalog or args.dry_run):
+        try:
+            renamer_mover.catalog = ReportCatalog(args.catalog)
+        except (OSError, sqlite3.Error) as e:
+            logger.error('Cannot open the catalog %s, reports will not be recorded: %s', args.catalog, e)
+    renamer_mover.remove_duplicates = args.remove_duplicates
+    if args.verify:
+        renamer_mover.verify = VerifiedTransfer(args.verify_retries, args.verify_backoff)
+    if args.archive:
+        try:
+            renamer_mover.archive = ArchiveBundler(renamer_mover.base_destination_directory, args.archive, args.archive_keep_days,
+                                                   renamer_mover.catalog)
+        except RuntimeError as e:
+            parser.error(str(e))
+    if args.prepare_folders and not (args.dry_run or args.resume):
+        renamer_mover.prepare_destination_folders()
+    if args.resume:
+        renamer_mover.resume()
+    elif args.manifest:
+        with open(args.manifest, encoding='utf-8') as manifest_file:
+            groups = json.load(manifest_file)['groups']
+        renamer_mover.process_manifest(groups, dry_run=args.dry_run, overwrite=not args.no_overwrite)
+    elif args.watch and not args.dry_run:
+        watcher = open_watcher(args.source, args.poll_interval)
+        try:
+            renamer_mover.watch(watcher, args.settle, overwrite=not args.no_overwrite, current_date_fields=current_date_fields)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+    else:
+        renamer_mover.rename_and_move_files(dry_run=args.dry_run, overwrite=not args.no_overwrite)
+
+    # Report where the time went
+    summary = dict(metrics.summary(), seconds=round(time.perf_counter() - started, 6))
+    if renamer_mover.verify is not None:
+        summary['verify'] = renamer_mover.verify.summary()
+    logger.info('Run summary: %s', json.dumps(summary))
+    if args.metrics_file:
+        with open(args.metrics_file, 'w', encoding='utf-8') as metrics_file:
+            json.dump(summary, metrics_file, indent=2)
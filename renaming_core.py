@@ -0,0 +1,1594 @@
+"""
+Renaming engine shared by renamingV7.py (the command line) and EOD/script_rename.py (the web service):
+the reports config and its compiled name templates, source matcher and route table, the copy and
+verification helpers, workbook validation, the destination locks, the content indexes, the archive
+bundle indexes and the catalog.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import string
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType, SimpleNamespace
+from xml.etree import ElementTree
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: byte-range locks through msvcrt instead
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('renaming_core')
+
+# File mapping and routing rules of the CLI and the EOD web service
+REPORTS_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports.json')
+
+# Local state of the CLI and the service (catalog, lock files, content indexes), on the local disk rather than in the
+# synced OneDrive tree; REPORTS_STATE_DIR moves it elsewhere
+STATE_DIRECTORY = os.environ.get('REPORTS_STATE_DIR') or os.path.join(
+    os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.local', 'share'), 'itrust-reports')
+
+# SQLite catalog of filed reports
+DEFAULT_CATALOG = os.path.join(STATE_DIRECTORY, 'catalog.sqlite3')
+
+# Advisory lock files serializing writes to the same path across threads and processes; paths are
+# hashed onto LOCK_STRIPES lock files
+LOCK_FOLDER = os.path.join(STATE_DIRECTORY, 'locks')
+LOCK_STRIPES = 256
+
+# Seconds destination_lock waits for a lock before giving up
+LOCK_TIMEOUT = 60
+
+# Content indexes of the destination folders, one file per folder named after a hash of its path; kept
+# with the local state so OneDrive does not sync them
+CONTENT_INDEX_FOLDER = os.path.join(STATE_DIRECTORY, 'content-index')
+
+# Name of the content index earlier versions kept inside each destination folder; it is imported into
+# the local index and removed when that is first saved
+LEGACY_CONTENT_INDEX_NAME = '.content-index.json'
+
+# Extensions of the CBS report exports
+REPORT_EXTENSIONS = ('.xls', '.xlsx')
+
+# Format of RPTDATE and SYSDATE in the new file names, e.g. '14Jun2024'
+REPORT_DATE_FORMAT = '%d%b%Y'
+
+# Template fields holding dates; values captured from file names are normalized to REPORT_DATE_FORMAT
+DATE_FIELDS = ('RPTDATE', 'SYSDATE')
+
+# Month folder names of the destination hierarchy
+MONTH_NAMES = ('JANUARY', 'FEBRUARY', 'MARCH', 'APRIL', 'MAY', 'JUNE',
+               'JULY', 'AUGUST', 'SEPTEMBER', 'OCTOBER', 'NOVEMBER', 'DECEMBER')
+
+# A routing rule: files whose new name starts with `prefix` go to `destination`
+# (path parts relative to the base destination directory, which may use the
+# {YEAR} and {MONTH} of the file's report date). When `capture_suffix` is set,
+# the '_'-delimited token right after the prefix (e.g. the branch code '006')
+# is appended as the last folder.
+RouteRule = namedtuple('RouteRule', ['prefix', 'destination', 'capture_suffix'])
+
+
+@lru_cache(maxsize=None)
+def normalize_report_date(value):
+    """
+    Convert a report date given as '14Jun2024' or '2024-06-14' to REPORT_DATE_FORMAT.
+
+    :param value: The date.
+    :return: The date as e.g. '14Jun2024'.
+    :raises ValueError: If the date is in neither format.
+    """
+    for date_format in (REPORT_DATE_FORMAT, '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format).strftime(REPORT_DATE_FORMAT)
+        except ValueError:
+            pass
+    raise ValueError(f'Unrecognized report date: {value!r}')
+
+
+@lru_cache(maxsize=None)
+def date_path(report_date):
+    """
+    Year and month folder names of a report date, e.g. '14Jun2024' -> ('2024', 'JUNE').
+
+    :param report_date: Report date in either format accepted by normalize_report_date.
+    :return: Tuple of (year, month).
+    """
+    date = datetime.strptime(normalize_report_date(report_date), REPORT_DATE_FORMAT)
+    return str(date.year), MONTH_NAMES[date.month - 1]
+
+
+class PrefixRouter:
+    # Trie nodes are dicts keyed by character; this key marks the end of a rule prefix.
+    _RULE = None
+
+    def __init__(self, rules, base_directory):
+        """
+        Compile the routing rules into a prefix trie.
+
+        :param rules: Iterable of RouteRule entries. When two rules share a prefix the first one wins.
+        :param base_directory: Directory the rule destinations are relative to; also the fallback destination.
+        """
+        self.rules = list(rules)
+        self.base_directory = base_directory
+        self.trie = {}
+        # Joined destination paths keyed by (rule index, suffix, (year, month))
+        self.paths = {}
+        # Whether each rule's destination depends on the report date
+        self.dated = []
+        for index, rule in enumerate(self.rules):
+            fields = {field for part in rule.destination for _, field, _, _ in string.Formatter().parse(part) if field is not None}
+            if fields - {'YEAR', 'MONTH'}:
+                raise ValueError(f"Unknown placeholders in the destination of {rule.prefix!r}: {', '.join(sorted(fields - {'YEAR', 'MONTH'}))}")
+            self.dated.append(bool(fields))
+            node = self.trie
+            for char in rule.prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(self._RULE, index)
+
+    def classify(self, new_name):
+        """
+        Find the rule for a file name in a single walk over the name. The longest matching prefix
+        wins, so lookups cost O(len(new_name)) however many rules exist.
+
+        :param new_name: The new name of the file.
+        :return: (rule index, suffix) where suffix is the part after the prefix up to the next '_' for
+                 rules that capture it (e.g. the branch '006'), otherwise None; (None, None) if no
+                 rule matches.
+        """
+        node = self.trie
+        match = None
+        end = 0
+        for position, char in enumerate(new_name):
+            node = node.get(char)
+            if node is None:
+                break
+            if self._RULE in node:
+                match = node[self._RULE]
+                end = position + 1
+        if match is None or not self.rules[match].capture_suffix:
+            return match, None
+        stop = new_name.find('_', end)
+        return match, new_name[end:] if stop == -1 else new_name[end:stop]
+
+    def route(self, new_name, report_date=None):
+        """
+        Find the destination folder for a file name (see classify).
+
+        :param new_name: The new name of the file.
+        :param report_date: The file's report date, giving the {YEAR} and {MONTH} folders of dated rules.
+        :return: The path to the destination folder.
+        :raises ValueError: If the matching rule is dated and no report date is given.
+        """
+        match, suffix = self.classify(new_name)
+        if match is None:
+            return self.base_directory
+        rule = self.rules[match]
+
+        period = None
+        if self.dated[match]:
+            if report_date is None:
+                raise ValueError(f'No report date to route {new_name} by')
+            period = date_path(report_date)
+
+        key = (match, suffix, period)
+        path = self.paths.get(key)
+        if path is None:
+            parts = rule.destination
+            if period is not None:
+                parts = tuple(part.format(YEAR=period[0], MONTH=period[1]) for part in parts)
+            if suffix is not None:
+                parts += (suffix,)
+            path = self.paths[key] = os.path.join(self.base_directory, *parts)
+        return path
+
+    def route_many(self, names, report_dates=None):
+        """
+        Route a batch of file names.
+
+        :param names: Iterable of new file names.
+        :param report_dates: Optional iterable of the files' report dates, in the same order.
+        :return: List of destination folder paths, in the same order as the names.
+        """
+        route = self.route
+        if report_dates is None:
+            return [route(name) for name in names]
+        return [route(name, report_date) for name, report_date in zip(names, report_dates)]
+
+
+class StageMetrics:
+    # Upper bounds, in seconds, of the latency histogram buckets
+    BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self):
+        """
+        Thread-safe latency histograms and byte counters per pipeline stage (scan, match, render,
+        route, mkdir, receive, rename, copy, fsync, checksum, ...), reported as a JSON summary or in
+        the Prometheus text format.
+        """
+        self.lock = threading.Lock()
+        # Stage -> {'buckets': counts per bucket plus one for +Inf, 'count', 'seconds', 'max'}
+        self.stages = {}
+        # Stage -> bytes processed
+        self.bytes = {}
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Time the body of a with block as one observation of a stage.
+
+        :param stage: Stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        """
+        Record how long one run of a stage took.
+
+        :param stage: Stage name.
+        :param seconds: Duration.
+        """
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = {'buckets': [0] * (len(self.BUCKETS) + 1), 'count': 0, 'seconds': 0.0, 'max': 0.0}
+            histogram['buckets'][bucket] += 1
+            histogram['count'] += 1
+            histogram['seconds'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+
+    def add_bytes(self, stage, count):
+        """
+        Count bytes processed by a stage.
+
+        :param stage: Stage name.
+        :param count: Number of bytes.
+        """
+        with self.lock:
+            self.bytes[stage] = self.bytes.get(stage, 0) + count
+
+    def summary(self):
+        """
+        :return: JSON-serializable dictionary with the count, total, mean and maximum seconds and
+                 the bucket counts of each stage, and the byte counters.
+        """
+        with self.lock:
+            stages = {}
+            for stage, histogram in sorted(self.stages.items()):
+                stages[stage] = {
+                    'count': histogram['count'],
+                    'seconds': round(histogram['seconds'], 6),
+                    'mean': round(histogram['seconds'] / histogram['count'], 6),
+                    'max': round(histogram['max'], 6),
+                    'buckets': dict(zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], histogram['buckets'])),
+                }
+            return {'stages': stages, 'bytes': dict(sorted(self.bytes.items()))}
+
+    def prometheus(self, prefix='renamer'):
+        """
+        :param prefix: Metric name prefix.
+        :return: The metrics in the Prometheus text exposition format.
+        """
+        lines = [f'# HELP {prefix}_stage_seconds Time spent in each pipeline stage.',
+                 f'# TYPE {prefix}_stage_seconds histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ('+Inf',), histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram["seconds"]}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+            lines += [f'# HELP {prefix}_stage_bytes_total Bytes processed by each pipeline stage.',
+                      f'# TYPE {prefix}_stage_bytes_total counter']
+            lines += [f'{prefix}_stage_bytes_total{{stage="{stage}"}} {count}' for stage, count in sorted(self.bytes.items())]
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide metrics of the CLI run or the service worker
+metrics = StageMetrics()
+
+# Buffer size for copies and hashing
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def temp_prefix(name):
+    """
+    :param name: Final name of the file being written.
+    :return: Prefix of its temporary files; the process ID keeps those of different processes apart and traceable.
+    """
+    return f'.{name}.{os.getpid()}.'
+
+
+def copy_file_data(source, target):
+    """
+    Copy the contents of one open file to another in large chunks.
+
+    Uses copy_file_range or sendfile where the platform supports them, so the data does not pass
+    through Python, and falls back to buffered reads and writes.
+
+    :param source: File object opened for binary reading.
+    :param target: File object opened for binary writing.
+    :return: Tuple of (bytes copied, name of the copy method used).
+    """
+    source_fd = source.fileno()
+    target_fd = target.fileno()
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        copied = 0
+        try:
+            while True:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(source_fd, target_fd, COPY_CHUNK_SIZE)
+                else:
+                    sent = os.sendfile(target_fd, source_fd, None, COPY_CHUNK_SIZE)
+                if not sent:
+                    if copied:
+                        return copied, method
+                    # Nothing copied at offset 0: an empty file, or a method this pair of files (e.g. a
+                    # FUSE or network mount) silently does not support; the next method copies either
+                    break
+                copied += sent
+        except OSError:
+            # Not supported for this pair of files; only fall back if nothing was written yet
+            if copied:
+                raise
+
+    copied = 0
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return copied, 'buffered'
+        target.write(chunk)
+        copied += len(chunk)
+
+
+class TransferError(OSError):
+    """
+    A copied file that does not match its source.
+    """
+
+
+def copy_across_devices(source_path, destination_path):
+    """
+    Move a file to another volume: copy it into a temporary file next to the destination,
+    fsync it, rename it into place and then remove the source. The source is only removed if the
+    copy has as many bytes as the source.
+
+    :param source_path: Path of the file to move.
+    :param destination_path: Final path of the file.
+    :return: Tuple of (bytes copied, name of the copy method used).
+    :raises TransferError: If fewer or more bytes were copied than the source holds; the source is kept.
+    """
+    destination_folder, destination_name = os.path.split(destination_path)
+    fd, temp_path = tempfile.mkstemp(dir=destination_folder, prefix=temp_prefix(destination_name), suffix='.part')
+    try:
+        with open(source_path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            with metrics.timed('copy'):
+                copied, method = copy_file_data(source, target)
+                target.flush()
+            size = os.fstat(source.fileno()).st_size
+            if copied != size:
+                raise TransferError(f'Copied {copied} of the {size} bytes of {source_path} ({method})')
+            with metrics.timed('fsync'):
+                os.fsync(target.fileno())
+        shutil.copystat(source_path, temp_path)
+        with metrics.timed('rename'):
+            os.replace(temp_path, destination_path)
+        metrics.add_bytes('copy', copied)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    os.unlink(source_path)
+    return copied, method
+
+
+def fsync_directory(path):
+    """
+    fsync a folder, so that a file renamed into it survives a crash. Windows cannot open folders
+    for this, so it is skipped there.
+
+    :param path: Path of the folder.
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def verified_copy(source_path, destination_path, expected_digest=None):
+    """
+    Copy a file to another volume and check the copy before it is put in place. The source is read
+    once: each chunk is written to a temporary file beside the destination and hashed with BLAKE2b
+    in the same loop. The temporary file is fsynced, hashed back from disk and renamed into place
+    only if both hashes match (and match expected_digest, if given); the folder is then fsynced.
+    The source is left alone; the caller removes it.
+
+    :param source_path: Path of the file to copy.
+    :param destination_path: Final path of the copy.
+    :param expected_digest: Optional BLAKE2b hex digest the content must have.
+    :return: Tuple of (bytes copied, hex digest, seconds spent hashing).
+    :raises TransferError: If the copy does not match, or the source changed while it was copied.
+    """
+    destination_folder, destination_name = os.path.split(destination_path)
+    fd, temp_path = tempfile.mkstemp(dir=destination_folder, prefix=temp_prefix(destination_name), suffix='.part')
+    try:
+        digest = hashlib.blake2b()
+        hashing = 0.0
+        copied = 0
+        with open(source_path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            before = os.fstat(source.fileno())
+            with metrics.timed('copy'):
+                while chunk := source.read(COPY_CHUNK_SIZE):
+                    target.write(chunk)
+                    started = time.perf_counter()
+                    digest.update(chunk)
+                    hashing += time.perf_counter() - started
+                    copied += len(chunk)
+                target.flush()
+            with metrics.timed('fsync'):
+                os.fsync(target.fileno())
+            after = os.fstat(source.fileno())
+        metrics.observe('checksum', hashing)
+        if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns) or copied != after.st_size:
+            raise TransferError(f'{source_path} changed while it was copied')
+
+        started = time.perf_counter()
+        copy_digest = hashlib.blake2b()
+        with open(temp_path, 'rb') as copy:
+            while chunk := copy.read(COPY_CHUNK_SIZE):
+                copy_digest.update(chunk)
+        verifying = time.perf_counter() - started
+        metrics.observe('verify', verifying)
+        if copy_digest.hexdigest() != digest.hexdigest():
+            raise TransferError(f'The copy of {source_path} does not match its checksum')
+        if expected_digest is not None and digest.hexdigest() != expected_digest:
+            raise TransferError(f'{source_path} does not match its expected checksum')
+
+        shutil.copystat(source_path, temp_path)
+        with metrics.timed('rename'):
+            os.replace(temp_path, destination_path)
+        with metrics.timed('fsync'):
+            fsync_directory(destination_folder)
+        metrics.add_bytes('copy', copied)
+        metrics.add_bytes('checksum', copied)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return copied, digest.hexdigest(), hashing + verifying
+
+
+class VerifiedTransfer:
+    def __init__(self, retries=3, backoff=0.5):
+        """
+        Verified-transfer mode: cross-volume moves go through verified_copy, and the source is deleted
+        only once the copy is known to match it. A copy that fails is retried with exponential backoff.
+        Keeps the totals reported in the CLI's run summary.
+
+        :param retries: Number of further attempts after a failed copy.
+        :param backoff: Seconds to wait before the first retry; doubled for each later one.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.retried = 0
+        self.failed = 0
+        self.copy_seconds = 0.0
+        self.checksum_seconds = 0.0
+
+    def move(self, source_path, destination_path, same_device, expected_digest=None):
+        """
+        Move a file to its destination. On the same volume it is renamed (nothing to verify) and the
+        folder fsynced; otherwise it is copied by verified_copy and then removed.
+
+        :param source_path: Path of the file to move.
+        :param destination_path: Final path of the file.
+        :param same_device: Whether source and destination are on the same volume.
+        :param expected_digest: Optional BLAKE2b hex digest the copy must have, e.g. one taken while
+                                the file was uploaded.
+        :return: Tuple of (bytes moved, hex digest or None if the file was renamed).
+        :raises OSError: If the last attempt fails; the source is then left in place.
+        """
+        if same_device:
+            size = os.stat(source_path).st_size
+            with metrics.timed('rename'):
+                os.replace(source_path, destination_path)
+            with metrics.timed('fsync'):
+                fsync_directory(os.path.dirname(destination_path))
+            return size, None
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                copied, digest, hashing = verified_copy(source_path, destination_path, expected_digest)
+                break
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                if attempt >= self.retries:
+                    with self.lock:
+                        self.failed += 1
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                logger.warning('Copying %s failed (%s), retrying in %.1fs', source_path, e, delay)
+                time.sleep(delay)
+        with self.lock:
+            self.files += 1
+            self.bytes += copied
+            self.copy_seconds += time.perf_counter() - started - hashing
+            self.checksum_seconds += hashing
+        os.unlink(source_path)
+        return copied, digest
+
+    def summary(self):
+        """
+        :return: JSON-serializable dictionary with the number of verified copies, their bytes,
+                 retries and failures, and the checksum overhead: total seconds, seconds per file
+                 and its ratio to the time spent copying.
+        """
+        with self.lock:
+            return {
+                'files': self.files,
+                'bytes': self.bytes,
+                'retries': self.retried,
+                'failed': self.failed,
+                'checksum_seconds': round(self.checksum_seconds, 6),
+                'checksum_seconds_per_file': round(self.checksum_seconds / self.files, 6) if self.files else None,
+                'overhead': round(self.checksum_seconds / self.copy_seconds, 4) if self.copy_seconds else None,
+            }
+
+
+def file_digest(path):
+    """
+    Hash a file's content with BLAKE2b, reading it in COPY_CHUNK_SIZE chunks.
+
+    :param path: Path of the file.
+    :return: Hex digest.
+    """
+    digest = hashlib.blake2b()
+    with metrics.timed('hash'), open(path, 'rb') as source:
+        while chunk := source.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+            metrics.add_bytes('hash', len(chunk))
+    return digest.hexdigest()
+
+
+# First bytes of an OLE2 compound document (.xls) and of a zip archive (.xlsx)
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+# Largest xl/workbook.xml read to list an .xlsx file's sheet names
+MAX_WORKBOOK_PART_SIZE = 16 * 1024 * 1024
+
+
+class WorkbookError(ValueError):
+    """
+    A file with a workbook extension that is not a complete, readable workbook.
+    """
+
+
+def check_workbook_signature(name, head):
+    """
+    Check the first bytes of a file against the signature its extension calls for, so an HTML error
+    page or a file of another type is refused from its first chunk.
+
+    :param name: File name, whose extension selects the format.
+    :param head: At least the first 8 bytes of the file.
+    :raises WorkbookError: If the file is not of that format, e.g. an HTML error page.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    signature = OLE_SIGNATURE if extension == '.xls' else ZIP_SIGNATURE
+    if not head.startswith(signature):
+        if head.lstrip()[:1] == b'<':
+            raise WorkbookError(f'{name} is an HTML or XML page, not an {extension} workbook')
+        raise WorkbookError(f'{name} is not an {extension} workbook')
+
+
+def workbook_sheet_names(path, name):
+    """
+    List the sheet names of an .xlsx file. Only the zip central directory and xl/workbook.xml are read,
+    never the sheets themselves, so this takes the same time whatever the file's size.
+
+    :param path: Path of the file.
+    :param name: File name used in error messages.
+    :return: List of sheet names, in workbook order.
+    :raises WorkbookError: If the archive is truncated or damaged or has no workbook part.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            try:
+                info = archive.getinfo('xl/workbook.xml')
+            except KeyError:
+                raise WorkbookError(f'{name} is a zip archive but not an Excel workbook')
+            if info.file_size > MAX_WORKBOOK_PART_SIZE:
+                raise WorkbookError(f'{name} has an implausibly large workbook part')
+            root = ElementTree.fromstring(archive.read(info))
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, ElementTree.ParseError, EOFError, KeyError) as e:
+        raise WorkbookError(f'{name} is damaged or incomplete: {e}')
+    return [element.get('name') for element in root.iter() if element.tag.rpartition('}')[2] == 'sheet']
+
+
+def validate_workbook(path, name=None, expected_sheets=()):
+    """
+    Check that a file is a complete workbook before it is filed. For .xlsx files the zip central
+    directory and sheet names are read; for .xls files the OLE header is checked.
+
+    :param path: Path of the file.
+    :param name: File name the format is judged by (default: that of path).
+    :param expected_sheets: Sheet names the workbook must contain (checked for .xlsx files only).
+    :return: List of sheet names, or None for .xls files.
+    :raises WorkbookError: If the file is not a valid workbook or lacks an expected sheet.
+    """
+    name = name or os.path.basename(path)
+    with metrics.timed('validate'):
+        with open(path, 'rb') as workbook:
+            head = workbook.read(512)
+        check_workbook_signature(name, head)
+        if not name.lower().endswith('.xlsx'):
+            # A compound document header is 512 bytes and declares 512 or 4096 byte sectors
+            if len(head) < 512 or struct.unpack_from('<H', head, 30)[0] not in (9, 12):
+                raise WorkbookError(f'{name} has a damaged or incomplete OLE header')
+            return None
+        sheets = workbook_sheet_names(path, name)
+        missing = [sheet for sheet in expected_sheets if sheet not in sheets]
+        if missing:
+            raise WorkbookError(f"{name} has no sheet {', '.join(map(repr, missing))} (it has {', '.join(map(repr, sheets))})")
+        return sheets
+
+
+class NameTemplate:
+    def __init__(self, template):
+        """
+        Parse a str.format-style file name template once into literal text and placeholder names.
+
+        :param template: Template such as 'SKUK_Report_{RPTDATE}{SYSDATE}.xlsx'. Only plain {NAME}
+                         placeholders are supported.
+        """
+        self.template = template
+        # (literal text, placeholder name or None) pairs, in order
+        self.segments = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if field_name is not None and (not field_name.isidentifier() or format_spec or conversion):
+                raise ValueError(f'Unsupported placeholder {{{field_name}}} in name template {template!r}')
+            self.segments.append((literal, field_name))
+        self.fields = frozenset(field_name for _, field_name in self.segments if field_name is not None)
+
+    def render(self, values):
+        """
+        Fill in the placeholders.
+
+        :param values: Dictionary of placeholder values.
+        :return: The rendered file name.
+        """
+        return ''.join([literal if field_name is None else literal + str(values[field_name])
+                        for literal, field_name in self.segments])
+
+
+@lru_cache(maxsize=16)
+def _compile_mapping_items(items):
+    return {old_name: NameTemplate(template) for old_name, template in items}
+
+
+def compile_file_mapping(file_mapping):
+    """
+    Compile every name template in a file mapping, reusing the result for mappings seen before.
+
+    :param file_mapping: Dictionary of old file names to new name templates.
+    :return: Dictionary of old file names to NameTemplate objects.
+    """
+    return _compile_mapping_items(tuple(file_mapping.items()))
+
+
+# A source rule: `filename` is the exact mapping key (None for pattern rules), `pattern` the regex
+# it was compiled from, and `groups` maps the rule's groups in the combined regex to template placeholders.
+SourceRule = namedtuple('SourceRule', ['filename', 'pattern', 'template', 'groups'])
+
+
+class SourceMatcher:
+    # Browsers save repeated downloads as 'name (2).xlsx'
+    DUPLICATE_SUFFIX = r'(?: \(\d+\))?'
+
+    def __init__(self, name_templates, source_patterns):
+        """
+        Compile the exact file names of the mapping and the source patterns into one alternation regex,
+        so each name in a directory listing is matched against every rule in a single pass.
+
+        :param name_templates: Dictionary of exact file names to NameTemplate objects. These rules come
+                               first and also match browser duplicates such as 'name (2).xlsx'.
+        :param source_patterns: Iterable of (regex, NameTemplate) pairs. Named groups in the regex, such as
+                                (?P<BRANCH>\\d{3}), fill the placeholders of the same name in the template.
+        """
+        self.rules = []
+        alternatives = []
+        for filename, template in name_templates.items():
+            stem, extension = os.path.splitext(filename)
+            pattern = re.escape(stem) + self.DUPLICATE_SUFFIX + re.escape(extension)
+            alternatives.append(pattern)
+            self.rules.append(SourceRule(filename, pattern, template, {}))
+        for pattern, template in source_patterns:
+            index = len(self.rules)
+            # Group names must be unique across the alternation, so prefix them with the rule index
+            groups = {f'r{index}_{name}': name for name in re.compile(pattern).groupindex}
+            rewritten = re.sub(r'\(\?P<(\w+)>', rf'(?P<r{index}_\1>', pattern)
+            rewritten = re.sub(r'\(\?P=(\w+)\)', rf'(?P=r{index}_\1)', rewritten)
+            alternatives.append(rewritten)
+            self.rules.append(SourceRule(None, pattern, template, groups))
+        # Each rule is wrapped in a group named '_<index>'; being outermost it is the match's lastgroup
+        combined = '|'.join(f'(?P<_{index}>{alternative})' for index, alternative in enumerate(alternatives))
+        self.regex = re.compile(combined or '(?!)')
+
+    def match(self, name):
+        """
+        Find the first rule matching a file name.
+
+        :param name: File name to match.
+        :return: Tuple of (rule index, dictionary of captured placeholder values), or None.
+        """
+        match = self.regex.fullmatch(name)
+        if match is None:
+            return None
+        index = int(match.lastgroup[1:])
+        groups = self.rules[index].groups
+        return index, {placeholder: match.group(group) for group, placeholder in groups.items()}
+
+
+class ReportConfig:
+    def __init__(self, file_mapping, routing_rules, source_patterns=(), expected_sheets=()):
+        """
+        Read-only, precompiled form of the reports config, shared by every renamer built from it.
+
+        :param file_mapping: Dictionary of original file names to new name templates.
+        :param routing_rules: Iterable of RouteRule entries.
+        :param source_patterns: Iterable of (regex, new name template) pairs for files whose names vary.
+        :param expected_sheets: Iterable of (new name prefix, sheet names) pairs; workbooks whose new
+                                name starts with the prefix must contain those sheets.
+        """
+        self.file_mapping = MappingProxyType(dict(file_mapping))
+        self.routing_rules = tuple(routing_rules)
+        self.name_templates = compile_file_mapping(self.file_mapping)
+        self.source_matcher = SourceMatcher(
+            self.name_templates,
+            [(pattern, NameTemplate(template)) for pattern, template in source_patterns],
+        )
+        # Placeholders that must come from additional_info rather than from the file name
+        self.required_fields = frozenset().union(*(
+            rule.template.fields - set(rule.groups.values()) for rule in self.source_matcher.rules))
+        # Longest prefixes first, so the most specific entry wins
+        self.expected_sheets = tuple(sorted(
+            ((prefix, tuple(sheets)) for prefix, sheets in expected_sheets), key=lambda entry: -len(entry[0])))
+        # Compiled routers keyed by base destination directory
+        self.routers = {}
+
+    def sheets_for(self, new_name):
+        """
+        Get the sheet names a renamed workbook must contain.
+
+        :param new_name: The file's new name.
+        :return: Tuple of sheet names, empty if nothing is expected.
+        """
+        for prefix, sheets in self.expected_sheets:
+            if new_name.startswith(prefix):
+                return sheets
+        return ()
+
+    def router(self, base_directory):
+        """
+        Get the PrefixRouter for the routing rules under a base destination directory.
+
+        :param base_directory: Directory the rule destinations are relative to.
+        :return: A PrefixRouter, compiled on first use.
+        """
+        router = self.routers.get(base_directory)
+        if router is None:
+            router = self.routers[base_directory] = PrefixRouter(self.routing_rules, base_directory)
+        return router
+
+
+# Loaded configs keyed by path, as (st_mtime_ns, ReportConfig)
+_loaded_configs = {}
+_loaded_configs_lock = threading.Lock()
+
+
+def load_report_config(path=REPORTS_CONFIG):
+    """
+    Load the file mapping and routing rules from a JSON config file.
+
+    The parsed config is cached and only re-read when the file's modification time changes, so
+    report types can be added without restarting anything.
+
+    :param path: Path to the config file.
+    :return: A ReportConfig.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    with _loaded_configs_lock:
+        cached = _loaded_configs.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, encoding='utf-8') as config_file:
+        data = json.load(config_file)
+    routing_rules = [
+        RouteRule(route['prefix'], tuple(route['destination']), route.get('capture_suffix', False))
+        for route in data['routes']
+    ]
+    source_patterns = [(source['pattern'], source['template']) for source in data.get('source_patterns', [])]
+    expected_sheets = [(entry['prefix'], entry['sheets']) for entry in data.get('expected_sheets', [])]
+    config = ReportConfig(data['file_mapping'], routing_rules, source_patterns, expected_sheets)
+    with _loaded_configs_lock:
+        _loaded_configs[path] = (mtime, config)
+    return config
+
+
+class DirectoryCache:
+    def __init__(self):
+        """
+        Process-wide record of destination folders known to exist, so each folder costs at most one
+        makedirs per process instead of an exists/makedirs pair per file.
+        """
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def add(self, folder):
+        """
+        Record a folder that was just seen to exist.
+
+        :param folder: Folder path.
+        """
+        with self.lock:
+            self.known.add(folder)
+
+    def ensure(self, folder):
+        """
+        Make sure a folder exists, creating it (and its parents) the first time it is asked for.
+
+        :param folder: Folder path.
+        """
+        if folder in self.known:
+            return
+        with metrics.timed('mkdir'):
+            os.makedirs(folder, exist_ok=True)
+        self.add(folder)
+
+    def invalidate(self, folder):
+        """
+        Forget a folder (and everything below it) that turned out to be missing.
+
+        :param folder: Folder path.
+        """
+        prefix = os.path.join(folder, '')
+        with self.lock:
+            self.known = {known for known in self.known if known != folder and not known.startswith(prefix)}
+
+    def run_in(self, folder, operation, *args):
+        """
+        Run an operation that writes into a folder. If the folder was removed behind the cache's back,
+        forget it, create it again and retry the operation once.
+
+        :param folder: Folder the operation writes into.
+        :param operation: Callable to run.
+        :return: Whatever the operation returns.
+        """
+        self.ensure(folder)
+        try:
+            return operation(*args)
+        except FileNotFoundError:
+            if os.path.isdir(folder):
+                raise
+            self.invalidate(folder)
+            self.ensure(folder)
+            return operation(*args)
+
+
+directory_cache = DirectoryCache()
+
+
+class LockTimeoutError(TimeoutError):
+    """
+    A destination lock that another thread or process held for longer than the lock timeout.
+    """
+
+
+def try_lock(fd):
+    """
+    Take an exclusive advisory lock on an open lock file without waiting.
+
+    :param fd: Descriptor of the lock file; closing it releases the lock.
+    :return: Whether the lock was taken; False if another descriptor holds it.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError as e:
+        # flock reports a held lock as EWOULDBLOCK; msvcrt as EACCES or EDEADLOCK
+        if fcntl is not None and not isinstance(e, BlockingIOError):
+            raise
+        return False
+
+
+@contextmanager
+def destination_lock(path, lock_folder=None, stripes=None, timeout=None):
+    """
+    Hold an exclusive advisory lock for a path, shared by every thread and process using the same lock
+    folder. Paths are hashed onto a fixed number of lock files, so the number of lock files stays fixed
+    however many paths there are. The lock is polled without blocking, backing off up to 0.1 seconds
+    between tries, until it is free or the timeout passes.
+
+    :param path: Path to lock, usually a destination file.
+    :param lock_folder: Folder of the lock files (default: LOCK_FOLDER).
+    :param stripes: Number of lock files (default: LOCK_STRIPES).
+    :param timeout: Seconds to wait for the lock (default: LOCK_TIMEOUT).
+    :raises LockTimeoutError: If the lock is still held by someone else when the timeout passes.
+    """
+    lock_folder = lock_folder or LOCK_FOLDER
+    timeout = LOCK_TIMEOUT if timeout is None else timeout
+    stripe = int.from_bytes(hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).digest(), 'big')
+    lock_path = os.path.join(lock_folder, f'{stripe % (stripes or LOCK_STRIPES):03d}.lock')
+    fd = directory_cache.run_in(lock_folder, os.open, lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with metrics.timed('lock'):
+            deadline = time.monotonic() + timeout
+            delay = 0.001
+            while not try_lock(fd):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LockTimeoutError(f'Gave up waiting for the lock on {path} ({lock_path}) after {timeout:g}s; '
+                                           f'another process is holding it')
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.1)
+        yield
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+def content_index_path(folder, index_folder=None):
+    """
+    :param folder: Destination folder.
+    :param index_folder: Folder of the content indexes (default: CONTENT_INDEX_FOLDER).
+    :return: Path of the destination folder's content index.
+    """
+    key = hashlib.blake2b(os.path.abspath(folder).encode(), digest_size=16).hexdigest()
+    return os.path.join(index_folder or CONTENT_INDEX_FOLDER, key + '.json')
+
+
+def read_content_index(folder, index_folder=None):
+    """
+    Read the entries of a destination folder's content index, falling back to the legacy index
+    inside the folder if there is no local one yet.
+
+    :param folder: Destination folder.
+    :param index_folder: Folder of the content indexes (default: CONTENT_INDEX_FOLDER).
+    :return: Dictionary of file name -> {'size', 'mtime_ns', 'blake2b'}; empty if there is no
+             readable index.
+    """
+    return _read_content_index(folder, index_folder)[0]
+
+
+def _read_content_index(folder, index_folder=None):
+    """
+    See read_content_index.
+
+    :return: Tuple of (entries, whether they were read from the legacy index).
+    """
+    try:
+        with open(content_index_path(folder, index_folder), encoding='utf-8') as index_file:
+            return json.load(index_file)['entries'], False
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    try:
+        with open(os.path.join(folder, LEGACY_CONTENT_INDEX_NAME), encoding='utf-8') as index_file:
+            return json.load(index_file), True
+    except (OSError, ValueError):
+        return {}, False
+
+
+class ContentIndex:
+    def __init__(self, folder, index_folder=None):
+        """
+        Persistent index of the files in one destination folder: name -> size, mtime and content hash.
+        An entry is only trusted while the file's size and mtime still match, and hashes are filled in
+        lazily the first time a comparison needs them, so reruns never rehash the whole folder.
+
+        :param folder: Destination folder.
+        :param index_folder: Folder the index is stored in (default: CONTENT_INDEX_FOLDER), on the
+                             local disk rather than in the synced destination tree.
+        """
+        self.folder = os.path.abspath(folder)
+        self.index_folder = index_folder or CONTENT_INDEX_FOLDER
+        self.path = content_index_path(folder, self.index_folder)
+        self.lock = threading.Lock()
+        # Names recorded by this process since the last save
+        self.changed = set()
+        self.entries = read_content_index(folder, self.index_folder)
+
+    def digest(self, name, path, stat):
+        """
+        Return the content hash of a file in the folder, from the index if its entry still matches
+        the file's size and mtime, otherwise by hashing it and updating the index.
+
+        :param name: File name within the folder.
+        :param path: Path of the file.
+        :param stat: os.stat result of the file.
+        :return: Hex digest.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and entry['blake2b']:
+            return entry['blake2b']
+        digest = file_digest(path)
+        self.remember(name, stat, digest)
+        return digest
+
+    def remember(self, name, stat, digest=None):
+        """
+        Record a file written to the folder. Without a digest, it is computed on first comparison.
+
+        :param name: File name within the folder.
+        :param stat: os.stat result of the file.
+        :param digest: Optional content hash.
+        """
+        with self.lock:
+            self.entries[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blake2b': digest}
+            self.changed.add(name)
+
+    def save(self):
+        """
+        Write the index back atomically, if it changed. Other processes (CLI runs, service workers) may
+        have saved the same index meanwhile, so under the index's destination_lock the file is re-read
+        and this process's changes are merged into it. A legacy index left in the destination folder
+        is removed once its entries have been imported into the local one; one that was not imported,
+        because a local index already existed or it could not be read, is left alone.
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            changed = {name: self.entries[name] for name in self.changed}
+            self.changed = set()
+        try:
+            # The file lock is taken without holding self.lock, which its holders may be waiting for
+            with destination_lock(self.path):
+                entries, imported = _read_content_index(self.folder, self.index_folder)
+                entries.update(changed)
+                fd, temp_path = directory_cache.run_in(self.index_folder, tempfile.mkstemp, '.part',
+                                                       temp_prefix(os.path.basename(self.path)), self.index_folder)
+                with os.fdopen(fd, 'w', encoding='utf-8') as index_file:
+                    json.dump({'folder': self.folder, 'entries': entries}, index_file)
+                os.replace(temp_path, self.path)
+                if imported:
+                    try:
+                        os.unlink(os.path.join(self.folder, LEGACY_CONTENT_INDEX_NAME))
+                    except OSError:
+                        pass
+        except BaseException:
+            with self.lock:
+                self.changed.update(changed)
+            raise
+        with self.lock:
+            # Keep entries recorded while the file was being written
+            entries.update((name, self.entries[name]) for name in self.changed)
+            self.entries = entries
+
+
+_content_indexes = {}
+_content_indexes_lock = threading.Lock()
+
+
+def content_index(folder):
+    """
+    Return the process-wide ContentIndex of a destination folder, loading it on first use.
+
+    :param folder: Destination folder.
+    :return: ContentIndex.
+    """
+    with _content_indexes_lock:
+        index = _content_indexes.get(folder)
+        if index is None:
+            index = _content_indexes[folder] = ContentIndex(folder)
+        return index
+
+
+def save_content_indexes():
+    """
+    Persist every content index changed since it was last saved.
+    """
+    with _content_indexes_lock:
+        indexes = list(_content_indexes.values())
+    for index in indexes:
+        try:
+            index.save()
+        except OSError:
+            # The index is only an optimization; it is rebuilt lazily next time
+            pass
+
+
+def same_content(destination_path, size, digest):
+    """
+    Check whether the file at a destination path has the given size and content hash. Only files of
+    equal size are hashed, and their hash comes from the folder's ContentIndex while still valid.
+
+    :param destination_path: Path of the file.
+    :param size: Expected size in bytes.
+    :param digest: Expected BLAKE2b hex digest.
+    :return: True if the file exists with that content.
+    """
+    try:
+        stat = os.stat(destination_path)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != size:
+        return False
+    folder, name = os.path.split(destination_path)
+    return content_index(folder).digest(name, destination_path, stat) == digest
+
+
+def record_content(destination_path, digest=None):
+    """
+    Add a file just written to a destination folder to that folder's ContentIndex.
+
+    :param destination_path: Path of the file.
+    :param digest: Its content hash, if known.
+    """
+    folder, name = os.path.split(destination_path)
+    content_index(folder).remember(name, os.stat(destination_path), digest)
+
+
+# Bundle formats of --archive; tar.zst needs Python 3.14 or the zstandard package
+ARCHIVE_FORMATS = ('zip', 'tar.zst')
+
+# zstd skippable frames (ignored by decompressors) holding a tar.zst bundle's index and its footer
+ZSTD_INDEX_MAGIC = 0x184D2A50
+ZSTD_FOOTER_MAGIC = 0x184D2A51
+ZSTD_FOOTER = struct.Struct('<IIQ')
+
+
+def tar_zst_index(path):
+    """
+    Read the member index of a tar.zst bundle from its footer, without decompressing anything.
+
+    :param path: Path of the bundle.
+    :return: Dictionary of member name -> [frame offset, frame length, size, tar header length].
+    """
+    with open(path, 'rb') as bundle:
+        bundle.seek(-ZSTD_FOOTER.size, os.SEEK_END)
+        magic, _, index_offset = ZSTD_FOOTER.unpack(bundle.read(ZSTD_FOOTER.size))
+        if magic != ZSTD_FOOTER_MAGIC:
+            raise ValueError(f'{path} has no bundle index')
+        bundle.seek(index_offset)
+        magic, length = struct.unpack('<II', bundle.read(8))
+        if magic != ZSTD_INDEX_MAGIC:
+            raise ValueError(f'{path} has a damaged bundle index')
+        return json.loads(bundle.read(length))['members']
+
+
+def zip_journal_path(bundle):
+    """
+    :param bundle: Path of a zip bundle.
+    :return: Path of the journal kept beside it while members are appended to it.
+    """
+    folder, name = os.path.split(bundle)
+    return os.path.join(folder, '.' + name + '.append')
+
+
+def recover_zip(bundle):
+    """
+    Roll back an append to a zip bundle that was interrupted, if there was one. Appending overwrites
+    the bundle's central directory, so it is saved in the journal first, with its offset; putting it
+    back and truncating the bundle after it restores the bundle as it was before the append.
+
+    :param bundle: Path of a zip bundle.
+    """
+    journal_path = zip_journal_path(bundle)
+    try:
+        with open(journal_path, 'rb') as journal:
+            saved = journal.read()
+    except FileNotFoundError:
+        return
+    if len(saved) > 8 and os.path.exists(bundle):
+        offset, = struct.unpack('<Q', saved[:8])
+        with open(bundle, 'r+b') as output:
+            output.seek(offset)
+            output.write(saved[8:])
+            output.truncate()
+            os.fsync(output.fileno())
+        logger.warning('Rolled back an interrupted append to %s', bundle)
+    os.unlink(journal_path)
+
+
+def bundle_members(path):
+    """
+    List the members of an archive bundle and their sizes, from its index.
+
+    :param path: Path of a .zip or .tar.zst bundle.
+    :return: Dictionary of member name -> size in bytes.
+    """
+    if path.endswith('.zip'):
+        recover_zip(path)
+        with zipfile.ZipFile(path) as bundle:
+            return {info.filename: info.file_size for info in bundle.infolist()}
+    return {name: entry[2] for name, entry in tar_zst_index(path).items()}
+
+
+# Dates inside new file names (e.g. ..._14Jun2024sysdate15Jun2024.xlsx)
+NAME_DATE_PATTERN = re.compile(r'\d{2}[A-Z][a-z]{2}\d{4}')
+NAME_SYSDATE_PATTERN = re.compile(r'sysdate(\d{2}[A-Z][a-z]{2}\d{4})')
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    report_type TEXT COLLATE NOCASE,
+    branch TEXT,
+    rptdate TEXT,
+    sysdate TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    blake2b TEXT,
+    filed_at REAL NOT NULL,
+    member TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (path, member)
+);
+CREATE INDEX IF NOT EXISTS reports_by_date ON reports (rptdate, report_type, branch);
+CREATE INDEX IF NOT EXISTS reports_by_type ON reports (report_type, branch, rptdate);
+CREATE INDEX IF NOT EXISTS reports_by_branch ON reports (branch, rptdate);
+"""
+
+
+@lru_cache(maxsize=4096)
+def iso_report_date(report_date):
+    """
+    :param report_date: Date as 14Jun2024 or 2024-06-14, or None.
+    :return: The date as 2024-06-14, or None if it is missing or not a date.
+    """
+    try:
+        return datetime.strptime(normalize_report_date(report_date), REPORT_DATE_FORMAT).date().isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+class ReportCatalog:
+    def __init__(self, path):
+        """
+        SQLite catalog of filed reports: one row per file with its report type (route prefix), branch
+        (captured suffix), RPTDATE, SYSDATE, size, hash and path, indexed for lookups by date, type
+        and branch. Each thread gets its own connection; the database runs in WAL mode so the CLI and
+        the EOD service can share it.
+
+        :param path: Path of the database file.
+        """
+        self.path = path
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.migrate()
+        self.connection().executescript(CATALOG_SCHEMA)
+
+    def connection(self):
+        """
+        :return: This thread's connection to the catalog.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def migrate(self):
+        """
+        Upgrade a catalog created before bundled reports were catalogued, whose rows are keyed by path
+        alone: the table is rebuilt with the member column in its primary key.
+        """
+        connection = self.connection()
+
+        def columns():
+            return [row[1] for row in connection.execute('PRAGMA table_info(reports)')]
+        if 'member' in columns() or not columns():
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have upgraded it meanwhile
+            if 'member' not in columns():
+                connection.execute('ALTER TABLE reports RENAME TO reports_by_path')
+                for index in ('reports_by_date', 'reports_by_type', 'reports_by_branch'):
+                    connection.execute(f'DROP INDEX IF EXISTS {index}')
+                for statement in CATALOG_SCHEMA.split(';'):
+                    connection.execute(statement)
+                connection.execute("INSERT INTO reports SELECT *, '' FROM reports_by_path")
+                connection.execute('DROP TABLE reports_by_path')
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def entry(router, path, stat, digest=None, report_date=None, member=''):
+        """
+        Build the catalog row of a filed report.
+
+        :param router: PrefixRouter giving the report type and branch of the file name.
+        :param path: Path of the file, or of the bundle holding it.
+        :param stat: os.stat result of the file (for a bundle member, its size and the bundle's mtime).
+        :param digest: BLAKE2b hex digest of its content, if known.
+        :param report_date: Its report date; by default the first date in its name.
+        :param member: Its member name in the bundle at path, or '' for a loose file.
+        :return: Tuple of the row's values, in column order.
+        """
+        name = os.path.basename(member or path)
+        rule, branch = router.classify(name)
+        report_type = router.rules[rule].prefix.rstrip('_ ') if rule is not None else None
+        if report_date is None:
+            dates = NAME_DATE_PATTERN.findall(name)
+            report_date = dates[0] if dates else None
+        sysdate = NAME_SYSDATE_PATTERN.search(name)
+        return (os.path.abspath(path), name, report_type, branch, iso_report_date(report_date),
+                iso_report_date(sysdate and sysdate.group(1)), stat.st_size, stat.st_mtime_ns, digest, time.time(), member)
+
+    def record(self, entries):
+        """
+        Add or update catalog rows, in one transaction.
+
+        :param entries: Rows built by entry().
+        """
+        with metrics.timed('catalog'), self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+
+    def archive(self, members):
+        """
+        Point the rows of loose files that were deleted once bundled at their copies in the bundles.
+
+        :param members: (path of the deleted file, bundle path, member name) of each file.
+        """
+        with metrics.timed('catalog'), self.connection() as connection:
+            connection.executemany("UPDATE OR REPLACE reports SET path = ?, member = ? WHERE path = ? AND member = ''",
+                                   [(os.path.abspath(bundle), member, os.path.abspath(path)) for path, bundle, member in members])
+
+    def query(self, rptdate=None, date_from=None, date_to=None, report_type=None, branch=None, name=None, limit=100):
+        """
+        Look up filed reports. Every criterion given must match.
+
+        :param rptdate: Report date, as 14Jun2024 or 2024-06-14.
+        :param date_from: Earliest report date.
+        :param date_to: Latest report date.
+        :param report_type: Report type (route prefix without its trailing '_', e.g. Balancesheet_consolidated), any case.
+        :param branch: Branch suffix, e.g. 003.
+        :param name: Substring of the file name.
+        :param limit: Maximum number of rows returned.
+        :return: List of row dictionaries, newest report date first.
+        :raises ValueError: If a date cannot be parsed.
+        """
+        clauses, values = [], []
+        for column, operator, value in (('rptdate', '=', rptdate), ('rptdate', '>=', date_from), ('rptdate', '<=', date_to)):
+            if value:
+                iso = iso_report_date(value)
+                if iso is None:
+                    raise ValueError(f'Invalid date {value!r}')
+                clauses.append(f'{column} {operator} ?')
+                values.append(iso)
+        if report_type:
+            clauses.append('report_type = ?')
+            values.append(report_type)
+        if branch:
+            clauses.append('branch = ?')
+            values.append(branch)
+        if name:
+            clauses.append("instr(lower(name), lower(?)) > 0")
+            values.append(name)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        with metrics.timed('catalog'):
+            rows = self.connection().execute(
+                f'SELECT * FROM reports{where} ORDER BY rptdate DESC, path LIMIT ?', values + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def rebuild(self, base_directory, router, batch_size=1000):
+        """
+        Replace the catalog rows under a base directory with what is on disk. The tree is streamed with
+        os.scandir, so memory use does not grow with it. Hashes are taken from each folder's content
+        index where its entry is still valid, and left empty otherwise rather than reading every file.
+        Reports kept only in an archive bundle (their loose copy pruned) are catalogued as members of
+        the bundle, from its index.
+
+        :param base_directory: Root of the destination tree.
+        :param router: PrefixRouter of the tree.
+        :param batch_size: Rows inserted per executemany call.
+        :return: Number of reports catalogued.
+        """
+        root = os.path.abspath(base_directory)
+        count = 0
+        connection = self.connection()
+        with metrics.timed('catalog'), connection:
+            # Every path under the root sorts between root + sep and root + the next character
+            connection.execute('DELETE FROM reports WHERE path > ? AND path < ?',
+                               (root + os.sep, root + chr(ord(os.sep) + 1)))
+            batch = []
+            folders = [root]
+            while folders:
+                folder = folders.pop()
+                hashes = read_content_index(folder)
+                try:
+                    with os.scandir(folder) as entries:
+                        for entry in entries:
+                            if entry.name.startswith('.'):
+                                continue
+                            if entry.is_dir(follow_symlinks=False):
+                                folders.append(entry.path)
+                            elif entry.name.lower().endswith(REPORT_EXTENSIONS):
+                                stat = entry.stat()
+                                known = hashes.get(entry.name)
+                                digest = None
+                                if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                                    digest = known['blake2b']
+                                batch.append(self.entry(router, entry.path, stat, digest))
+                            elif entry.name.endswith(tuple('.' + archive_format for archive_format in ARCHIVE_FORMATS)):
+                                batch.extend(self.bundled_entries(router, entry.path, entry.stat()))
+                            if len(batch) >= batch_size:
+                                connection.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                                count += len(batch)
+                                batch = []
+                except OSError as e:
+                    logger.warning('Skipping %s: %s', folder, e)
+            connection.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+            count += len(batch)
+        return count
+
+    def bundled_entries(self, router, bundle, stat):
+        """
+        Build the catalog rows of the reports of an archive bundle whose loose copies are gone.
+
+        :param router: PrefixRouter of the tree.
+        :param bundle: Path of the bundle.
+        :param stat: os.stat result of the bundle.
+        :return: List of rows built by entry().
+        """
+        try:
+            members = bundle_members(bundle)
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            logger.warning('Skipping the bundle %s: %s', bundle, e)
+            return []
+        folder = os.path.dirname(bundle)
+        return [self.entry(router, bundle, SimpleNamespace(st_size=size, st_mtime_ns=stat.st_mtime_ns), member=member)
+                for member, size in members.items()
+                if member.lower().endswith(REPORT_EXTENSIONS) and not os.path.exists(os.path.join(folder, *member.split('/')))]
+
+
+class ReportRenamer:
+    def __init__(self, config, additional_info, base_destination_directory):
+        """
+        Naming and routing shared by the CLI's and the service's FileRenamerMover.
+
+        :param config: ReportConfig holding the file mapping (old file names to new name templates with
+                       placeholders for additional info) and the routing rules.
+        :param additional_info: Dictionary containing variables to be used in the new file names.
+        :param base_destination_directory: Root of the destination tree.
+        :raises ValueError: If additional_info lacks a value used by a name template.
+        """
+        self.config = config
+        self.file_mapping = config.file_mapping
+        self.additional_info = additional_info
+        self.name_templates = config.name_templates
+        self.check_placeholders()
+        self.base_destination_directory = base_destination_directory
+        self.router = config.router(self.base_destination_directory)
+
+    def check_placeholders(self):
+        """
+        Make sure every placeholder used by the mapping has a value, so a bad mapping fails when it is
+        loaded rather than partway through a batch.
+
+        :raises ValueError: If additional_info lacks a value used by a name template.
+        """
+        missing = self.config.required_fields - self.additional_info.keys()
+        if missing:
+            raise ValueError(f"Missing values for name template placeholders: {', '.join(sorted(missing))}")
+
+    def render_name(self, old_name):
+        """
+        Build the new name of a file from its precompiled template.
+
+        :param old_name: Name of the file as listed in the mapping.
+        :return: The new file name.
+        """
+        with metrics.timed('render'):
+            return self.name_templates[old_name].render(self.additional_info)
+
+    def match_source(self, name, additional_info=None):
+        """
+        Work out the new name of a source file from the first exact name or pattern rule matching it.
+
+        :param name: Name of the file in the source directory or of the upload.
+        :param additional_info: Values overriding the renamer's additional_info, e.g. for one date
+                                group of a manifest.
+        :return: Tuple of (rule index, new file name, report date), or None if no rule matches. The
+                 report date is the file's RPTDATE: captured from its name, or from additional_info.
+        """
+        with metrics.timed('match'):
+            match = self.config.source_matcher.match(name)
+        if match is None:
+            return None
+        index, captures = match
+        template = self.config.source_matcher.rules[index].template
+        additional_info = additional_info or self.additional_info
+        if captures:
+            # Values captured from the file name take precedence over additional_info
+            values = dict(additional_info)
+            for field, value in captures.items():
+                values[field] = normalize_report_date(value) if field in DATE_FIELDS else value
+        else:
+            values = additional_info
+        with metrics.timed('render'):
+            new_name = template.render(values)
+        return index, new_name, values.get('RPTDATE')
+
+    def determine_destination_folder(self, new_name, report_date=None):
+        """
+        Determine the destination folder based on the new file name.
+
+        :param new_name: The new name of the file.
+        :param report_date: The file's report date; defaults to the RPTDATE in additional_info.
+        :return: The path to the destination folder.
+        """
+        with metrics.timed('route'):
+            return self.router.route(new_name, report_date or self.additional_info.get('RPTDATE'))
+
+    def route_many(self, names, report_dates=None):
+        """
+        Determine the destination folders for a batch of new file names.
+
+        :param names: List of new file names.
+        :param report_dates: Optional list of the files' report dates; defaults to the RPTDATE in
+                             additional_info for every file.
+        :return: List of destination folder paths, in the same order as the names.
+        """
+        if report_dates is None:
+            report_dates = [self.additional_info.get('RPTDATE')] * len(names)
+        with metrics.timed('route'):
+            return self.router.route_many(names, report_dates)
+
+    def prepare_destination_folders(self, additional_info=None):
+        """
+        Create the whole destination hierarchy for a report date in one pass: every folder the
+        mapping's exact file names route to (e.g. P&L/000-006 and BALANCE SHEET/000-006).
+
+        :param additional_info: Values giving the report date (default: the renamer's additional_info).
+        :return: Sorted list of the folders.
+        """
+        additional_info = additional_info or self.additional_info
+        new_names = [rule.template.render(additional_info)
+                     for rule in self.config.source_matcher.rules if rule.filename is not None]
+        folders = sorted(set(self.route_many(new_names, [additional_info.get('RPTDATE')] * len(new_names))))
+        for folder in folders:
+            directory_cache.ensure(folder)
+        return folders
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Keep the catalog, lock files and content indexes of the tests out of the real state folder; set
+# before renaming_core is imported, which reads it once
+os.environ['REPORTS_STATE_DIR'] = tempfile.mkdtemp(prefix='reports-state-')
+
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+sys.path.insert(0, os.path.join(REPO, 'EOD'))
+sys.path.insert(0, REPO)
+
+import renaming_core  # noqa: E402
+from benchmark import write_workbook  # noqa: E402
+
+
+@pytest.fixture
+def config():
+    return renaming_core.load_report_config(os.path.join(REPO, 'reports.json'))
+
+
+@pytest.fixture
+def workbook():
+    """
+    Write a small valid .xlsx file whose content is unique to its stamp.
+    """
+    def write(path, stamp=None, size=4096):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_workbook(path, size, (stamp or os.path.basename(path)).encode(), os.urandom(1024))
+        return path
+    return write
+
+
+@pytest.fixture
+def downloads(tmp_path):
+    path = tmp_path / 'Downloads'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def onedrive(tmp_path, monkeypatch):
+    """
+    Destination tree the CLI files into instead of the user's OneDrive.
+    """
+    import renamingV7
+    path = tmp_path / 'OneDrive'
+    monkeypatch.setattr(renamingV7, 'default_destination_directory', lambda username: str(path))
+    monkeypatch.setattr(renamingV7.FileRenamerMover, 'get_logged_in_username', lambda self: 'tester')
+    return path
+
+
+@pytest.fixture
+def renamer(config, downloads, onedrive):
+    """
+    Build a CLI FileRenamerMover on the Downloads and OneDrive folders of the test.
+    """
+    import renamingV7
+
+    def build(rptdate='14Jun2024', sysdate='15Jun2024', **options):
+        options.setdefault('max_workers', 1)
+        return renamingV7.FileRenamerMover(config, str(downloads), {'RPTDATE': rptdate, 'SYSDATE': sysdate}, **options)
+    return build
@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import zipfile
+
+import pytest
+
+import renaming_core
+import renamingV7
+
+
+def test_zip_bundle_appends_new_members_in_place(tmp_path):
+    bundler = renamingV7.ArchiveBundler(str(tmp_path))
+    bundle = str(tmp_path / 'FINANCE_2024-06-14.zip')
+    first, second = tmp_path / 'first.xlsx', tmp_path / 'second.xlsx'
+    first.write_bytes(b'first' * 1000)
+    second.write_bytes(b'second' * 1000)
+
+    bundler.write_zip(bundle, {'P&L/first.xlsx': str(first)})
+    inode = os.stat(bundle).st_ino
+    bundler.write_zip(bundle, {'P&L/second.xlsx': str(second)})
+    assert os.stat(bundle).st_ino == inode
+    assert renamingV7.bundle_members(bundle) == {'P&L/first.xlsx': 5000, 'P&L/second.xlsx': 6000}
+    assert not os.path.exists(renamingV7.zip_journal_path(bundle))
+
+    first.write_bytes(b'replaced')
+    bundler.write_zip(bundle, {'P&L/first.xlsx': str(first)})
+    assert os.stat(bundle).st_ino != inode
+    assert b''.join(renamingV7.read_bundle_member(bundle, 'P&L/first.xlsx')) == b'replaced'
+    assert renamingV7.bundle_members(bundle)['P&L/second.xlsx'] == 6000
+
+
+def test_interrupted_zip_append_is_rolled_back(tmp_path, monkeypatch):
+    bundler = renamingV7.ArchiveBundler(str(tmp_path))
+    bundle = str(tmp_path / 'FINANCE_2024-06-14.zip')
+    report = tmp_path / 'report.xlsx'
+    report.write_bytes(b'report' * 1000)
+    bundler.write_zip(bundle, {'P&L/report.xlsx': str(report)})
+    with open(bundle, 'rb') as original:
+        before = original.read()
+
+    def crash(archive, members):
+        # Die halfway through a member, before the central directory is written again
+        archive.fp.write(b'half a member')
+        archive.fp = None
+        raise KeyboardInterrupt
+    monkeypatch.setattr(bundler, 'zip_files', crash)
+    with pytest.raises(KeyboardInterrupt):
+        bundler.write_zip(bundle, {'P&L/other.xlsx': str(report)})
+    with pytest.raises(zipfile.BadZipFile):
+        zipfile.ZipFile(bundle)
+    assert os.path.exists(renamingV7.zip_journal_path(bundle))
+
+    assert renamingV7.bundle_members(bundle) == {'P&L/report.xlsx': 6000}
+    with open(bundle, 'rb') as recovered:
+        assert recovered.read() == before
+    assert not os.path.exists(renamingV7.zip_journal_path(bundle))
+    with zipfile.ZipFile(bundle) as archive:
+        assert archive.testzip() is None
+
+
+def test_pruned_reports_stay_catalogued_in_their_bundle(tmp_path, config, workbook):
+    base = tmp_path / 'OneDrive'
+    folder = base / 'FINANCE' / '2024' / 'JUNE' / 'P&L' / '006'
+    name = 'P&L_CONSOLIDATED_006_14Jun2024sysdate15Jun2024.xlsx'
+    loose = workbook(str(folder / name))
+    router = config.router(str(base))
+    catalog = renaming_core.ReportCatalog(str(tmp_path / 'catalog.sqlite3'))
+    catalog.record([catalog.entry(router, loose, os.stat(loose))])
+
+    bundler = renamingV7.ArchiveBundler(str(base), keep_days=1, catalog=catalog)
+    operation = renamingV7.PlannedMove('Profit N Loss 006_PL_CONSOLIDATED.xlsx', name, str(folder), loose, None, '14Jun2024')
+    bundler.add([operation], [{'moved_to': loose}])
+    assert not os.path.exists(loose)
+
+    bundle = str(base / 'FINANCE' / '2024' / 'JUNE' / 'FINANCE_2024-06-14.zip')
+    expected = [(bundle, 'P&L/006/' + name, name, '2024-06-14')]
+    rows = catalog.query(name='P&L_CONSOLIDATED_006')
+    assert [(row['path'], row['member'], row['name'], row['rptdate']) for row in rows] == expected
+
+    assert catalog.rebuild(str(base), router) == 1
+    rows = catalog.query(name='P&L_CONSOLIDATED_006')
+    assert [(row['path'], row['member'], row['name'], row['rptdate']) for row in rows] == expected
+
+
+def test_catalog_keyed_by_path_alone_is_upgraded(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite3')
+    with sqlite3.connect(path) as connection:
+        connection.executescript(renaming_core.CATALOG_SCHEMA.replace("path TEXT NOT NULL", "path TEXT PRIMARY KEY")
+                                 .replace(",\n    member TEXT NOT NULL DEFAULT '',\n    PRIMARY KEY (path, member)", ''))
+        connection.execute("INSERT INTO reports VALUES ('/r/a.xlsx', 'a.xlsx', NULL, NULL, '2024-06-14', NULL, 1, 2, NULL, 3)")
+    connection.close()
+
+    catalog = renaming_core.ReportCatalog(path)
+    assert [row['member'] for row in catalog.query()] == ['']
+    catalog.archive([('/r/a.xlsx', '/r/bundle.zip', 'a.xlsx')])
+    assert [(row['path'], row['member']) for row in catalog.query()] == [('/r/bundle.zip', 'a.xlsx')]
+
+
+def test_tar_zst_members_are_read_through_the_index(tmp_path):
+    try:
+        bundler = renamingV7.ArchiveBundler(str(tmp_path), 'tar.zst')
+    except RuntimeError:
+        pytest.skip('needs Python 3.14 or the zstandard package')
+    bundle = str(tmp_path / 'FINANCE_2024-06-14.tar.zst')
+    first, second = tmp_path / 'first.xlsx', tmp_path / 'second.xlsx'
+    first.write_bytes(b'first' * 1000)
+    second.write_bytes(b'second' * 1000)
+    bundler.write_tar_zst(bundle, {'P&L/first.xlsx': str(first)})
+    bundler.write_tar_zst(bundle, {'P&L/second.xlsx': str(second)})
+
+    assert renaming_core.bundle_members(bundle) == {'P&L/first.xlsx': 5000, 'P&L/second.xlsx': 6000}
+    assert b''.join(renamingV7.read_bundle_member(bundle, 'P&L/second.xlsx')) == b'second' * 1000
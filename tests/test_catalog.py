@@ -0,0 +1,48 @@
+import pytest
+
+import renaming_core
+
+
+@pytest.fixture
+def filed(renamer, downloads, workbook, tmp_path):
+    """
+    File three reports of two dates with a catalog, and return the renamer.
+    """
+    catalog = renaming_core.ReportCatalog(str(tmp_path / 'catalog.sqlite3'))
+    for rptdate, names in (('14Jun2024', ['SKUK_Reports.xlsx', 'Profit N Loss 006_PL_CONSOLIDATED.xlsx']),
+                           ('01Jul2024', ['Profit N Loss 004_PL_CONSOLIDATED.xlsx'])):
+        for name in names:
+            workbook(str(downloads / name), rptdate + name)
+        mover = renamer(rptdate=rptdate, sysdate=rptdate)
+        mover.catalog = catalog
+        assert all('moved_to' in result for result in mover.rename_and_move_files())
+    return mover
+
+
+def names(rows):
+    return sorted(row['name'] for row in rows)
+
+
+def test_catalog_lookups(filed):
+    catalog = filed.catalog
+    assert names(catalog.query(report_type='p&l_consolidated')) == [
+        'P&L_CONSOLIDATED_004_01Jul2024sysdate01Jul2024.xlsx', 'P&L_CONSOLIDATED_006_14Jun2024sysdate14Jun2024.xlsx']
+    assert names(catalog.query(branch='004')) == ['P&L_CONSOLIDATED_004_01Jul2024sysdate01Jul2024.xlsx']
+    assert names(catalog.query(rptdate='2024-06-14')) == [
+        'P&L_CONSOLIDATED_006_14Jun2024sysdate14Jun2024.xlsx', 'SKUK_Report_14Jun2024sysdate14Jun2024.xlsx']
+    assert names(catalog.query(date_from='15Jun2024', date_to='2024-07-31')) == ['P&L_CONSOLIDATED_004_01Jul2024sysdate01Jul2024.xlsx']
+    assert names(catalog.query(name='skuk')) == ['SKUK_Report_14Jun2024sysdate14Jun2024.xlsx']
+    assert len(catalog.query(limit=2)) == 2
+    with pytest.raises(ValueError):
+        catalog.query(rptdate='June')
+
+
+def test_rebuild_restores_rows_and_hashes(filed):
+    catalog = filed.catalog
+    before = {row['path']: row['blake2b'] for row in catalog.query()}
+    assert all(before.values())
+    with catalog.connection() as connection:
+        connection.execute('DELETE FROM reports')
+
+    assert catalog.rebuild(filed.base_destination_directory, filed.router) == 3
+    assert {row['path']: row['blake2b'] for row in catalog.query()} == before
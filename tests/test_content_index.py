@@ -0,0 +1,65 @@
+import json
+import os
+
+from renaming_core import LEGACY_CONTENT_INDEX_NAME, ContentIndex, content_index_path, read_content_index
+
+
+def test_filing_writes_no_index_into_the_destination_tree(renamer, downloads, onedrive, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    [result] = renamer().rename_and_move_files()
+    folder = os.path.dirname(result['moved_to'])
+    assert os.listdir(folder) == [os.path.basename(result['moved_to'])]
+    assert os.path.basename(result['moved_to']) in read_content_index(folder)
+
+
+def test_saves_of_two_processes_are_merged(tmp_path):
+    folder = tmp_path / 'reports'
+    folder.mkdir()
+    for name in ('a.xlsx', 'b.xlsx'):
+        (folder / name).write_bytes(name.encode())
+    first, second = ContentIndex(str(folder)), ContentIndex(str(folder))
+    first.remember('a.xlsx', os.stat(folder / 'a.xlsx'), 'aa')
+    second.remember('b.xlsx', os.stat(folder / 'b.xlsx'), 'bb')
+    first.save()
+    second.save()
+    entries = read_content_index(str(folder))
+    assert {name: entry['blake2b'] for name, entry in entries.items()} == {'a.xlsx': 'aa', 'b.xlsx': 'bb'}
+
+
+def test_legacy_index_is_imported_and_removed(tmp_path):
+    folder = tmp_path / 'reports'
+    folder.mkdir()
+    (folder / 'a.xlsx').write_bytes(b'a')
+    stat = os.stat(folder / 'a.xlsx')
+    legacy = folder / LEGACY_CONTENT_INDEX_NAME
+    legacy.write_text(json.dumps({'a.xlsx': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'blake2b': 'aa'}}))
+
+    index = ContentIndex(str(folder))
+    assert index.digest('a.xlsx', str(folder / 'a.xlsx'), stat) == 'aa'
+    (folder / 'b.xlsx').write_bytes(b'b')
+    index.remember('b.xlsx', os.stat(folder / 'b.xlsx'), 'bb')
+    index.save()
+
+    assert not legacy.exists()
+    assert os.path.exists(content_index_path(str(folder)))
+    assert sorted(read_content_index(str(folder))) == ['a.xlsx', 'b.xlsx']
+
+
+def test_legacy_index_is_kept_unless_imported(tmp_path):
+    folder = tmp_path / 'reports'
+    folder.mkdir()
+    (folder / 'a.xlsx').write_bytes(b'a')
+    legacy = folder / LEGACY_CONTENT_INDEX_NAME
+    legacy.write_text('{"a.xlsx": ')
+
+    # An unreadable legacy index is not imported
+    index = ContentIndex(str(folder))
+    index.remember('a.xlsx', os.stat(folder / 'a.xlsx'), 'aa')
+    index.save()
+    assert legacy.exists()
+
+    # Nor is one that appears once the local index exists
+    legacy.write_text(json.dumps({}))
+    index.remember('a.xlsx', os.stat(folder / 'a.xlsx'), 'ab')
+    index.save()
+    assert legacy.exists()
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import renaming_core
+from renaming_core import TransferError, copy_across_devices, copy_file_data
+
+
+def copy(source_path, target_path):
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        result = copy_file_data(source, target)
+    with open(target_path, 'rb') as target:
+        return result, target.read()
+
+
+def test_copy_file_data_copies_everything(tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    (tmp_path / 'source').write_bytes(data)
+    (copied, _), written = copy(tmp_path / 'source', tmp_path / 'target')
+    assert copied == len(data)
+    assert written == data
+
+
+def test_zero_at_offset_zero_falls_back_to_buffered_copy(tmp_path, monkeypatch):
+    # Some mounts return 0 from copy_file_range and sendfile instead of failing with ENOSYS/EXDEV
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    data = os.urandom(100000)
+    (tmp_path / 'source').write_bytes(data)
+    (copied, method), written = copy(tmp_path / 'source', tmp_path / 'target')
+    assert (copied, method) == (len(data), 'buffered')
+    assert written == data
+
+
+def test_empty_file(tmp_path):
+    (tmp_path / 'source').write_bytes(b'')
+    (copied, _), written = copy(tmp_path / 'source', tmp_path / 'target')
+    assert copied == 0
+    assert written == b''
+
+
+def test_short_copy_keeps_the_source(tmp_path, monkeypatch):
+    def short_copy(source, target):
+        target.write(source.read(10))
+        return 10, 'short'
+
+    monkeypatch.setattr(renaming_core, 'copy_file_data', short_copy)
+    source = tmp_path / 'report.xlsx'
+    source.write_bytes(b'x' * 1000)
+    destination = tmp_path / 'out' / 'report.xlsx'
+    destination.parent.mkdir()
+    with pytest.raises(TransferError):
+        copy_across_devices(str(source), str(destination))
+    assert source.read_bytes() == b'x' * 1000
+    assert not destination.exists()
+    assert os.listdir(destination.parent) == []
+
+
+def test_copy_across_devices_moves_the_file(tmp_path):
+    source = tmp_path / 'report.xlsx'
+    source.write_bytes(b'report' * 1000)
+    destination = tmp_path / 'out' / 'report.xlsx'
+    destination.parent.mkdir()
+    copied, _ = copy_across_devices(str(source), str(destination))
+    assert copied == 6000
+    assert not source.exists()
+    assert destination.read_bytes() == b'report' * 1000
@@ -0,0 +1,201 @@
+import io
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip('flask')
+
+import renaming_core  # noqa: E402
+
+
+@pytest.fixture
+def eod(tmp_path, monkeypatch):
+    """
+    The web service, configured after import onto folders of the test. Its config files a
+    Sample.xlsx upload under a name that carries only the SYSDATE.
+    """
+    import script_rename
+    reports_config = tmp_path / 'reports.json'
+    reports_config.write_text(json.dumps({
+        'file_mapping': {'Sample.xlsx': 'SKUK_Report_sysdate{SYSDATE}.xlsx'},
+        'routes': [{'prefix': 'SKUK_Report_', 'destination': ['FINANCE', '{YEAR}', '{MONTH}', 'SUKUK'],
+                    'capture_suffix': False}],
+    }))
+    uploads = tmp_path / 'uploads'
+    app = script_rename.app
+    settings = {'REPORTS_CONFIG': str(reports_config), 'DESTINATION_ROOT': str(tmp_path / 'OneDrive'),
+                'CATALOG_PATH': str(tmp_path / 'catalog.sqlite3'), 'UPLOAD_FOLDER': str(uploads),
+                'JOBS_FOLDER': str(uploads / '.jobs'), 'LOCK_FOLDER': str(uploads / '.locks'), 'SWEEP_INTERVAL': 0,
+                'VALIDATE_WORKBOOKS': False, 'ASYNC_JOBS': False}
+    for key, value in settings.items():
+        monkeypatch.setitem(app.config, key, value)
+    monkeypatch.setattr(app, 'extensions', {})
+    return script_rename
+
+
+def upload(client, workbook, path):
+    with open(workbook(str(path)), 'rb') as data:
+        return client.post('/process_files', content_type='multipart/form-data',
+                           data={'rptdate': '2024-06-30', 'sysdate': '2024-07-01', 'files': (io.BytesIO(data.read()), 'Sample.xlsx')})
+
+
+def wait_for(client, job_id):
+    for _ in range(100):
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] == 'done':
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'Job {job_id} did not finish')
+
+
+def test_async_job_catalogs_the_report_date(eod, workbook, tmp_path, monkeypatch):
+    monkeypatch.setitem(eod.app.config, 'ASYNC_JOBS', True)
+    client = eod.app.test_client()
+    response = upload(client, workbook, tmp_path / 'Sample.xlsx')
+    assert response.status_code == 202
+
+    job = wait_for(client, response.get_json()['job_id'])
+    assert [entry['status'] for entry in job['files']] == ['moved']
+    rows = eod.get_engine().catalog.query(name='SKUK_Report_')
+    assert [(row['rptdate'], row['sysdate']) for row in rows] == [('2024-06-30', '2024-07-01')]
+
+
+def test_async_job_prepares_the_month_folders(eod, workbook, tmp_path, monkeypatch):
+    reports_config = tmp_path / 'reports.json'
+    config = json.loads(reports_config.read_text())
+    config['file_mapping']['Balance.xlsx'] = 'CUSTOMER BALANCE_{RPTDATE}.xlsx'
+    config['routes'].append({'prefix': 'CUSTOMER BALANCE_', 'destination': ['CREDIT', '{YEAR}', '{MONTH}'],
+                             'capture_suffix': False})
+    reports_config.write_text(json.dumps(config))
+    monkeypatch.setitem(eod.app.config, 'ASYNC_JOBS', True)
+    client = eod.app.test_client()
+    wait_for(client, upload(client, workbook, tmp_path / 'Sample.xlsx').get_json()['job_id'])
+    assert (tmp_path / 'OneDrive' / 'CREDIT' / '2024' / 'JUNE').is_dir()
+
+
+def test_job_registry_is_built_from_the_config_on_first_use(eod, tmp_path, monkeypatch):
+    for key, value in {'MAX_JOBS': 1, 'JOB_TTL': 5, 'JOB_WORKERS': 2}.items():
+        monkeypatch.setitem(eod.app.config, key, value)
+    jobs, executor = eod.get_jobs()
+    assert (jobs.max_jobs, jobs.ttl, jobs.folder) == (1, 5, str(tmp_path / 'uploads' / '.jobs'))
+    assert executor._max_workers == 2
+    assert eod.get_jobs() == (jobs, executor)
+    assert jobs.create() is not None
+    assert jobs.create() is None
+
+
+def test_sweeper_spares_uploads_of_unfinished_jobs(eod, tmp_path):
+    staging = tmp_path / 'uploads'
+    staging.mkdir()
+    now = time.time()
+    staged = []
+    for age, name in enumerate('cba', 1):
+        path = staging / f'{name}.part'
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now - 1000 * age, now - 1000 * age))
+        staged.append(str(path))
+    oldest = staged[-1]
+    jobs, _ = eod.get_jobs()
+    job_id = jobs.create()
+    jobs.update(job_id, status='queued', files=[{'old': 'Sample.xlsx', 'status': 'queued', 'staged': oldest}])
+    assert 'staged' not in jobs.get(job_id)['files'][0]
+    # Seen from another worker process through the job's status file
+    assert eod.JobRegistry(10, 60, jobs.folder).staged_paths() == {oldest}
+
+    sweeper = eod.StagingSweeper(str(staging), max_age=3600, max_bytes=200, batch_size=10, pinned=jobs.staged_paths)
+    sweeper.tick(now)
+    sweeper.tick(now)
+    assert sorted(os.listdir(staging)) == ['.jobs', 'a.part', 'c.part']
+    assert sweeper.status()['reclaimed']['evicted_files'] == 1
+
+
+def test_sweeper_keeps_the_status_of_unfinished_jobs(eod, tmp_path):
+    jobs, _ = eod.get_jobs()
+    queued, done = jobs.create(), jobs.create()
+    jobs.update(done, status='done', finished=time.time())
+    long_ago = time.time() - 7200
+    for job_id in (queued, done):
+        os.utime(jobs.job_path(job_id), (long_ago, long_ago))
+    assert eod.JobRegistry(10, 60, jobs.folder).status_paths() == {jobs.job_path(queued)}
+
+    sweeper = eod.StagingSweeper(jobs.folder, max_age=3600, batch_size=10, pinned=jobs.status_paths)
+    sweeper.tick()
+    assert os.listdir(jobs.folder) == [queued + '.json']
+
+
+def test_only_one_worker_holds_the_sweeper_lock(eod, tmp_path):
+    lock_folder = tmp_path / 'uploads' / '.locks'
+    lock_folder.mkdir(parents=True)
+    fd = os.open(lock_folder / 'sweeper.lock', os.O_RDWR | os.O_CREAT)
+    try:
+        assert renaming_core.try_lock(fd)
+        assert not eod.hold_sweeper_lock()
+    finally:
+        os.close(fd)
+    assert eod.hold_sweeper_lock()
+    assert eod.hold_sweeper_lock()
+    os.close(eod.app.extensions.pop('sweeper_lock'))
+
+
+def test_upload_is_filed_and_catalogued(eod, workbook, tmp_path):
+    client = eod.app.test_client()
+    response = upload(client, workbook, tmp_path / 'Sample.xlsx')
+    assert response.status_code == 200
+    filed = tmp_path / 'OneDrive' / 'FINANCE' / '2024' / 'JUNE' / 'SUKUK' / 'SKUK_Report_sysdate01Jul2024.xlsx'
+    assert [result['moved_to'] for result in response.get_json()] == [str(filed)]
+    assert filed.exists()
+
+    reports = client.get('/reports', query_string={'rptdate': '30Jun2024', 'type': 'SKUK_Report'}).get_json()
+    assert [report['path'] for report in reports] == [str(filed)]
+    assert len(client.get('/reports', query_string={'limit': 0}).get_json()) == 1
+    assert client.get('/reports', query_string={'from': 'June'}).status_code == 400
+    assert 'eod_stage_seconds_count{stage="receive"}' in client.get('/metrics').get_data(as_text=True)
+
+
+def test_buffered_upload_is_deduplicated_and_catalogued(eod, workbook, tmp_path, monkeypatch):
+    monkeypatch.setitem(eod.app.config, 'STREAM_UPLOADS', False)
+    client = eod.app.test_client()
+    sample = workbook(str(tmp_path / 'Sample.xlsx'))
+    first, again = (upload(client, lambda path: path, sample).get_json() for _ in range(2))
+    filed = tmp_path / 'OneDrive' / 'FINANCE' / '2024' / 'JUNE' / 'SUKUK' / 'SKUK_Report_sysdate01Jul2024.xlsx'
+    assert [result.get('unchanged') for result in first + again] == [None, True]
+    assert os.listdir(tmp_path / 'uploads') == ['.locks']
+
+    digest = renaming_core.file_digest(str(filed))
+    assert renaming_core.read_content_index(str(filed.parent))[filed.name]['blake2b'] == digest
+    reports = client.get('/reports', query_string={'rptdate': '30Jun2024'}).get_json()
+    assert [(report['path'], report['blake2b']) for report in reports] == [(str(filed), digest)]
+
+
+def test_rejected_uploads_are_reported_per_file(eod, tmp_path, monkeypatch):
+    monkeypatch.setitem(eod.app.config, 'VALIDATE_WORKBOOKS', True)
+    client = eod.app.test_client()
+    response = client.post('/process_files', content_type='multipart/form-data', data={
+        'rptdate': '2024-06-30', 'sysdate': '2024-07-01',
+        'files': [(io.BytesIO(b'<html>Session expired</html>'), 'Sample.xlsx'),
+                  (io.BytesIO(b'PK'), 'Other.xlsx'), (io.BytesIO(b'text'), 'notes.txt')],
+    })
+    errors = [result['error'] for result in response.get_json()]
+    assert 'HTML' in errors[0]
+    assert errors[1:] == ['File not found in mapping', 'Only .xls and .xlsx files are allowed']
+    assert [names for _, _, names in os.walk(tmp_path / 'OneDrive') if names] == []
+
+
+def test_batch_files_each_group_under_its_date(eod, workbook, tmp_path):
+    client = eod.app.test_client()
+    manifest = {'groups': [{'name': 'june', 'rptdate': '2024-06-30', 'files': ['Sample.xlsx']},
+                           {'name': 'july', 'rptdate': '2024-07-31', 'sysdate': '2024-08-01', 'files': ['Sample.xlsx']}]}
+    with open(workbook(str(tmp_path / 'Sample.xlsx')), 'rb') as data:
+        content = data.read()
+    response = client.post('/process_batch', content_type='multipart/form-data', data={
+        'manifest': json.dumps(manifest),
+        'june': (io.BytesIO(content), 'Sample.xlsx'),
+        'july': (io.BytesIO(content), 'Sample.xlsx'),
+    })
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted((result['group'], os.path.relpath(result['moved_to'], tmp_path / 'OneDrive')) for result in results) == [
+        ('july', os.path.join('FINANCE', '2024', 'JULY', 'SUKUK', 'SKUK_Report_sysdate01Aug2024.xlsx')),
+        ('june', os.path.join('FINANCE', '2024', 'JUNE', 'SUKUK', 'SKUK_Report_sysdate30Jun2024.xlsx')),
+    ]
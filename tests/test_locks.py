@@ -0,0 +1,48 @@
+import os
+import threading
+import time
+
+import pytest
+
+import renaming_core
+from renaming_core import LockTimeoutError, destination_lock
+
+
+def hold_lock(path, lock_folder):
+    """
+    Lock the stripe of a path through a descriptor of its own, like another process would.
+    """
+    with destination_lock(path, lock_folder):
+        pass
+    [name] = os.listdir(lock_folder)
+    fd = os.open(os.path.join(lock_folder, name), os.O_RDWR)
+    if renaming_core.fcntl is not None:
+        renaming_core.fcntl.flock(fd, renaming_core.fcntl.LOCK_EX)
+    else:
+        renaming_core.msvcrt.locking(fd, renaming_core.msvcrt.LK_NBLCK, 1)
+    return fd
+
+
+def test_held_lock_times_out(tmp_path):
+    lock_folder = str(tmp_path / 'locks')
+    path = str(tmp_path / 'report.xlsx')
+    fd = hold_lock(path, lock_folder)
+    try:
+        started = time.monotonic()
+        with pytest.raises(LockTimeoutError, match='report.xlsx'):
+            with destination_lock(path, lock_folder, timeout=0.2):
+                pass
+        assert 0.2 <= time.monotonic() - started < 2
+    finally:
+        os.close(fd)
+    with destination_lock(path, lock_folder, timeout=0):
+        pass
+
+
+def test_lock_is_acquired_once_released(tmp_path):
+    lock_folder = str(tmp_path / 'locks')
+    path = str(tmp_path / 'report.xlsx')
+    fd = hold_lock(path, lock_folder)
+    threading.Timer(0.1, os.close, [fd]).start()
+    with destination_lock(path, lock_folder, timeout=5):
+        pass
@@ -0,0 +1,19 @@
+import renaming_core
+
+
+def test_stage_metrics_summary_and_prometheus():
+    metrics = renaming_core.StageMetrics()
+    metrics.observe('copy', 0.002)
+    metrics.observe('copy', 2.0)
+    metrics.add_bytes('copy', 4096)
+
+    summary = metrics.summary()
+    assert summary['bytes'] == {'copy': 4096}
+    assert (summary['stages']['copy']['count'], summary['stages']['copy']['max']) == (2, 2.0)
+    assert summary['stages']['copy']['buckets']['0.005'] == 1
+
+    lines = metrics.prometheus('eod').splitlines()
+    assert 'eod_stage_seconds_bucket{stage="copy",le="0.005"} 1' in lines
+    assert 'eod_stage_seconds_bucket{stage="copy",le="+Inf"} 2' in lines
+    assert 'eod_stage_seconds_count{stage="copy"} 2' in lines
+    assert 'eod_stage_bytes_total{stage="copy"} 4096' in lines
@@ -0,0 +1,98 @@
+import json
+import os
+
+import pytest
+
+import renamingV7
+
+SUKUK = os.path.join('FINANCE', '2024', 'JUNE', 'SUKUK', 'SKUK_Report_14Jun2024sysdate15Jun2024.xlsx')
+PL_006 = os.path.join('FINANCE', '2024', 'JUNE', 'P&L', '006', 'P&L_CONSOLIDATED_006_14Jun2024sysdate15Jun2024.xlsx')
+
+
+def test_dry_run_plans_without_moving(renamer, downloads, onedrive, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    workbook(str(downloads / 'Profit N Loss 006_PL_CONSOLIDATED.xlsx'))
+    workbook(str(onedrive / SUKUK), 'already filed')
+    (downloads / 'notes.xlsx').write_bytes(b'')
+
+    mover = renamer()
+    plan = mover.plan()
+    assert sorted(operation.destination_path for operation in plan.operations) == sorted([str(onedrive / SUKUK), str(onedrive / PL_006)])
+    assert [operation.destination_path for operation in plan.conflicts()] == [str(onedrive / SUKUK)]
+    assert plan.new_folders == [str((onedrive / PL_006).parent)]
+    assert plan.unmatched == ['notes.xlsx']
+
+    assert mover.rename_and_move_files(dry_run=True) == []
+    assert sorted(os.listdir(downloads)) == ['Profit N Loss 006_PL_CONSOLIDATED.xlsx', 'SKUK_Reports.xlsx', 'notes.xlsx']
+    assert not (onedrive / PL_006).exists()
+
+
+def test_no_overwrite_skips_existing_destinations(renamer, downloads, onedrive, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'), 'new')
+    workbook(str(onedrive / SUKUK), 'already filed')
+
+    results = renamer().rename_and_move_files(overwrite=False)
+    assert results[0]['error'].startswith('Skipped')
+    assert os.listdir(downloads) == ['SKUK_Reports.xlsx']
+
+
+def test_resume_finishes_an_interrupted_batch(renamer, downloads, onedrive, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    workbook(str(downloads / 'Profit N Loss 006_PL_CONSOLIDATED.xlsx'))
+    journal = renamingV7.OperationJournal(str(downloads / renamingV7.JOURNAL_NAME))
+    mover = renamer(journal=journal)
+    operations = mover.plan().operations
+    by_name = {operation.old_name: operation for operation in operations}
+
+    # The run died after filing the P&L report but before recording it, and left a partial copy
+    journal.begin(operations)
+    journal.close()
+    pl = by_name['Profit N Loss 006_PL_CONSOLIDATED.xlsx']
+    os.makedirs(pl.destination_folder)
+    os.replace(downloads / pl.old_name, pl.destination_path)
+    sukuk = by_name['SKUK_Reports.xlsx']
+    os.makedirs(sukuk.destination_folder)
+    partial = os.path.join(sukuk.destination_folder, '.' + sukuk.new_name + '.123.abc.part')
+    open(partial, 'wb').close()
+
+    results = {os.path.basename(result['old']): result for result in mover.resume()}
+    assert results['Profit N Loss 006_PL_CONSOLIDATED.xlsx']['strategy'] == 'completed'
+    assert results['SKUK_Reports.xlsx']['moved_to'] == str(onedrive / SUKUK)
+    assert not os.path.exists(partial)
+    assert os.listdir(downloads) == []
+    assert journal.pending() == []
+
+
+def test_journal_skips_torn_records(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    operation = renamingV7.PlannedMove('a.xlsx', 'A.xlsx', str(tmp_path), str(tmp_path / 'A.xlsx'), None, '14Jun2024')
+    journal = renamingV7.OperationJournal(str(path))
+    journal.begin([operation])
+    journal.close()
+    with open(path, 'a', encoding='utf-8') as torn:
+        torn.write('{"step": "done", "pa')
+    assert journal.pending() == [operation]
+
+
+def test_manifest_files_each_group_under_its_own_date(renamer, downloads, onedrive, workbook, capsys):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    workbook(str(downloads / 'Profit N Loss 006_PL_CONSOLIDATED.xlsx'))
+    groups = [{'name': 'june', 'rptdate': '2024-06-28', 'files': ['SKUK_Reports.xlsx', 'missing.xlsx']},
+              {'name': 'july', 'rptdate': '2024-07-01', 'sysdate': '2024-07-02', 'files': ['Profit N Loss 006_PL_CONSOLIDATED.xlsx']}]
+
+    results = renamer().process_manifest(groups)
+    printed = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert printed == results
+    by_group = {(result['group'], os.path.basename(result['old'])): result for result in results}
+    assert by_group['june', 'missing.xlsx']['error'] == 'File not found'
+    assert by_group['june', 'SKUK_Reports.xlsx']['moved_to'] == str(
+        onedrive / 'FINANCE' / '2024' / 'JUNE' / 'SUKUK' / 'SKUK_Report_28Jun2024sysdate28Jun2024.xlsx')
+    assert by_group['july', 'Profit N Loss 006_PL_CONSOLIDATED.xlsx']['moved_to'] == str(
+        onedrive / 'FINANCE' / '2024' / 'JULY' / 'P&L' / '006' / 'P&L_CONSOLIDATED_006_01Jul2024sysdate02Jul2024.xlsx')
+
+
+def test_manifest_refuses_a_file_in_two_groups(renamer):
+    groups = [{'rptdate': '2024-06-28', 'files': ['SKUK_Reports.xlsx']},
+              {'rptdate': '2024-07-01', 'files': ['SKUK_Reports.xlsx']}]
+    with pytest.raises(ValueError):
+        renamer().plan_manifest(groups)
@@ -0,0 +1,111 @@
+import os
+
+import renaming_core
+
+SUKUK = os.path.join('FINANCE', '2024', 'JUNE', 'SUKUK', 'SKUK_Report_14Jun2024sysdate15Jun2024.xlsx')
+
+
+def set_mtime(path, seconds):
+    os.utime(path, (seconds, seconds))
+
+
+def test_rename_and_move(renamer, downloads, onedrive, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    results = renamer().rename_and_move_files()
+    assert [result['moved_to'] for result in results] == [str(onedrive / SUKUK)]
+    assert os.listdir(downloads) == []
+
+
+def test_superseded_duplicate_is_kept_by_default(renamer, downloads, onedrive, workbook):
+    old = workbook(str(downloads / 'SKUK_Reports.xlsx'), 'stale')
+    new = workbook(str(downloads / 'SKUK_Reports (1).xlsx'), 'fresh')
+    set_mtime(old, 1_700_000_000)
+    set_mtime(new, 1_700_000_100)
+
+    results = renamer().rename_and_move_files()
+    assert [os.path.basename(result['old']) for result in results] == ['SKUK_Reports (1).xlsx']
+    assert os.listdir(downloads) == ['SKUK_Reports.xlsx']
+
+    # The next run does not file the stale copy over the newer report
+    results = renamer().rename_and_move_files()
+    assert 'newer' in results[0]['error']
+    assert os.path.exists(old)
+    with open(onedrive / SUKUK, 'rb') as filed:
+        assert b'fresh' in filed.read()
+
+
+def test_superseded_duplicate_is_removed_on_request(renamer, downloads, onedrive, workbook):
+    old = workbook(str(downloads / 'SKUK_Reports.xlsx'), 'stale')
+    new = workbook(str(downloads / 'SKUK_Reports (1).xlsx'), 'fresh')
+    set_mtime(old, 1_700_000_000)
+    set_mtime(new, 1_700_000_100)
+
+    renamer_mover = renamer()
+    renamer_mover.remove_duplicates = True
+    results = renamer_mover.rename_and_move_files()
+    assert [os.path.basename(result['old']) for result in results] == ['SKUK_Reports (1).xlsx']
+    assert os.listdir(downloads) == []
+    with open(onedrive / SUKUK, 'rb') as filed:
+        assert b'fresh' in filed.read()
+
+    # The next run finds nothing to file
+    assert renamer().rename_and_move_files() == []
+    with open(onedrive / SUKUK, 'rb') as filed:
+        assert b'fresh' in filed.read()
+
+
+def test_duplicates_are_kept_when_the_newest_fails(renamer, downloads, workbook):
+    old = workbook(str(downloads / 'SKUK_Reports.xlsx'), 'stale')
+    new = downloads / 'SKUK_Reports (1).xlsx'
+    new.write_bytes(b'<html>not a workbook</html>')
+    set_mtime(old, 1_700_000_000)
+    set_mtime(new, 1_700_000_100)
+
+    renamer_mover = renamer()
+    renamer_mover.remove_duplicates = True
+    results = renamer_mover.rename_and_move_files()
+    assert 'error' in results[0]
+    assert sorted(os.listdir(downloads)) == ['SKUK_Reports (1).xlsx', 'SKUK_Reports.xlsx']
+
+
+def test_newer_destination_is_not_overwritten(renamer, downloads, onedrive, workbook):
+    filed = workbook(str(onedrive / SUKUK), 'fresh')
+    stale = workbook(str(downloads / 'SKUK_Reports.xlsx'), 'stale')
+    set_mtime(stale, 1_700_000_000)
+    set_mtime(filed, 1_700_000_100)
+
+    results = renamer().rename_and_move_files()
+    assert 'newer' in results[0]['error']
+    assert os.path.exists(stale)
+    with open(filed, 'rb') as destination:
+        assert b'fresh' in destination.read()
+
+
+def test_older_destination_is_overwritten(renamer, downloads, onedrive, workbook):
+    filed = workbook(str(onedrive / SUKUK), 'stale')
+    fresh = workbook(str(downloads / 'SKUK_Reports.xlsx'), 'fresh')
+    set_mtime(filed, 1_700_000_000)
+    set_mtime(fresh, 1_700_000_100)
+
+    results = renamer().rename_and_move_files()
+    assert results[0]['moved_to'] == filed
+    with open(filed, 'rb') as destination:
+        assert b'fresh' in destination.read()
+
+
+def test_verified_copy_digest_is_kept(renamer, downloads, onedrive, workbook, tmp_path, monkeypatch):
+    source = workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    expected = renaming_core.file_digest(source)
+    mover = renamer()
+    mover.verify = renaming_core.VerifiedTransfer()
+    mover.catalog = renaming_core.ReportCatalog(str(tmp_path / 'catalog.sqlite3'))
+    # File it as if OneDrive were on another volume, through the checksummed copy
+    monkeypatch.setattr(mover, 'folder_device', lambda folder: -1)
+    hashed = []
+    monkeypatch.setattr(renaming_core, 'file_digest', lambda path: hashed.append(path) or expected)
+
+    results = mover.rename_and_move_files()
+    assert (results[0]['strategy'], results[0]['digest']) == ('verified', expected)
+    assert hashed == []
+    assert renaming_core.read_content_index(str((onedrive / SUKUK).parent))[os.path.basename(SUKUK)]['blake2b'] == expected
+    assert [row['blake2b'] for row in mover.catalog.query()] == [expected]
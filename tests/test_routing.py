@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import renaming_core
+
+
+def test_report_dates_are_normalized():
+    assert renaming_core.normalize_report_date('2024-06-14') == '14Jun2024'
+    assert renaming_core.normalize_report_date('14Jun2024') == '14Jun2024'
+    assert renaming_core.date_path('2024-06-14') == ('2024', 'JUNE')
+    with pytest.raises(ValueError):
+        renaming_core.normalize_report_date('14/06/2024')
+
+
+def test_name_template_renders_placeholders():
+    template = renaming_core.NameTemplate('SKUK_Report_{RPTDATE}sysdate{SYSDATE}.xlsx')
+    assert template.fields == {'RPTDATE', 'SYSDATE'}
+    assert template.render({'RPTDATE': '14Jun2024', 'SYSDATE': '15Jun2024'}) == 'SKUK_Report_14Jun2024sysdate15Jun2024.xlsx'
+    with pytest.raises(ValueError):
+        renaming_core.NameTemplate('Report_{RPTDATE:>10}.xlsx')
+
+
+def test_matcher_takes_exact_names_duplicates_and_patterns(config):
+    matcher = config.source_matcher
+    exact = matcher.match('SKUK_Reports.xlsx')
+    assert exact is not None and matcher.rules[exact[0]].filename == 'SKUK_Reports.xlsx'
+    assert matcher.match('SKUK_Reports (2).xlsx')[0] == exact[0]
+    # A branch that is not in the file mapping is caught by its source pattern
+    index, values = matcher.match('Profit N Loss 123_PL_CONSOLIDATED.xlsx')
+    assert matcher.rules[index].filename is None and values == {'BRANCH': '123'}
+    assert matcher.match('SKUK_Reports.xlsx.crdownload') is None
+
+
+def test_router_picks_the_longest_prefix(config, tmp_path):
+    router = config.router(str(tmp_path))
+    routes = {
+        'P&L_CONSOLIDATED_006_14Jun2024sysdate15Jun2024.xlsx': ('FINANCE', '2024', 'JUNE', 'P&L', '006'),
+        'FUND CUSTOMER BALANCE_14Jun2024sysdate15Jun2024.xlsx': ('FINANCE', '2024', 'JUNE', 'FUND CUSTOMER BALANCE'),
+        'CUSTOMER BALANCE_14Jun2024sysdate15Jun2024.xlsx': ('CREDIT', '2024', 'JUNE', 'CUSTOMER BALANCE'),
+        'Unknown_14Jun2024.xlsx': (),
+    }
+    for name, parts in routes.items():
+        assert router.route(name, '14Jun2024') == os.path.join(str(tmp_path), *parts)
+    assert router.classify('Balancesheet_consolidated_003_14Jun2024.xlsx')[1] == '003'
+    with pytest.raises(ValueError):
+        router.route('SKUK_Report_14Jun2024.xlsx')
+
+
+def test_unknown_destination_placeholder_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        renaming_core.PrefixRouter([renaming_core.RouteRule('X_', ('{BRANCH}',), False)], str(tmp_path))
+
+
+def test_renamer_renders_and_routes(renamer, onedrive):
+    mover = renamer(rptdate='31Jul2024', sysdate='01Aug2024')
+    _, new_name, report_date = mover.match_source('Profit N Loss 004_PL_CONSOLIDATED (1).xlsx')
+    assert new_name == 'P&L_CONSOLIDATED_004_31Jul2024sysdate01Aug2024.xlsx'
+    assert mover.determine_destination_folder(new_name, report_date) == str(onedrive / 'FINANCE' / '2024' / 'JULY' / 'P&L' / '004')
@@ -0,0 +1,37 @@
+import pytest
+
+import renaming_core
+
+
+def test_complete_workbook_lists_its_sheets(workbook, tmp_path):
+    path = workbook(str(tmp_path / 'report.xlsx'))
+    assert renaming_core.validate_workbook(path, expected_sheets=['Report']) == ['Report']
+    with pytest.raises(renaming_core.WorkbookError, match='no sheet'):
+        renaming_core.validate_workbook(path, expected_sheets=['Summary'])
+
+
+def test_truncated_workbook_is_refused(workbook, tmp_path):
+    path = workbook(str(tmp_path / 'report.xlsx'), size=64 * 1024)
+    with open(path, 'r+b') as truncated:
+        truncated.truncate(32 * 1024)
+    with pytest.raises(renaming_core.WorkbookError, match='damaged or incomplete'):
+        renaming_core.validate_workbook(path)
+
+
+def test_error_page_saved_as_a_workbook_is_refused(tmp_path):
+    path = tmp_path / 'report.xlsx'
+    path.write_bytes(b'<!DOCTYPE html><html>Session expired</html>')
+    with pytest.raises(renaming_core.WorkbookError, match='HTML'):
+        renaming_core.validate_workbook(str(path))
+
+
+def test_xls_header_is_checked(tmp_path):
+    header = bytearray(512)
+    header[:8] = renaming_core.OLE_SIGNATURE
+    header[30:32] = (9).to_bytes(2, 'little')
+    path = tmp_path / 'report.xls'
+    path.write_bytes(bytes(header))
+    assert renaming_core.validate_workbook(str(path)) is None
+    path.write_bytes(bytes(header[:100]))
+    with pytest.raises(renaming_core.WorkbookError):
+        renaming_core.validate_workbook(str(path))
@@ -0,0 +1,154 @@
+import os
+import struct
+from datetime import datetime
+
+import pytest
+
+import renamingV7
+
+
+class ScriptedWatcher:
+    """
+    Watcher replaying a list of steps: lists of changed names, None for a lost-events overflow,
+    exceptions to raise, or callables run before the next step (e.g. to finish a download).
+    """
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def changes(self, timeout=None):
+        while self.steps:
+            step = self.steps.pop(0)
+            if callable(step) and not isinstance(step, type):
+                step()
+                continue
+            if isinstance(step, BaseException):
+                raise step
+            return step
+        raise KeyboardInterrupt
+
+
+def watch(renamer_mover, steps, **options):
+    with pytest.raises(KeyboardInterrupt):
+        renamer_mover.watch(ScriptedWatcher(steps), settle=0, **options)
+
+
+def test_placeholder_beside_a_partial_download_is_not_filed(renamer, downloads, onedrive, workbook):
+    placeholder = downloads / 'SKUK_Reports.xlsx'
+    placeholder.write_bytes(b'')
+    partial = downloads / 'SKUK_Reports.xlsx.part'
+    partial.write_bytes(b'PK\x03\x04 still downloading')
+    renamer_mover = renamer()
+
+    watch(renamer_mover, [['SKUK_Reports.xlsx'], [], ['SKUK_Reports.xlsx']])
+    assert placeholder.exists()
+    assert not os.path.exists(onedrive)
+
+    def finish():
+        partial.unlink()
+        workbook(str(placeholder))
+
+    watch(renamer_mover, [finish, ['SKUK_Reports.xlsx'], [], []])
+    assert os.listdir(downloads) == []
+    assert len(os.listdir(onedrive / 'FINANCE' / '2024' / 'JUNE' / 'SUKUK')) == 1
+
+
+def test_non_empty_file_with_a_partial_sibling_waits(renamer, downloads, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    (downloads / 'SKUK_Reports.xlsx.crdownload').write_bytes(b'newer download')
+    watch(renamer(), [['SKUK_Reports.xlsx'], [], []])
+    assert sorted(os.listdir(downloads)) == ['SKUK_Reports.xlsx', 'SKUK_Reports.xlsx.crdownload']
+
+
+def test_file_changed_just_before_filing_waits(renamer, downloads, monkeypatch, workbook):
+    path = workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    renamer_mover = renamer()
+    signature = renamer_mover.download_signature
+    looks = []
+
+    def growing(name):
+        # The file grows between the settle check and the last look before filing
+        looks.append(name)
+        if len(looks) == 3:
+            with open(path, 'ab') as download:
+                download.write(b'more')
+        return signature(name)
+
+    monkeypatch.setattr(renamer_mover, 'download_signature', growing)
+    watch(renamer_mover, [[], []])
+    assert os.listdir(downloads) == ['SKUK_Reports.xlsx']
+    watch(renamer_mover, [[], []])
+    assert os.listdir(downloads) == []
+
+
+def test_errors_do_not_stop_watching(renamer, downloads, workbook):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    watch(renamer(), [OSError(5, 'Input/output error'), ['SKUK_Reports.xlsx'], []])
+    assert os.listdir(downloads) == []
+
+
+def test_files_that_cannot_be_filed_are_reported_one_by_one(renamer, downloads, onedrive, workbook, caplog):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    (downloads / 'Profit N Loss 004_PL_CONSOLIDATED.xlsx').write_bytes(b'<html>Session expired</html>')
+    watch(renamer(), [[], []])
+    assert os.listdir(downloads) == ['Profit N Loss 004_PL_CONSOLIDATED.xlsx']
+    assert os.listdir(onedrive / 'FINANCE' / '2024' / 'JUNE' / 'SUKUK') == ['SKUK_Report_14Jun2024sysdate15Jun2024.xlsx']
+    assert 'not an .xlsx workbook' in caplog.text
+
+
+def test_name_that_cannot_be_rendered_does_not_stop_the_batch(renamer, downloads, onedrive, workbook, monkeypatch, caplog):
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    workbook(str(downloads / 'Profit N Loss 004_PL_CONSOLIDATED.xlsx'))
+    renamer_mover = renamer()
+    match_source = renamer_mover.match_source
+
+    def bad_date(name, additional_info=None):
+        if name.startswith('Profit'):
+            raise ValueError('31Feb2024 is not a valid date')
+        return match_source(name, additional_info)
+
+    monkeypatch.setattr(renamer_mover, 'match_source', bad_date)
+    watch(renamer_mover, [[], []])
+    assert os.listdir(downloads) == ['Profit N Loss 004_PL_CONSOLIDATED.xlsx']
+    assert 'Profit N Loss 004_PL_CONSOLIDATED.xlsx: 31Feb2024 is not a valid date' in caplog.text
+
+
+def test_dates_not_given_follow_the_calendar(renamer, downloads, onedrive, workbook, monkeypatch):
+    class Tomorrow(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2024, 7, 1, 0, 5)
+
+    monkeypatch.setattr(renamingV7, 'datetime', Tomorrow)
+    workbook(str(downloads / 'SKUK_Reports.xlsx'))
+    watch(renamer(rptdate='30Jun2024'), [[], []], current_date_fields=('RPTDATE', 'SYSDATE'))
+    assert os.listdir(onedrive / 'FINANCE' / '2024' / 'JULY' / 'SUKUK') == ['SKUK_Report_01Jul2024sysdate01Jul2024.xlsx']
+
+
+def test_overflow_lists_the_directory_again(renamer, downloads, workbook):
+    renamer_mover = renamer()
+    # Arrives while events are being dropped
+    watch(renamer_mover, [lambda: workbook(str(downloads / 'SKUK_Reports.xlsx')), None, []])
+    assert os.listdir(downloads) == []
+
+
+def test_inotify_overflow_event_is_reported():
+    read_fd, write_fd = os.pipe()
+    watcher = renamingV7.InotifyWatcher.__new__(renamingV7.InotifyWatcher)
+    watcher.fd = read_fd
+    try:
+        name = b'SKUK_Reports.xlsx\0\0\0'
+        os.write(write_fd, struct.pack('iIII', 1, watcher.IN_MOVED_TO, 0, len(name)) + name)
+        assert watcher.changes(0) == ['SKUK_Reports.xlsx']
+        os.write(write_fd, struct.pack('iIII', -1, watcher.IN_Q_OVERFLOW, 0, 0))
+        assert watcher.changes(0) is None
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def test_username_without_a_console(monkeypatch):
+    monkeypatch.setenv('USERNAME', 'tester')
+    monkeypatch.setenv('LOGNAME', 'tester')
+    monkeypatch.setenv('USER', 'tester')
+    assert renamingV7.FileRenamerMover.get_logged_in_username(None) == 'tester'